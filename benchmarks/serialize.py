@@ -0,0 +1,116 @@
+"""Time :py:func:`dcc_sra.serialize.write_xml` on a synthetic projected
+study with 1 process and then with more, up to the number of cores.
+
+    python benchmarks/serialize.py --samples 10000
+
+Every run must write the same bytes as the single process run.
+
+"""
+
+import os
+import sys
+import time
+import hashlib
+import argparse
+import multiprocessing
+
+# run as a script, only benchmarks/ is on the path, not the checkout
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from dcc_sra import SubmitRecord
+from dcc_sra import PrepSeq
+from dcc_sra.project import StudyMeta
+from dcc_sra.project import SampleMeta
+from dcc_sra.project import PrepMeta
+from dcc_sra.project import SeqMeta
+from dcc_sra.serialize import write_xml
+
+
+class Digest(object):
+    """Stand-in for the submission file; keeps only a checksum and the
+    size of what's written"""
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        self.md5.update(data)
+        self.size += len(data)
+
+
+def study(n_samples, files_per_seq=2):
+    """:returns: Tuple; the study, its records, and the tardict
+    :py:func:`write_xml` needs. Every sample has a 16S sequence set,
+    and every other sample a WGS one too."""
+    st = StudyMeta("study", "Synthetic", "A synthetic study for timing "
+                   "serialization", None)
+    mixs = tuple(sorted(dict(
+        biome="terrestrial biome", collection_date="2016-01-01",
+        feature="human-associated habitat", material="feces",
+        geo_loc_name="USA", lat_lon="42.36 N 71.06 W",
+        rel_to_oxygen="anaerobe", samp_size="1 g").iteritems()))
+    records, tardict = list(), dict()
+    for i in range(n_samples):
+        sample = SampleMeta("sa%i"%(i), "Sample %i"%(i), mixs, None)
+        for seqtype in ("16s", "wgs"):
+            if seqtype == "wgs" and i % 2:
+                continue
+            prep = PrepMeta("%s_p%s"%(sample.id, seqtype), seqtype, "408170",
+                            "pcr" if seqtype == "16s" else "random",
+                            "Library construction for "+seqtype)
+            url = "fasp://aspera.ihmpdcc.org/%s/%s.tar"%(seqtype, sample.id)
+            seq = SeqMeta("%s_s%s"%(sample.id, seqtype), seqtype,
+                          "Illumina HiSeq 2500", (url,), 1000, None, None)
+            tardict[(url.rsplit("/", 1)[1], seqtype)] = [
+                ["%s_R%i.fastq.gz"%(seq.id, r), "1000"]
+                for r in range(1, files_per_seq+1) ]
+            records.append(SubmitRecord(sample, [PrepSeq(prep, seq)]))
+    return st, records, tardict
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--samples", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per worker count; the fastest is shown")
+    parser.add_argument("--max-workers", type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument("--chunksize", type=int, default=64)
+    opts = parser.parse_args()
+
+    st, records, tardict = study(opts.samples)
+    workers, counts = 1, list()
+    while workers < opts.max_workers:
+        counts.append(workers)
+        workers *= 2
+    counts.append(opts.max_workers)
+
+    print "%i samples, %i records, %i cores"%(
+        opts.samples, len(records), multiprocessing.cpu_count())
+    print "%8s %10s %8s %10s"%("workers", "seconds", "speedup", "MB")
+    expected, serial = None, None
+    for workers in counts:
+        best = None
+        for _ in range(opts.repeat):
+            out = Digest()
+            start = time.time()
+            write_xml(out, st, records, tardict, workers=workers,
+                      chunksize=opts.chunksize)
+            secs = time.time() - start
+            best = secs if best is None else min(best, secs)
+            if expected is None:
+                expected = out.md5.hexdigest()
+            elif out.md5.hexdigest() != expected:
+                print >> sys.stderr, "Output with %i workers differs"%(
+                    workers)
+                return 1
+        serial = serial or best
+        print "%8i %10.2f %8.2f %10.1f"%(workers, best, serial/best,
+                                         out.size/1e6)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
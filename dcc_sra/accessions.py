@@ -0,0 +1,157 @@
+import sqlite3
+import threading
+from collections import namedtuple
+from os.path import basename
+
+from .util import reportnum
+from .update import _is_ok
+
+FNAME = "accessions.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    spuid     TEXT PRIMARY KEY,
+    target_db TEXT,
+    accession TEXT,
+    status    TEXT,
+    report    INTEGER,
+    tagged    INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS files (
+    spuid TEXT,
+    name  TEXT,
+    size  INTEGER,
+    PRIMARY KEY (spuid, name)
+);
+"""
+
+Entry = namedtuple("Entry", "spuid target_db accession status report "
+                   "tagged files")
+
+
+class AccessionIndex(object):
+    """What was submitted to NCBI and what came of it, by SPUID: the
+    target database, the accession, the latest status and the number
+    of the report it came from, whether the OSDF node is tagged with
+    the accession, and the names and sizes of the files uploaded for
+    it. Safe to share between threads.
+
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(fname, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+
+    def get(self, spuid):
+        """:returns: :py:class:`Entry` or None"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT spuid, target_db, accession, status, report, tagged"
+                " FROM objects WHERE spuid = ?", (spuid,)).fetchone()
+            files = self.db.execute(
+                "SELECT name, size FROM files WHERE spuid = ?"
+                " ORDER BY name", (spuid,)).fetchall()
+        if row is None and not files:
+            return None
+        row = row or (spuid, None, None, None, None, 0)
+        return Entry(*(row[:5]+(bool(row[5]), files)))
+
+
+    def accession(self, spuid, target_db=None):
+        """:returns: String; the accession NCBI accepted ``spuid``
+        under, if any"""
+        e = self.get(spuid)
+        if e is None or not e.accession or not _is_ok(e.status):
+            return None
+        if target_db and e.target_db != target_db:
+            return None
+        return e.accession
+
+
+    def record_statuses(self, statuses):
+        """Save the latest status of objects from NCBI's reports. An
+        accession already on record is kept if a status comes without
+        one.
+
+        :param statuses: Iterable of
+        :py:class:`dcc_sra.update.ObjectStatus`
+
+        """
+        rows = [ (s.spuid, s.target_db, s.accession, s.status,
+                  reportnum(basename(s.report)) if s.report else None)
+                 for s in statuses ]
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO objects (spuid) VALUES (?)",
+                [ r[:1] for r in rows ])
+            self.db.executemany(
+                "UPDATE objects SET target_db = coalesce(?, target_db),"
+                " accession = coalesce(?, accession), status = ?,"
+                " report = ? WHERE spuid = ?",
+                [ r[1:]+r[:1] for r in rows ])
+
+
+    def mark_tagged(self, objects):
+        """Note that OSDF nodes carry their accession tags
+
+        :param objects: Iterable of tuples; ``(spuid, target_db,
+        accession)``
+
+        """
+        with self.lock, self.db:
+            for spuid, target_db, acc in objects:
+                self.db.execute(
+                    "INSERT OR IGNORE INTO objects (spuid) VALUES (?)",
+                    (spuid,))
+                self.db.execute(
+                    "UPDATE objects SET target_db = ?, accession = ?,"
+                    " tagged = 1 WHERE spuid = ?", (target_db, acc, spuid))
+
+
+    def record_files(self, spuid, files):
+        """Save the files uploaded for ``spuid``
+
+        :param files: Iterable of tuples; ``(name, size)``
+
+        """
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM files WHERE spuid = ?", (spuid,))
+            self.db.executemany(
+                "INSERT INTO files (spuid, name, size) VALUES (?, ?, ?)",
+                [ (spuid, name, size) for name, size in files ])
+
+
+    def lacking(self, spuids, target_db=None):
+        """:returns: List of strings; the SPUIDs in ``spuids`` with no
+        accepted accession"""
+        return [ s for s in spuids if not self.accession(s, target_db) ]
+
+
+    def known(self):
+        """:returns: Dictionary; SPUID to None for every object with an
+        accepted accession, in the form ``write_xml`` takes"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT spuid, status FROM objects"
+                " WHERE accession IS NOT NULL").fetchall()
+        return dict( (spuid, None) for spuid, status in rows
+                     if _is_ok(status) )
+
+
+    def tags(self):
+        """:returns: Dictionary; SPUID to the set of accession tags its
+        OSDF node is known to carry, in the form ``tag_nodes`` takes"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT spuid, target_db, accession FROM objects"
+                " WHERE tagged = 1").fetchall()
+        return dict( (spuid, set([target_db+":"+acc]))
+                     for spuid, target_db, acc in rows )
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,89 @@
+import os
+import sys
+import tempfile
+import subprocess
+from os.path import basename
+from collections import namedtuple
+
+# point this at a stand-in to run without a real Aspera client
+ASCP = os.environ.get("DCC_SRA_ASCP", "ascp")
+
+Transferred = namedtuple("Transferred", "path size ok")
+
+# resume partial files, checking what's there with a sparse checksum
+RESUME = ["-k", "2"]
+
+
+def _ascp(args, password=None):
+    env = dict(os.environ)
+    if password:
+        env['ASPERA_SCP_PASS'] = password
+    proc = subprocess.Popen([ASCP]+args, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, env=env)
+    out = proc.communicate()[0]
+    return proc.returncode, out
+
+
+def download_file(server, user, password, remote_path, local_dir,
+                  keyfile=None, rate="200M"):
+    """Download one file into ``local_dir``, resuming a partial download
+    left there by an earlier attempt.
+
+    :returns: Boolean; True if ascp succeeded
+
+    """
+    args = ["-Q", "-T", "-l", rate] + RESUME
+    if keyfile:
+        args += ["-i", keyfile]
+    args += ["%s@%s:%s"%(user, server, remote_path), local_dir]
+    returncode, out = _ascp(args, password)
+    if returncode != 0:
+        print >> sys.stderr, "ascp exited with %i: %s"%(returncode,
+                                                         out.strip())
+    return returncode == 0
+
+
+def upload_files(server, user, password, local_files, remote_path,
+                 keyfile=None, rate="200M", verify=None):
+    """Upload several files to one remote directory in a single ascp
+    session, paying for the SSH handshake and session setup once.
+
+    :param verify: Callable; given a file's basename, returns its size
+    on the server or None. Only used if ascp fails, to work out which
+    files made it anyway.
+
+    :returns: List of :py:class:`Transferred`; one per local file, in
+    the order given
+
+    """
+    if not local_files:
+        return []
+    sizes = [ os.stat(f).st_size for f in local_files ]
+    fd, list_fname = tempfile.mkstemp(prefix="ascp_files.", suffix=".txt")
+    try:
+        with os.fdopen(fd, 'w') as out:
+            for fname in local_files:
+                print >> out, os.path.abspath(fname)
+        args = ["-Q", "-T", "-d", "-l", rate, "--file-list="+list_fname]
+        args += RESUME
+        if keyfile:
+            args += ["-i", keyfile]
+        args.append("%s@%s:%s"%(user, server, remote_path))
+        returncode, out = _ascp(args, password)
+    finally:
+        os.remove(list_fname)
+
+    if returncode == 0:
+        return [ Transferred(f, s, True) for f, s in zip(local_files, sizes) ]
+    print >> sys.stderr, "ascp exited with %i: %s"%(returncode, out.strip())
+    if verify is None:
+        return [ Transferred(f, s, False) for f, s in zip(local_files, sizes) ]
+    return [ Transferred(f, s, _remote_size(verify, f) == s)
+             for f, s in zip(local_files, sizes) ]
+
+
+def _remote_size(verify, fname):
+    try:
+        return verify(basename(fname))
+    except (OSError, IOError):
+        return None
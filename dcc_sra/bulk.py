@@ -0,0 +1,155 @@
+import sys
+import time
+import threading
+from itertools import count
+from itertools import chain
+from collections import OrderedDict
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+from .snapshot import DocNode
+
+# (rel, node_type, linkage field, rel of the parents) for each level,
+# in the order they're loaded. The "seqs" levels have to cover every
+# node type the cutlass preps' child_seq_sets() returns, which is what
+# the per-node walk submits: the raw sequence sets of a 16S prep, and
+# the raw, private raw and microbial transcriptomics raw sequence sets
+# of a WGS prep. Trimmed sets hang off raw sets, not preps, so they
+# were never part of a submission.
+LEVELS = (
+    ("subjects",  "subject",         "participates_in",  None),
+    ("visits",    "visit",           "by",               "subjects"),
+    ("samples",   "sample",          "collected_during", "visits"),
+    ("preps_16s", "16s_dna_prep",    "prepared_from",    "samples"),
+    ("preps_wgs", "wgs_dna_prep",    "prepared_from",    "samples"),
+    ("seqs",      "16s_raw_seq_set", "sequenced_from",   "preps_16s"),
+    ("seqs",      "wgs_raw_seq_set", "sequenced_from",   "preps_wgs"),
+    ("seqs",      "wgs_raw_seq_set_private", "sequenced_from", "preps_wgs"),
+    ("seqs",      "microb_transcriptomics_raw_seq_set", "sequenced_from",
+     "preps_wgs"),
+)
+
+
+def _chunks(seq, n):
+    for i in range(0, len(seq), n):
+        yield seq[i:i+n]
+
+
+class Graph(object):
+    """In-memory OSDF study graph, joined from bulk query results."""
+
+    def __init__(self):
+        self.nodes = dict()
+        self._children = defaultdict(list)
+
+    def add(self, doc):
+        if doc['id'] not in self.nodes:
+            self.nodes[doc['id']] = DocNode(doc, self)
+        return self.nodes[doc['id']]
+
+    def link(self, parent_id, rel, node):
+        self._children[(parent_id, rel)].append(node)
+
+    def sort(self):
+        for children in self._children.itervalues():
+            children.sort(key=lambda n: n.id)
+
+    def children(self, parent_id, rel):
+        return self._children.get((parent_id, rel), [])
+
+
+class BulkLoader(object):
+    """Load a whole study with one set of paginated OSDF queries per
+    node type instead of one query per parent node.
+
+    :param osdf: ``osdf.OSDF`` instance, e.g. from
+    ``cutlass.iHMPSession.get_osdf()``
+
+    :keyword batch_size: Integer; how many parent IDs to put in each
+    linkage query
+
+    :keyword workers: Integer; how many queries to run at once
+
+    """
+
+    def __init__(self, osdf, namespace="ihmp", batch_size=100, workers=8):
+        self.osdf = osdf
+        self.namespace = namespace
+        self.batch_size = batch_size
+        self.workers = max(1, int(workers))
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.timings = OrderedDict()
+        self.counts = OrderedDict()
+
+
+    def _query(self, query):
+        docs, seen = list(), 0
+        for page in count(1):
+            res = self.osdf.oql_query(self.namespace, query, page=page)
+            with self._lock:
+                self.requests += 1
+            docs.extend(res['results'])
+            seen += len(res['results'])
+            if 'search_result_total' not in res:
+                raise Exception("OSDF gave no search_result_total for query"
+                                " `%s'; unable to page through it"%(query))
+            total = res['search_result_total']
+            if not res['results'] or seen >= total:
+                break
+        return docs
+
+
+    def _linked(self, node_type, field, parent_ids):
+        def _q(ids):
+            linked = " || ".join('"%s"[linkage.%s]'%(i, field) for i in ids)
+            return self._query('"%s"[node_type] && (%s)'%(node_type, linked))
+        batches = list(_chunks(parent_ids, self.batch_size))
+        if self.workers == 1 or len(batches) < 2:
+            return list(chain.from_iterable(map(_q, batches)))
+        pool = ThreadPool(min(self.workers, len(batches)))
+        try:
+            return list(chain.from_iterable(
+                pool.map(_q, batches, chunksize=1)))
+        finally:
+            pool.close()
+            pool.join()
+
+
+    def load(self, study_id):
+        """Load ``study_id`` and everything below it.
+
+        :returns: :py:class:`dcc_sra.snapshot.DocNode`; the study,
+        ready to be walked by :py:class:`dcc_sra.traverse.StudyTraversal`
+
+        """
+        graph = Graph()
+        self.requests += 1
+        study = graph.add(self.osdf.get_node(study_id))
+        by_rel = {None: [study_id]}
+        for rel, node_type, field, parent_rel in LEVELS:
+            start = time.time()
+            parent_ids = by_rel[parent_rel]
+            wanted = set(parent_ids)
+            ids = by_rel.setdefault(rel, list())
+            docs, seen = self._linked(node_type, field, parent_ids), set()
+            for doc in docs:
+                if doc['id'] in seen:
+                    continue
+                seen.add(doc['id'])
+                node = graph.add(doc)
+                for parent_id in doc['linkage'].get(field, []):
+                    if parent_id in wanted:
+                        graph.link(parent_id, rel, node)
+                ids.append(node.id)
+            self.timings[node_type] = time.time() - start
+            self.counts[node_type] = len(seen)
+        graph.sort()
+        return study
+
+
+    def report(self, out=sys.stderr):
+        for node_type, secs in self.timings.iteritems():
+            print >> out, "OSDF bulk load: %s took %.2fs (%i nodes)"%(
+                node_type, secs, self.counts[node_type])
+        print >> out, "OSDF bulk load: %i requests"%(self.requests)
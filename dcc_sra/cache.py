@@ -0,0 +1,162 @@
+import os
+import sys
+import fcntl
+import errno
+import shutil
+import hashlib
+import threading
+from os.path import join
+from os.path import exists
+from contextlib import contextmanager
+
+
+def _link(src, dest):
+    """Hard link ``src`` to ``dest``, or copy it if they're on
+    different file systems"""
+    tmp = dest+".tmp"
+    if exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copyfile(src, tmp)
+    os.rename(tmp, dest)
+
+
+class TarballCache(object):
+    """Tarballs downloaded from the DCC, kept in ``root`` for any run or
+    study that needs them again.
+
+    Entries are keyed by URL and size, and by md5 when one is known; an
+    entry whose md5 doesn't match what's asked for is a miss. Files go
+    in and out of the cache as hard links where possible, so neither
+    costs a copy, and evicting an entry never pulls a file out from
+    under a transfer using it. Once the cache holds more than
+    ``max_bytes``, the least recently used entries are evicted.
+    Processes sharing ``root`` coordinate through a lock file, which is
+    only held for renames and links within ``root``; copies to or from
+    another file system happen outside it.
+
+    """
+
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        if not os.path.isdir(root):
+            try:
+                os.makedirs(root)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.hits = self.misses = 0
+
+
+    @contextmanager
+    def _locked(self, mode=fcntl.LOCK_EX):
+        with open(join(self.root, ".lock"), 'a') as lock:
+            fcntl.flock(lock.fileno(), mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+    def _path(self, url, size):
+        return join(self.root, hashlib.sha1("%s\t%s"%(url, size)).hexdigest())
+
+
+    def _tmp(self, path):
+        return "%s.%i.%i.tmp"%(path, os.getpid(),
+                               threading.current_thread().ident)
+
+
+    def fetch(self, url, size, md5, dest):
+        """Put the cached copy of a tarball at ``dest``, if there is one
+
+        :returns: Boolean; True on a hit
+
+        """
+        path = self._path(url, size)
+        snap = self._tmp(path)
+        with self._locked(fcntl.LOCK_SH):
+            hit = (exists(path) and os.stat(path).st_size == size
+                   and (not md5 or self._stored_md5(path) == md5))
+            if hit:
+                # a link that eviction can't take away, to copy from
+                _link(path, snap)
+                os.utime(path, None)
+        if hit:
+            try:
+                _link(snap, dest)
+            finally:
+                os.remove(snap)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return hit
+
+
+    def _stored_md5(self, path):
+        if not exists(path+".md5"):
+            return None
+        with open(path+".md5") as f:
+            return f.read().strip()
+
+
+    def store(self, url, size, md5, src):
+        """Add a downloaded tarball to the cache. A tarball that doesn't
+        match its expected size is left out. ``md5`` is taken as the
+        checksum of ``src`` as is, so check it first, e.g. with the
+        ``checksum`` of :py:func:`dcc_sra.transfer.untar`; if it's None
+        the entry has no md5, and only matches requests without one."""
+        if os.stat(src).st_size != size:
+            print >> sys.stderr, "Not caching %s: size mismatch"%(url)
+            return False
+        path = self._path(url, size)
+        tmp = self._tmp(path)
+        _link(src, tmp)
+        try:
+            with self._locked():
+                if md5:
+                    with open(path+".md5.tmp", 'w') as f:
+                        print >> f, md5
+                    os.rename(path+".md5.tmp", path+".md5")
+                elif exists(path+".md5"):
+                    os.remove(path+".md5")
+                os.rename(tmp, path)
+                # a link keeps the mtime of the download, not of now
+                os.utime(path, None)
+                self._evict()
+        finally:
+            if exists(tmp):
+                os.remove(tmp)
+        return True
+
+
+    def _entries(self):
+        for name in os.listdir(self.root):
+            if name.startswith(".") or "." in name:
+                continue
+            st = os.stat(join(self.root, name))
+            yield st.st_mtime, st.st_size, join(self.root, name)
+
+
+    def _evict(self):
+        if not self.max_bytes:
+            return
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            for f in (path, path+".md5"):
+                if exists(f):
+                    os.remove(f)
+            total -= size
+
+
+    def report(self):
+        print >> sys.stderr, "Tarball cache %s: %i hits, %i misses"%(
+            self.root, self.hits, self.misses)
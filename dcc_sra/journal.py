@@ -0,0 +1,87 @@
+import os
+import threading
+from os.path import exists
+
+
+class Journal(object):
+    """Append-only record of the steps a transfer has finished, so a
+    transfer that was interrupted can pick up where it left off.
+
+    Each line is a tab-separated step; ``downloaded`` with the tarball
+    size, ``extracted`` with a member's name, size, md5 and sha256,
+    ``extracted_all`` once every member is on disk, and ``uploaded``
+    with a member's name and size. Every line is flushed to disk
+    before the step is considered done; a line cut short by a crash is
+    ignored.
+
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.download_size = None
+        self.members = list()
+        self.extracted = False
+        self.uploaded = dict()
+        self.lock = threading.Lock()
+        if exists(fname):
+            self._load()
+
+
+    def _load(self):
+        extracted = list()
+        with open(self.fname) as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                fields = line.rstrip("\n").split("\t")
+                step = fields[0]
+                if step == "downloaded":
+                    self.download_size = int(fields[1])
+                elif step == "extracted":
+                    name, size, md5, sha256 = fields[1:]
+                    extracted.append((name, int(size), md5, sha256))
+                elif step == "extracted_all":
+                    self.members, self.extracted = extracted, True
+                    extracted = list()
+                elif step == "uploaded":
+                    self.uploaded[fields[1]] = int(fields[2])
+
+
+    def _write(self, *lines):
+        with self.lock:
+            with open(self.fname, 'a') as f:
+                for fields in lines:
+                    print >> f, "\t".join(map(str, fields))
+                f.flush()
+                os.fsync(f.fileno())
+
+
+    def record_download(self, size):
+        self._write(("downloaded", size))
+        self.download_size = size
+
+
+    def record_extract(self, members):
+        """Record every member of a tarball as extracted, all at once;
+        a tarball is either extracted entirely or not at all.
+
+        :param members: List of tuples; path, size, md5 and sha256
+
+        """
+        self._write(*[ ("extracted",)+tuple(m) for m in members ]
+                     +[("extracted_all",)])
+        self.members, self.extracted = map(tuple, members), True
+
+
+    def record_upload(self, member):
+        self._write(("uploaded", member.path, member.size))
+        self.uploaded[member.path] = member.size
+
+
+    def is_uploaded(self, member):
+        return self.uploaded.get(member.path) == member.size
+
+
+    def remove(self):
+        if exists(self.fname):
+            os.remove(self.fname)
@@ -0,0 +1,127 @@
+import os
+import fcntl
+import threading
+from os.path import exists
+from contextlib import contextmanager
+
+from .update import accepted
+from .update import merge_reports
+from .update import _is_ok
+
+FNAME = "ledger.txt"
+
+
+def read_fingerprints(fname):
+    ret = dict()
+    if not exists(fname):
+        return ret
+    with open(fname) as f:
+        for line in f:
+            spuid, _, fp = line.rstrip("\n").split("\t")
+            ret[spuid] = fp
+    return ret
+
+
+def write_fingerprints(fname, emitted):
+    with open(fname, 'w') as f:
+        for fields in emitted:
+            print >> f, "\t".join(fields)
+
+
+class Ledger(object):
+    """Objects NCBI accepted in earlier submissions, with the
+    fingerprint of the Action that was accepted.
+
+    Stored as tab-separated lines of SPUID, target_db, accession and
+    fingerprint.
+
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.entries = dict()
+        if exists(fname):
+            with open(fname) as f:
+                for line in f:
+                    spuid, target_db, acc, fp = line.rstrip("\n").split("\t")
+                    self.entries[spuid] = (target_db, acc, fp or None)
+
+
+    def known(self):
+        """:returns: Dictionary; SPUID to fingerprint (or None)"""
+        return dict( (spuid, fp) for spuid, (_, _, fp)
+                     in self.entries.iteritems() )
+
+
+    def record(self, spuid, target_db, accession, fingerprint=None):
+        if not fingerprint and spuid in self.entries:
+            fingerprint = self.entries[spuid][2]
+        self.entries[spuid] = (target_db, accession, fingerprint)
+
+
+    def baseline(self, spuid, target_db, fingerprint, accession=None):
+        """Record the fingerprint of an object NCBI accepted before it
+        was in the ledger, as it is now, so later changes to it are
+        noticed. Fingerprints already on record are kept."""
+        if spuid in self.entries and self.entries[spuid][2]:
+            return
+        prev = self.entries.get(spuid, (None, None, None))
+        self.entries[spuid] = (prev[0] or target_db,
+                               prev[1] or accession or "", fingerprint)
+
+
+    def update_from_report(self, report_fname, fingerprints_fname):
+        """Record every object accepted in ``report_fname``, with the
+        fingerprints written when the submission was serialized.
+
+        :returns: Integer; the number of objects recorded
+
+        """
+        fps = read_fingerprints(fingerprints_fname)
+        n = 0
+        for spuid, target_db, acc in accepted(report_fname):
+            self.record(spuid, target_db, acc, fps.get(spuid))
+            n += 1
+        return n
+
+
+    def update_from_reports(self, report_fnames, fingerprints_fname):
+        """Record every object whose latest status across
+        ``report_fnames``, oldest first, is accepted.
+
+        :returns: Integer; the number of objects recorded
+
+        """
+        fps = read_fingerprints(fingerprints_fname)
+        n = 0
+        for o in merge_reports(report_fnames):
+            if o.accession and _is_ok(o.status):
+                self.record(o.spuid, o.target_db, o.accession,
+                            fps.get(o.spuid))
+                n += 1
+        return n
+
+
+    def save(self):
+        tmp = "%s.%i.%i.tmp"%(self.fname, os.getpid(),
+                              threading.current_thread().ident)
+        with open(tmp, 'w') as f:
+            for spuid, (target_db, acc, fp) in sorted(self.entries.iteritems()):
+                print >> f, "\t".join((spuid, target_db or "", acc, fp or ""))
+        os.rename(tmp, self.fname)
+
+
+@contextmanager
+def locked(fname):
+    """Load the ledger in ``fname`` for changes, and save it once the
+    block is done. Other processes doing the same, like the tasks of
+    other shards, wait until then, so none of them lose what another
+    recorded."""
+    with open(fname+".lock", 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            l = Ledger(fname)
+            yield l
+            l.save()
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
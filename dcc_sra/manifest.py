@@ -0,0 +1,107 @@
+import sqlite3
+import threading
+from os.path import basename
+from os.path import exists
+
+FNAME = "manifest.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS members (
+    tarball TEXT,
+    pos     INTEGER,
+    name    TEXT,
+    size    INTEGER,
+    md5     TEXT,
+    sha256  TEXT,
+    PRIMARY KEY (tarball, pos)
+);
+"""
+
+
+def read_complete(fname):
+    """:returns: List of tuples; name, size, md5 and sha256 of each
+    member listed in a ``.complete`` file"""
+    ret = list()
+    with open(fname) as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if not fields[0]:
+                continue
+            fields += [""]*(4-len(fields))
+            ret.append((fields[0], int(fields[1]), fields[2] or None,
+                        fields[3] or None))
+    return ret
+
+
+class ManifestStore(object):
+    """The members of every transferred tarball in one database, in
+    place of reading a ``.complete`` file per tarball. Tarballs are
+    keyed by the name of their ``.complete`` file.
+
+    Everything is read with a single query the first time it's asked
+    for, so checking thousands of tarballs costs dictionary lookups.
+
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(fname, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self._cache = None
+
+
+    def _load(self):
+        if self._cache is None:
+            cache = dict()
+            rows = self.db.execute("SELECT tarball, name, size, md5, sha256"
+                                   " FROM members ORDER BY tarball, pos")
+            for row in rows:
+                cache.setdefault(row[0], []).append(tuple(row[1:]))
+            self._cache = cache
+        return self._cache
+
+
+    def members(self, complete_fname):
+        """:returns: List of tuples; name, size, md5 and sha256 of each
+        member of the tarball, or None if it isn't in the store"""
+        with self.lock:
+            return self._load().get(basename(complete_fname))
+
+
+    def put(self, complete_fname, members):
+        """Replace the members of a tarball, in one transaction
+
+        :param members: Iterable of tuples; name, size, md5 and sha256
+
+        """
+        key, members = basename(complete_fname), map(tuple, members)
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM members WHERE tarball = ?", (key,))
+            self.db.executemany(
+                "INSERT INTO members (tarball, pos, name, size, md5, sha256)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [ (key, i)+m for i, m in enumerate(members) ])
+            if self._cache is not None:
+                self._cache[key] = members
+
+
+    def import_complete(self, complete_fnames):
+        """Add the ``.complete`` files that exist and aren't in the
+        store yet
+
+        :returns: Integer; the number of files imported
+
+        """
+        n = 0
+        for fname in complete_fnames:
+            if not exists(fname) or self.members(fname) is not None:
+                continue
+            self.put(fname, read_complete(fname))
+            n += 1
+        return n
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -1,20 +1,32 @@
 import os
+import sys
+import copy
 import getpass
+from collections import namedtuple
 
 import cutlass
 import anadama.pipelines
 
 from . import workflows
+from . import traverse
+from . import snapshot
+from . import bulk
+from . import project
+from . import shard
+from . import ledger
+from . import accessions
+from . import manifest
+from . import workqueue
+from .staging import StagingArea
+from .cache import TarballCache
+from .policy import Policy
 from . import SubmitRecord
 from . import PrepSeq
 
 def get_prepseqs(preps):
     def _ps():
         for prep in preps:
-            meth = getattr(prep, "child_seq_sets", None)
-            if not meth:
-                meth = getattr(prep, "raw_seq_sets", None)
-            for seq in meth():
+            for seq in traverse.seq_sets(prep):
                 yield prep, seq
     return map(PrepSeq._make, _ps())
 
@@ -33,11 +45,69 @@ def filter_unsequenced(records_wgs, records_16s):
     return [SubmitRecord(s, []) for s in unsequenced], recs_16s, recs_wgs
         
 
+def load_study(session, study_id, products_dir, workers=8, fanout=None,
+               loader="traverse", batch_size=100,
+               snapshot_mode="refresh", snapshot_max_age=0):
+    """Load a study and its ``SubmitRecord``s, from OSDF or from the
+    snapshot kept in ``products_dir``.
+
+    :keyword loader: String; ``traverse`` to ask OSDF for the children
+    of each node in turn, or ``bulk`` to load each node type with a
+    few linkage queries of ``batch_size`` parents each.
+
+    :keyword snapshot_mode: String; ``refresh`` to read from OSDF and
+    update the snapshot (unless it is younger than
+    ``snapshot_max_age`` seconds), ``offline`` to plan from the
+    snapshot alone, or None to neither read nor write a snapshot.
+
+    """
+    snap = None
+    if snapshot_mode:
+        snap = snapshot.Snapshot(os.path.join(products_dir, snapshot.FNAME))
+        if snapshot_mode == "offline" or snap.fresh(study_id,
+                                                    snapshot_max_age):
+            # the nodes only read their children from the snapshot
+            # during the traversal
+            try:
+                study = snap.study(study_id)
+                traversal = traverse.StudyTraversal(1)
+                records_16s, records_wgs = traversal.run(study)
+            finally:
+                snap.close()
+            return study, records_16s, records_wgs
+
+    if loader == "bulk":
+        bulk_loader = bulk.BulkLoader(session.get_osdf(),
+                                      batch_size=batch_size, workers=workers)
+        study = bulk_loader.load(study_id)
+        bulk_loader.report()
+        traversal = traverse.StudyTraversal(1)
+    else:
+        study = cutlass.Study.load(study_id)
+        traversal = traverse.StudyTraversal(workers, fanout)
+    records_16s, records_wgs = traversal.run(study)
+    traversal.report()
+    if snap is not None:
+        written = snap.save(study, traversal.links)
+        print >> sys.stderr, "OSDF snapshot: %i changed nodes saved to %s"%(
+            written, snap.fname)
+        snap.close()
+    return study, records_16s, records_wgs
+
+
+# the options that differ between the studies of a batch
+StudyOptions = namedtuple("StudyOptions", "serialize upload products_dir label")
+
+
 def _remote_path(options):
     study_id = options['serialize']['study_id']
     return "/submit/Production/{}/".format(study_id)
 
 
+def _shard_path(remote_path, shard):
+    return remote_path.rstrip("/")+"_"+shard+"/"
+
+
 class DCCSRAPipeline(anadama.pipelines.Pipeline):
     """Pipeline for submitting metadata from the iHMP DCC's OSDF instance
     to NCBI's SRA.
@@ -59,6 +129,18 @@ class DCCSRAPipeline(anadama.pipelines.Pipeline):
 
     6. Upload submission.xml and submit.ready file
 
+    If the ``transfer`` options name a ``queue_fname`` on shared
+    storage, step 2 and the uploads of step 5 are left to
+    :py:class:`DCCSRAWorkerPipeline` runs on other hosts, and this
+    pipeline waits for them before it goes on to step 3.
+
+    If the ``shard`` options set a maximum number of Actions or bytes
+    per submission, steps 2-6 are done separately for each shard of
+    the study, in ``shard_N`` subdirectories of ``products_dir``. NCBI
+    expects each submission in its own directory next to the others,
+    so shards are uploaded to ``remote_path`` with ``_shard_N`` added,
+    e.g. ``/submit/Production/<study_id>_shard_0/``.
+
     Workflows used:
 
     * :py:func:`dcc_sra.workflows.download_upload`
@@ -82,6 +164,8 @@ class DCCSRAPipeline(anadama.pipelines.Pipeline):
             "study_id": None,
             "release_date": None,
             "bioproject_id": None,
+            "workers": 1,
+            "incremental": False,
         },
         "upload": {
             "keyfile": "/home/rschwager/test_data/broad_metadata/dcc_sra/iHMP_SRA_key",
@@ -90,7 +174,46 @@ class DCCSRAPipeline(anadama.pipelines.Pipeline):
             "user": "asp-hmp2",
         },
         "report": {
-            "products_dir": "reports"
+            "products_dir": "reports",
+            "interval": 0.5,
+            "max_interval": 60,
+            "deadline": 20*60,
+            "until_final": False,
+        },
+        "osdf": {
+            "workers": 8,
+            "fanout": {},
+            "loader": "traverse",
+            "batch_size": 100,
+            "snapshot_mode": "refresh",
+            "snapshot_max_age": 0,
+        },
+        "shard": {
+            "max_actions": None,
+            "max_bytes": None,
+        },
+        "transfer": {
+            "pipelined": False,
+            "download_workers": 2,
+            "extract_workers": 1,
+            "upload_workers": 4,
+            "queue_size": 4,
+            "staging_budget": None,
+            "batch_uploads": False,
+            "retries": 3,
+            "backoff": 2,
+            "max_backoff": 300,
+            "breaker_threshold": 5,
+            "breaker_cooldown": 60,
+            "remote_index_ttl": 3600,
+            "manifest_db": False,
+            "cache_dir": None,
+            "cache_max_bytes": None,
+            "queue_fname": None,
+            "queue_lease": 600,
+            "queue_attempts": 3,
+            "queue_poll": 5,
+            "queue_timeout": 3600,
         }
     }
 
@@ -142,56 +265,101 @@ class DCCSRAPipeline(anadama.pipelines.Pipeline):
                 entered = default
             self.options['serialize']['dcc_user'] = entered
 
-        if not self.options['serialize'].get('study_id', None):
-            prompt = "Enter the study ID to submit: "
-            self.options['serialize']['study_id'] = raw_input(prompt)
+        self._ask_study()
 
         if not self.options['serialize'].get('dcc_pw', None):
             prompt = "Enter your DCC password: "
             self.options['serialize']['dcc_pw'] = getpass.getpass(prompt)
 
+        self.add_products(
+            cached_wgs_files = cached_wgs_files,
+            cached_16s_files = cached_16s_files
+        )
+
+
+    def _ask_study(self):
+        if not self.options['serialize'].get('study_id', None):
+            prompt = "Enter the study ID to submit: "
+            self.options['serialize']['study_id'] = raw_input(prompt)
+
         if not self.options['upload'].get('remote_path', None):
             self.options['upload']['remote_path'] = _remote_path(self.options)
 
         if not self.options['upload']['remote_path'].endswith('/'):
             self.options['upload']['remote_path'] += '/'
 
-        self.add_products(
-            cached_wgs_files = cached_wgs_files,
-            cached_16s_files = cached_16s_files
-        )
-
 
     def _configure(self):
         session = cutlass.iHMPSession(self.options['serialize']['dcc_user'],
                                       self.options['serialize']['dcc_pw'])
-        study = cutlass.Study.load(self.options['serialize']['study_id'])
-
-        records_wgs = list()
-        records_16s = list()
-        for subject in study.subjects():
-            for visit in subject.visits():
-                for sample in visit.samples():
-                    prepseqs_16s = get_prepseqs(sample.sixteenSDnaPreps())
-                    records_16s.append(SubmitRecord(sample, prepseqs_16s))
-                    prepseqs_wgs = get_prepseqs(sample.wgsDnaPreps())
-                    records_wgs.append(SubmitRecord(sample, prepseqs_wgs))
-                    
+        opts = StudyOptions(self.options['serialize'], self.options['upload'],
+                            self.products_dir, None)
+        for t in self._study_tasks(session, opts):
+            yield t
+
+
+    def _study_tasks(self, session, opts, shared=None):
+        study, records_16s, records_wgs = load_study(
+            session, opts.serialize['study_id'], opts.products_dir,
+            **self.options['osdf'])
+        study = project.study(study)
+        records_16s, records_wgs = project.records(records_16s, records_wgs)
+
         unsequenced, recs_16s, recs_wgs = filter_unsequenced(records_wgs,
                                                              records_16s)
 
-        submission_file = os.path.join(self.products_dir, "submission.xml")
-        ready_file = os.path.join(self.products_dir, "submit.ready")
+        shards = shard.plan(recs_16s, recs_wgs, **self.options['shard'])
+        if len(shards) == 1:
+            for t in self._submission_tasks(session, opts, study, recs_16s,
+                                            recs_wgs, unsequenced,
+                                            shared=shared):
+                yield t
+            return
+
+        if not opts.serialize['bioproject_id']:
+            raise ValueError("Splitting a study into several submissions"
+                             " needs an existing bioproject_id")
+        for i, (shard_16s, shard_wgs) in enumerate(shards):
+            name = shard.shard_name(i)
+            for t in self._submission_tasks(session, opts, study, shard_16s,
+                                            shard_wgs,
+                                            unsequenced if i == 0 else [],
+                                            shard=name, shared=shared):
+                yield t
+
+
+    def _submission_tasks(self, session, opts, study, recs_16s, recs_wgs,
+                          unsequenced, shard=None, shared=None):
+        products_dir = opts.products_dir
+        upload_opts = dict(opts.upload)
+        if shard:
+            products_dir = os.path.join(opts.products_dir, shard)
+            upload_opts['remote_path'] = _shard_path(opts.upload['remote_path'],
+                                                     shard)
+            if not os.path.isdir(products_dir):
+                os.mkdir(products_dir)
+        label = "/".join(filter(None, [opts.label, shard])) or None
+
+        accessions_fname = os.path.join(opts.products_dir, accessions.FNAME)
+        manifest_fname = None
+        if self.options['transfer']['manifest_db']:
+            manifest_fname = os.path.join(opts.products_dir, manifest.FNAME)
+        submission_file = os.path.join(products_dir, "submission.xml")
+        ready_file = os.path.join(products_dir, "submit.ready")
         six_fnames, wgs_fnames, tasks = workflows.download_upload(
             recs_16s, self.cached_16s_files, 
             recs_wgs, self.cached_wgs_files, 
-            dcc_user = self.options['serialize']['dcc_user'],
-            dcc_pw = self.options['serialize']['dcc_pw'],
-            ncbi_srv = self.options['upload']['remote_srv'],
-            ncbi_path = self.options['upload']['remote_path'],
-            ncbi_user = self.options['upload']['user'],
-            ncbi_keyfile = self.options['upload']['keyfile'],
-            products_dir = self.products_dir
+            dcc_user = opts.serialize['dcc_user'],
+            dcc_pw = opts.serialize['dcc_pw'],
+            ncbi_srv = upload_opts['remote_srv'],
+            ncbi_path = upload_opts['remote_path'],
+            ncbi_user = upload_opts['user'],
+            ncbi_keyfile = upload_opts['keyfile'],
+            products_dir = products_dir,
+            accessions_fname = accessions_fname,
+            manifest_fname = manifest_fname,
+            shared = shared,
+            **self.options['transfer']
             )
         for t in tasks:
             yield t
@@ -203,13 +371,163 @@ class DCCSRAPipeline(anadama.pipelines.Pipeline):
                                   unsequenced,
                                   submission_file,
                                   ready_file,
-                                  self.products_dir,
-                                  **self.options['serialize'])
+                                  opts.products_dir,
+                                  manifest_fname=manifest_fname,
+                                  **opts.serialize)
 
         yield workflows.kickoff(submission_file, ready_file,
                                 six_fnames+wgs_fnames,
-                                products_dir=self.products_dir,
-                                **self.options['upload'])
+                                products_dir=products_dir,
+                                shard=label,
+                                **upload_opts)
 
+        report_opts = self.options['report']
         yield workflows.report(session, ready_file+".complete",
-                               **self.options['upload'])
+                               fingerprints_fname=submission_file+".fingerprints",
+                               ledger_fname=os.path.join(opts.products_dir,
+                                                         ledger.FNAME),
+                               shard=label,
+                               interval=report_opts['interval'],
+                               max_interval=report_opts['max_interval'],
+                               deadline=report_opts['deadline'],
+                               until_final=report_opts['until_final'],
+                               osdf_workers=self.options['osdf']['workers'],
+                               tagged=project.tags(study, recs_16s, recs_wgs,
+                                                   unsequenced),
+                               accessions_fname=accessions_fname,
+                               **upload_opts)
+
+
+class DCCSRABatchPipeline(DCCSRAPipeline):
+    """Submit several studies in one run. Each study is submitted as
+    :py:class:`DCCSRAPipeline` would, in a subdirectory of
+    ``products_dir`` named for the study, but all of them use the one
+    OSDF session and the same SSH connections to NCBI.
+
+    The studies are listed in the ``batch`` options, as dictionaries of
+    ``serialize`` options (``study_id``, ``release_date``,
+    ``bioproject_id``...) that override the ones shared by the batch,
+    and an optional ``remote_path``, by default
+    ``/submit/Production/<study_id>/``.
+
+    With ``pipelined`` transfers, the sequence files of every study go
+    through a single scheduler, with a single staging budget, retry
+    policy and tarball cache, so a study with few files doesn't leave
+    workers idle. Every study's submission then waits for all of the
+    transfers.
+
+    """
+
+    name = "DCCSRABatch"
+
+    default_options = dict(copy.deepcopy(DCCSRAPipeline.default_options),
+                           batch={ "studies": [] })
+
+    def _ask_study(self):
+        if not self.options['batch']['studies']:
+            prompt = "Enter the study IDs to submit, separated by spaces: "
+            self.options['batch']['studies'] = [
+                {"study_id": s} for s in raw_input(prompt).split() ]
+
+
+    def _study_options(self, study_opts):
+        study_opts = dict(study_opts)
+        upload = dict(self.options['upload'])
+        upload['remote_path'] = study_opts.pop('remote_path', None)
+        serialize = dict(self.options['serialize'], **study_opts)
+        if not upload['remote_path']:
+            upload['remote_path'] = _remote_path({'serialize': serialize})
+        if not upload['remote_path'].endswith('/'):
+            upload['remote_path'] += '/'
+
+        products_dir = os.path.join(self.products_dir, serialize['study_id'])
+        if not os.path.isdir(products_dir):
+            os.mkdir(products_dir)
+        return StudyOptions(serialize, upload, products_dir,
+                            serialize['study_id'])
+
+
+    def _configure(self):
+        session = cutlass.iHMPSession(self.options['serialize']['dcc_user'],
+                                      self.options['serialize']['dcc_pw'])
+        shared = dict()
+        for study_opts in self.options['batch']['studies']:
+            opts = self._study_options(study_opts)
+            for t in self._study_tasks(session, opts, shared=shared):
+                yield t
+
+        transfer_opts = self.options['transfer']
+        for t in workflows.transfer_all(
+                shared,
+                download_workers=transfer_opts['download_workers'],
+                extract_workers=transfer_opts['extract_workers'],
+                upload_workers=transfer_opts['upload_workers'],
+                queue_size=transfer_opts['queue_size'],
+                queue_fname=transfer_opts['queue_fname'],
+                queue_lease=transfer_opts['queue_lease'],
+                queue_attempts=transfer_opts['queue_attempts'],
+                queue_poll=transfer_opts['queue_poll'],
+                queue_timeout=transfer_opts['queue_timeout']):
+            yield t
+
+
+class DCCSRAWorkerPipeline(DCCSRAPipeline):
+    """Transfer sequence files for a :py:class:`DCCSRAPipeline` running
+    elsewhere: claim the transfers it published to the work queue
+    named by the ``queue_fname`` of the ``transfer`` options, download
+    each tarball from the DCC into ``products_dir``, and upload its
+    contents to NCBI. Start as many as the hosts and network allow.
+
+    The ``worker`` options set how many transfers to run at once, an
+    NCBI key file to use in place of the coordinator's, and whether to
+    keep waiting for more work once the queue is empty.
+
+    """
+
+    name = "DCCSRAWorker"
+
+    default_options = dict(copy.deepcopy(DCCSRAPipeline.default_options),
+                           worker={ "threads": 1,
+                                    "keyfile": None,
+                                    "ssh_port": 22,
+                                    "wait": False })
+
+    def _ask_study(self):
+        if not self.options['transfer']['queue_fname']:
+            prompt = "Enter the path to the work queue: "
+            self.options['transfer']['queue_fname'] = raw_input(prompt)
+
+
+    def _configure(self):
+        transfer_opts = self.options['transfer']
+        worker_opts = self.options['worker']
+        queue = workqueue.WorkQueue(transfer_opts['queue_fname'],
+                                    transfer_opts['queue_lease'],
+                                    transfer_opts['queue_attempts'])
+        staging, cache = None, None
+        if transfer_opts['staging_budget'] is not None:
+            staging = StagingArea(transfer_opts['staging_budget'])
+        if transfer_opts['cache_dir']:
+            cache = TarballCache(transfer_opts['cache_dir'],
+                                 transfer_opts['cache_max_bytes'])
+        policy = Policy(transfer_opts['retries'], transfer_opts['backoff'],
+                        transfer_opts['max_backoff'],
+                        transfer_opts['breaker_threshold'],
+                        transfer_opts['breaker_cooldown'])
+        worker = workqueue.Worker(queue,
+                                  self.options['serialize']['dcc_user'],
+                                  self.options['serialize']['dcc_pw'],
+                                  self.products_dir,
+                                  keyfile=worker_opts['keyfile'],
+                                  staging=staging, cache=cache, policy=policy,
+                                  ssh_port=worker_opts['ssh_port'])
+        def _work():
+            worker.run(worker_opts['threads'], transfer_opts['queue_poll'],
+                       worker_opts['wait'])
+        yield {
+            "name": "transfer:worker: "+worker.owner,
+            "actions": [_work],
+            "file_dep": [],
+            "uptodate": [False],
+            "targets": [],
+        }
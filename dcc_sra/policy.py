@@ -0,0 +1,141 @@
+import sys
+import time
+import random
+import threading
+
+
+class CircuitBreaker(object):
+    """Stop everyone from calling an endpoint that keeps failing.
+
+    After ``threshold`` failures in a row the breaker opens, and
+    callers of :py:meth:`wait` block for ``cooldown`` seconds. Then a
+    single caller is let through to probe the endpoint; the others keep
+    waiting until the probe succeeds, which closes the breaker, or
+    fails, which opens it again. Failures of calls that started before
+    the breaker opened count toward the threshold, but don't end the
+    probe or put off the cooldown.
+
+    """
+
+    def __init__(self, name, threshold=5, cooldown=60):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.cond = threading.Condition()
+
+
+    def wait(self):
+        """Block while the breaker is open
+
+        :returns: Boolean; True if the caller is to probe the endpoint,
+        and should say so when it reports how it went
+
+        """
+        with self.cond:
+            while self.opened_at is not None:
+                left = self.opened_at + self.cooldown - time.time()
+                if left <= 0 and not self.probing:
+                    self.probing = True
+                    return True
+                # while another caller probes, wait to hear how it went
+                self.cond.wait(left if left > 0 else 1)
+            return False
+
+
+    def success(self):
+        with self.cond:
+            self.failures = 0
+            self.opened_at, self.probing = None, False
+            self.cond.notify_all()
+
+
+    def failure(self, probe=False):
+        """:keyword probe: Boolean; what :py:meth:`wait` returned to the
+        caller that failed"""
+        with self.cond:
+            self.failures += 1
+            if probe:
+                self.probing = False
+                self.opened_at = time.time()
+            elif (self.opened_at is None and self.threshold
+                  and self.failures >= self.threshold):
+                print >> sys.stderr, ("%s failed %i times in a row;"
+                                      " pausing it for %gs")%(
+                                          self.name, self.failures,
+                                          self.cooldown)
+                self.opened_at = time.time()
+            self.cond.notify_all()
+
+
+class Policy(object):
+    """Retry transfers with exponential backoff and full jitter, behind
+    a :py:class:`CircuitBreaker` per endpoint.
+
+    :keyword retries: Integer; attempts to make after the first one
+
+    :keyword backoff: Number; seconds to wait, at most, before the
+    first retry. The limit doubles with each retry up to
+    ``max_backoff``; the actual wait is picked at random below it.
+
+    :keyword breaker_threshold: Integer; failures in a row that pause
+    an endpoint. 0 never pauses.
+
+    :keyword breaker_cooldown: Number; seconds to pause an endpoint for
+
+    """
+
+    def __init__(self, retries=3, backoff=2, max_backoff=300,
+                 breaker_threshold=5, breaker_cooldown=60):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.breakers = dict()
+        self.lock = threading.Lock()
+
+
+    def breaker(self, endpoint):
+        with self.lock:
+            if endpoint not in self.breakers:
+                self.breakers[endpoint] = CircuitBreaker(
+                    endpoint, self.breaker_threshold, self.breaker_cooldown)
+            return self.breakers[endpoint]
+
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2**attempt))
+
+
+    def call(self, endpoint, what, func, *args, **kwargs):
+        """Call ``func`` until it returns something true, retrying if it
+        returns something false or raises.
+
+        :param what: String; what ``func`` does, for messages
+
+        :returns: Whatever ``func`` returned
+
+        """
+        breaker = self.breaker(endpoint)
+        for attempt in range(self.retries+1):
+            if attempt:
+                time.sleep(self.delay(attempt-1))
+            probe = breaker.wait()
+            err = None
+            try:
+                ret = func(*args, **kwargs)
+            except Exception as e:
+                ret, err = None, e
+            if ret:
+                breaker.success()
+                return ret
+            breaker.failure(probe)
+            print >> sys.stderr, "%s failed (attempt %i of %i)%s"%(
+                what, attempt+1, self.retries+1,
+                ": %s"%(err,) if err else "")
+        raise Exception("%s failed after %i attempts"%(what,
+                                                       self.retries+1))
@@ -0,0 +1,101 @@
+from collections import namedtuple
+
+from . import geo
+from . import SubmitRecord
+from . import PrepSeq
+
+StudyMeta = namedtuple("StudyMeta", "id name description accession")
+SampleMeta = namedtuple("SampleMeta", "id name mixs accession")
+PrepMeta = namedtuple("PrepMeta", "id subtype ncbi_taxon_id lib_selection "
+                      "lib_const_meth")
+SeqMeta = namedtuple("SeqMeta", "id seqtype seq_model urls size accession "
+                     "md5")
+
+# the only MIxS fields used by serialize._biosample
+MIXS_KEYS = ("biome", "collection_date", "feature", "material",
+             "geo_loc_name", "lat_lon", "rel_to_oxygen",
+             "samp_collect_device", "samp_mat_process", "samp_size")
+
+
+def prep_subtype(p):
+    return p._get_raw_doc()['meta']['subtype']
+
+
+def accession(node, target_db):
+    """Find the accession NCBI gave ``node`` in ``target_db``, as saved
+    in the node's tags by :py:func:`dcc_sra.update.handle_ok`"""
+    prefix = target_db+":"
+    for tag in getattr(node, "tags", None) or []:
+        if tag.startswith(prefix):
+            return tag[len(prefix):]
+    return None
+
+
+def study(st):
+    return StudyMeta(st.id, st.name, st.description,
+                     accession(st, "BioProject"))
+
+
+def sample(s):
+    mixs = dict((k, v) for k, v in s.mixs.iteritems() if k in MIXS_KEYS)
+    mixs['lat_lon'] = " ".join(geo.cardinal(mixs['lat_lon']))
+    return SampleMeta(s.id, s.name, tuple(sorted(mixs.iteritems())),
+                      accession(s, "BioSample"))
+
+
+def prep(p):
+    subtype = prep_subtype(p)
+    mims_or_mimarks = p.mimarks if subtype == "16s" else p.mims
+    return PrepMeta(p.id, subtype, p.ncbi_taxon_id, p.lib_selection,
+                    mims_or_mimarks['lib_const_meth'])
+
+
+def seq(s):
+    is_16s = s._get_raw_doc()['node_type'].startswith("16s")
+    checksums = getattr(s, "checksums", None) or {}
+    return SeqMeta(s.id, "16s" if is_16s else "wgs", s.seq_model,
+                   tuple(s.urls), s.size, accession(s, "SRA"),
+                   checksums.get("md5"))
+
+
+def records(*record_lists):
+    """Project lists of ``SubmitRecord``s. Nodes shared between
+    records, like a sample with both 16S and WGS preps, are projected
+    once and shared.
+
+    :returns: List of lists of ``SubmitRecord``s; one per argument
+
+    """
+    memo = dict()
+    def _p(func, node):
+        if node.id not in memo:
+            memo[node.id] = func(node)
+        return memo[node.id]
+
+    def _rec(r):
+        return SubmitRecord(
+            _p(sample, r.sample),
+            [ PrepSeq(_p(prep, p), _p(seq, s)) for p, s in r.prepseqs ])
+
+    return [ map(_rec, recs) for recs in record_lists ]
+
+
+def tags(st, *record_lists):
+    """Collect the accession tags the projected nodes had when they
+    were loaded, for :py:func:`dcc_sra.update.tag_nodes`
+
+    :returns: Dictionary; node ID to a set of ``target_db:accession``
+    tags
+
+    """
+    ret = dict()
+    def _add(node, target_db):
+        if node.accession:
+            ret.setdefault(node.id, set()).add(target_db+":"+node.accession)
+    _add(st, "BioProject")
+    for recs in record_lists:
+        for rec in recs:
+            _add(rec.sample, "BioSample")
+            for _, seq in rec.prepseqs:
+                _add(seq, "SRA")
+    return ret
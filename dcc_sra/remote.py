@@ -0,0 +1,133 @@
+import os
+import sys
+import time
+import fcntl
+import threading
+from os.path import exists
+from contextlib import contextmanager
+
+FNAME = "remote_index.txt"
+
+
+class RemoteIndex(object):
+    """Sizes of the files in the remote directory of an
+    :py:class:`dcc_sra.ssh.SSHConnection`, kept up to date as uploads
+    succeed instead of listed again for every check.
+
+    The index is listed from the server on first use, then every
+    ``ttl`` seconds or when :py:meth:`refresh` is called. It is saved
+    to ``fname``, so a later run can start from it without listing the
+    server at all, as long as it's younger than ``ttl``. Processes
+    saving to the same ``fname`` merge what they recorded with what's
+    there already, rather than overwrite it.
+
+    :keyword ttl: Number; seconds a listing stays good for. None
+    never lists again once there is a listing.
+
+    """
+
+    def __init__(self, conn, fname=None, ttl=3600):
+        self.conn = conn
+        self.fname = fname
+        self.ttl = ttl
+        self.sizes = dict()
+        self.recorded = dict()
+        self.listed_at = None
+        self.lock = threading.RLock()
+        if fname and exists(fname):
+            self._load()
+
+
+    def _read(self):
+        """:returns: Tuple; the listing time and sizes saved in
+        ``fname``, or None if there's none for this remote directory.
+        Lines that can't be parsed are left out."""
+        if not exists(self.fname):
+            return None
+        sizes = dict()
+        with open(self.fname) as f:
+            try:
+                remote_path, listed_at = f.readline().rstrip("\n").split("\t")
+                listed_at = float(listed_at)
+            except ValueError:
+                print >> sys.stderr, "Ignoring unreadable "+self.fname
+                return None
+            if remote_path != self.conn.remote_path:
+                return None
+            for line in f:
+                try:
+                    name, size = line.rstrip("\n").split("\t")
+                    sizes[name] = int(size)
+                except ValueError:
+                    continue
+        return listed_at, sizes
+
+
+    def _load(self):
+        saved = self._read()
+        if saved is not None:
+            self.listed_at, self.sizes = saved
+
+
+    @contextmanager
+    def _locked(self):
+        with open(self.fname+".lock", 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+    def stale(self):
+        if self.listed_at is None:
+            return True
+        return (self.ttl is not None
+                and time.time() - self.listed_at > self.ttl)
+
+
+    def refresh(self):
+        """List the remote directory again, in a single call"""
+        with self.lock:
+            self.sizes = self.conn.listing()
+            self.recorded = dict()
+            self.listed_at = time.time()
+            self.save()
+
+
+    def get(self, name):
+        """:returns: Integer; the size of ``name`` in the remote
+        directory, or None if it isn't there"""
+        with self.lock:
+            if self.stale():
+                self.refresh()
+            return self.sizes.get(name)
+
+
+    def record(self, name, size):
+        """Note that ``name`` was uploaded, ``size`` bytes long"""
+        with self.lock:
+            self.sizes[name] = size
+            self.recorded[name] = size
+
+
+    def save(self):
+        """Save the index, merged with what other processes saved. A
+        listing newer than the saved one replaces it. Otherwise the
+        saved listing is kept, along with what other processes
+        recorded on it, and the uploads recorded here since this
+        index's listing are added on top."""
+        if not self.fname or self.listed_at is None:
+            return
+        with self.lock, self._locked():
+            saved = self._read()
+            if saved is not None and saved[0] >= self.listed_at:
+                self.listed_at, self.sizes = saved
+                self.sizes.update(self.recorded)
+            tmp = "%s.%i.%i.tmp"%(self.fname, os.getpid(),
+                                  threading.current_thread().ident)
+            with open(tmp, 'w') as f:
+                print >> f, "%s\t%f"%(self.conn.remote_path, self.listed_at)
+                for name, size in sorted(self.sizes.iteritems()):
+                    print >> f, "%s\t%i"%(name, size)
+            os.rename(tmp, self.fname)
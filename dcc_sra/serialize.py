@@ -1,14 +1,15 @@
+import hashlib
+import functools
+import multiprocessing
 from os.path import basename
+from itertools import chain
+from cStringIO import StringIO
 import xml.etree.ElementTree as ET
 from xml.etree.ElementTree import SubElement as sub
+from xml.etree.ElementTree import _escape_attrib, _escape_cdata
 
 from dateutil.parser import parse as dateparse
 
-from . import geo
-
-
-def prep_subtype(p):
-    return p._get_raw_doc()['meta']['subtype']
 
 def eld(tagname, attrs={}, text=None, children=[]):
     ret = {"tagname": tagname}
@@ -30,28 +31,10 @@ def hier_sub(parent, tagname, attrs={}, text=None, children=[]):
     return ret
 
 
-def very_last(nested_list):
-    last = nested_list[-1]
-    while hasattr(last, "__iter__"):
-        last = last[-1]
-    return last
-
-
 def spuid(obj):
     return eld("SPUID", attrs={"spuid_namespace": "hmp2"}, text=obj.id)
 
 
-def flatten_list(l):
-    def _flat(ls):
-        for item in ls:
-            if hasattr(item, "__iter__"):
-                for subitem in _flat(item):
-                    yield subitem
-            else:
-                yield item
-    return list(_flat(l))
-
-
 # Thanks, http://stackoverflow.com/a/4590052
 def indent(elem, level=0):
     i = "\n" + level*"  "
@@ -71,12 +54,8 @@ def indent(elem, level=0):
 def reg_text(t):
     return u" ".join(t.split())
 
-def reg_sample(s):
-    s.mixs['lat_lon'] = " ".join(geo.cardinal(s.mixs['lat_lon']))
-    return s
 
-
-def _add_description(root, st, release_date=None):
+def _description(st, release_date=None):
     children = [ 
         eld("Comment", text="iHMP project "+st.name),
         eld("Organization", attrs={"role":"owner", "type":"institute"},
@@ -94,104 +73,95 @@ def _add_description(root, st, release_date=None):
     if release_date:
         d = dateparse(release_date).strftime("%Y-%m-%d")
         children.append( eld("Hold", attrs={"release_date": d}) )
-    hier_sub(root, "Description", children=children)
-    return root
+    return eld("Description", children=children)
 
 
-def _add_bioproject(root, st, bioproject_id=None):
-    if bioproject_id:
-        return root
-    ret = hier_sub(root, "Action", children=[
+def _bioproject(st):
+    pts_attrs = {"sample_scope":"eEnvironment"}
+    project = eld("Project", attrs={"schema_version":"2.0"}, children=[
+        eld("ProjectID", children=[spuid(st)]),
+        eld("Descriptor", children=[
+            eld("Title",    text="iHMP "+st.name),
+            eld("Description", text=reg_text(st.description)),
+            eld("Relevance", children=[ eld("Medical", text="Yes") ])
+        ]),
+        eld("ProjectType", children=[
+            eld("ProjectTypeSubmission", attrs=pts_attrs, children=[
+                eld("IntendedDataTypeSet", children=[
+                    eld("DataType", text="metagenome")
+                ])
+            ])
+        ])
+    ])
+    return eld("Action", children=[
         eld("AddData", attrs={"target_db":"BioProject"}, children=[
             eld("Data", attrs={"content_type":"xml"}, children=[
-                eld("XmlContent", children=[
-                    eld("Project", attrs={"schema_version":"2.0"})
-                ])
+                eld("XmlContent", children=[project])
             ]),
             eld("Identifier", children=[spuid(st)]),
         ])
     ])
-    prj = flatten_list(ret)[-3]
-    hier_sub(prj, "ProjectID", children=[spuid(st)])
-    hier_sub(prj, "Descriptor", children=[
-        eld("Title",    text="iHMP "+st.name),
-        eld("Description", text=reg_text(st.description)),
-        eld("Relevance", children=[ eld("Medical", text="Yes") ])
-    ])
-    pts_attrs = {"sample_scope":"eEnvironment"}
-    hier_sub(prj, "ProjectType", children=[
-        eld("ProjectTypeSubmission", attrs=pts_attrs, children=[
-            eld("IntendedDataTypeSet", children=[
-                eld("DataType", text="metagenome")
-            ])
-        ])
-    ])
-    return root
 
 
-def _add_biosample(root, st, sample, prep, release_date=None, 
-                   bioproject_id=None):
-    sample = reg_sample(sample)
-    ret = hier_sub(root, "Action", children=[
+def _biosample(st, sample, prep, bioproject_id=None):
+    if bioproject_id:
+        bioproject = eld("BioProject", 
+                         children=[eld("PrimaryId",
+                                       attrs={"name": "BioProject"}, 
+                                       text=bioproject_id)])
+    else:
+        bioproject = eld("BioProject", children=[spuid(st)])
+    kv = lambda k, v: eld("Attribute", attrs={"attribute_name": k}, text=v)
+    mixs = dict(sample.mixs)
+    get = lambda v: mixs.get(v, "missing").strip() or "missing"
+    biosample = eld("BioSample", attrs={"schema_version":"2.0"}, children=[
+        eld("SampleId", children=[spuid(sample)]),
+        eld("Descriptor", children=[
+            eld("Title", text=sample.name),
+        ]),
+        bioproject,
+        eld("Organism", attrs={"taxonomy_id": prep.ncbi_taxon_id},
+            children=[eld("OrganismName", text="Metagenome")]),
+        eld("Package", text="MIMS.me.human-associated.4.0"),
+        eld("Attributes", children=[
+            kv("env_biome", get("biome")),
+            kv("collection_date", get("collection_date")),
+            kv("env_feature", get("feature")),
+            kv("env_material", get("material")),
+            kv("geo_loc_name", get("geo_loc_name")),
+            kv("host", "Homo sapiens"),
+            kv("lat_lon", get("lat_lon"))
+        ]+[kv(k, get(k)) for k in ("rel_to_oxygen", "samp_collect_device",
+                                   "samp_mat_process", "samp_size")
+           if bool(mixs.get(k, None))]
+        )
+    ])
+    return eld("Action", children=[
         eld("AddData", attrs={"target_db":"BioSample"}, children=[
             eld("Data", attrs={"content_type":"xml"}, children=[
-                eld("XmlContent", children=[
-                    eld("BioSample", attrs={"schema_version":"2.0"})
-                ])
+                eld("XmlContent", children=[biosample])
             ]),
             eld("Identifier", children=[spuid(sample)])
         ])
     ])
-    bs_node = flatten_list(ret)[-3]
-    hier_sub(bs_node, "SampleId", children=[spuid(sample)])
-    hier_sub(bs_node, "Descriptor", children=[
-        eld("Title", text=sample.name),
-    ])
-    if bioproject_id:
-        hier_sub(bs_node, "BioProject", 
-                 children=[eld("PrimaryId", attrs={"name": "BioProject"}, 
-                               text=bioproject_id)])
-    else:
-        hier_sub(bs_node, "BioProject", children=[spuid(st)])
-    hier_sub(bs_node, "Organism",
-             attrs={"taxonomy_id": prep.ncbi_taxon_id},
-             children=[eld("OrganismName", text="Metagenome")])
-    hier_sub(bs_node, "Package", text="MIMS.me.human-associated.4.0")
-    kv = lambda k, v: eld("Attribute", attrs={"attribute_name": k}, text=v)
-    get = lambda v: sample.mixs.get(v, "missing").strip() or "missing"
-    hier_sub(bs_node, "Attributes", children=[
-        kv("env_biome", get("biome")),
-        kv("collection_date", get("collection_date")),
-        kv("env_feature", get("feature")),
-        kv("env_material", get("material")),
-        kv("geo_loc_name", get("geo_loc_name")),
-        kv("host", "Homo sapiens"),
-        kv("lat_lon", get("lat_lon"))
-    ]+[kv(k, get(k)) for k in ("rel_to_oxygen", "samp_collect_device",
-                               "samp_mat_process", "samp_size")
-       if bool(sample.mixs.get(k, None))]
-    )
-    return root
 
 
-def _add_sra(root, st, sample, prep, seq, files_sizes, 
-             bioproject_id=None):
+def _sra(st, sample, prep, seq, files_sizes, bioproject_id=None):
     kv = lambda k, v: eld("Attribute", attrs={"name": k}, text=v)
-    strategy = "AMPLICON" if prep_subtype(prep) == "16s" else "WGS"
-    mims_or_mimarks = prep.mimarks if prep_subtype(prep) == "16s" else prep.mims
+    strategy = "AMPLICON" if prep.subtype == "16s" else "WGS"
     file_nodes = [ 
-        eld("File", attrs={"file_path":basename(name)},
+        eld("File", attrs={"file_path":basename(fields[0])},
             children=[eld("DataType", text="sra-run-fastq")])
-        for name, _ in files_sizes
+        for fields in files_sizes
         ]
     if not file_nodes and seq.size == 0:
-        return root
+        return None
     if bioproject_id:
         st_spuid = eld("PrimaryId", attrs={"db": "BioProject"}, 
                        text=bioproject_id)
     else:
         st_spuid = spuid(st)
-    hier_sub(root, "Action", children=[
+    return eld("Action", children=[
         eld("AddFiles", attrs={"target_db": "SRA"}, children=file_nodes+[
             kv("instrument_model",seq.seq_model),
             kv("library_strategy",strategy),
@@ -199,7 +169,7 @@ def _add_sra(root, st, sample, prep, seq, files_sizes,
             kv("library_selection", prep.lib_selection.upper()),
             kv("library_layout", "FRAGMENT"),
             kv("library_construction_protocol",
-               reg_text(mims_or_mimarks['lib_const_meth'])),
+               reg_text(prep.lib_const_meth)),
             eld("AttributeRefId", attrs={"name": "BioProject"}, children=[
                 eld("RefId", children=[st_spuid])
             ]),
@@ -209,27 +179,190 @@ def _add_sra(root, st, sample, prep, seq, files_sizes,
             eld("Identifier", children=[spuid(seq)])
         ])
     ])
-    return root
 
 
-def to_xml(st, samples, tardict, release_date=None, bioproject_id=None):
-    root = ET.Element('Submission')
-    root = _add_description(root, st, release_date)
-    root = _add_bioproject(root, st, bioproject_id)
+def _record_jobs(st, samples, tardict, bioproject_id=None, known=None):
+    """Split ``samples`` into independent, picklable units of work: one
+    per record that has sequences, carrying the prep to describe a
+    BioSample with (if the sample hasn't been described by an earlier
+    record) and the files of each sequence set.
+
+    :keyword known: Dictionary; if given, maps the SPUIDs NCBI already
+    accepted to the fingerprints of the accepted Actions (None if
+    unknown). The part relevant to each record is passed along.
+
+    """
     sample_cache = set()
     for sample in samples:
         if not sample.prepseqs:
             continue
-        for prep, seq in sample.prepseqs:
-            if sample.sample.id not in sample_cache:
-                root = _add_biosample(root, st, sample.sample, prep, 
-                                      bioproject_id=bioproject_id)
-                sample_cache.add(sample.sample.id)
-            is_16s = seq._get_raw_doc()['node_type'].startswith("16s")    
-            seqtype = "16s" if is_16s else "wgs"
-            tarkey = (basename(seq.urls[0]), seqtype)
-            root = _add_sra(root, st, sample.sample, prep, seq, tardict[tarkey],
-                            bioproject_id)
+        bs_prep = None
+        if sample.sample.id not in sample_cache:
+            bs_prep = sample.prepseqs[0].prep
+            sample_cache.add(sample.sample.id)
+        seqs = [ (prep, seq, tardict[(basename(seq.urls[0]), seq.seqtype)])
+                 for prep, seq in sample.prepseqs ]
+        rec_known = None
+        if known is not None:
+            rec_known = _known(known, [sample.sample]+[s for _, s in
+                                                       sample.prepseqs])
+        yield st, sample.sample, bs_prep, seqs, bioproject_id, rec_known
+
+
+def _known(known, nodes):
+    ret = dict()
+    for node in nodes:
+        if node.id in known:
+            ret[node.id] = known[node.id]
+        elif node.accession:
+            ret[node.id] = None
+    return ret
 
+
+def _record_actions(job):
+    st, sample, bs_prep, seqs, bioproject_id, _ = job
+    if sample is None:
+        yield st.id, "BioProject", _bioproject(st)
+        return
+    if bs_prep is not None:
+        yield sample.id, "BioSample", _biosample(st, sample, bs_prep,
+                                                 bioproject_id)
+    for prep, seq, files_sizes in seqs:
+        action = _sra(st, sample, prep, seq, files_sizes, bioproject_id)
+        if action:
+            yield seq.id, "SRA", action
+
+
+def actions(st, samples, tardict, release_date=None, bioproject_id=None):
+    """Generate the children of the Submission element, in order, as
+    trees of :py:func:`eld` dicts."""
+    yield _description(st, release_date)
+    if not bioproject_id:
+        yield _bioproject(st)
+    for job in _record_jobs(st, samples, tardict, bioproject_id):
+        for _, _, action in _record_actions(job):
+            yield action
+
+
+def to_xml(st, samples, tardict, release_date=None, bioproject_id=None):
+    root = ET.Element('Submission')
+    for action in actions(st, samples, tardict, release_date,
+                          bioproject_id):
+        hier_sub(root, **action)
     return root
 
+
+def write_eld(write, el, level=0, encoding="us-ascii"):
+    """Write one :py:func:`eld` tree with ``write``, producing the
+    same bytes ``ElementTree.write`` does for the tree after
+    :py:func:`indent`."""
+    tag = el['tagname']
+    write("<"+tag)
+    for k, v in sorted(el.get('attrs', {}).items()):
+        write(' %s="%s"'%(k, _escape_attrib(v, encoding)))
+    text, children = el.get('text'), el.get('children', [])
+    if not text and not children:
+        write(" />")
+        return
+    write(">")
+    pad = "\n" + (level+1)*"  "
+    if children and (not text or not text.strip()):
+        text = pad
+    if text:
+        write(_escape_cdata(text, encoding))
+    for i, child in enumerate(children):
+        if i:
+            write(pad)
+        write_eld(write, child, level+1, encoding)
+    if children:
+        write("\n" + level*"  ")
+    write("</"+tag+">")
+
+
+def _fragment(job, encoding="us-ascii"):
+    """Serialize the Actions of one record.
+
+    :returns: Tuple; the XML text, a list of ``(spuid, target_db,
+    fingerprint)`` for every Action in it, and the same for Actions
+    left out because their SPUID is known without a fingerprint.
+    Actions whose SPUID is known and whose fingerprint hasn't changed
+    are left out.
+
+    """
+    known = job[-1]
+    buf, emitted, baseline = StringIO(), list(), list()
+    for obj_id, target_db, action in _record_actions(job):
+        piece = StringIO()
+        write_eld(piece.write, action, 1, encoding)
+        piece = piece.getvalue()
+        fp = hashlib.md5(piece).hexdigest()
+        if known is not None and obj_id in known \
+           and known[obj_id] in (None, fp):
+            if known[obj_id] is None:
+                baseline.append((obj_id, target_db, fp))
+            continue
+        buf.write("\n  ")
+        buf.write(piece)
+        emitted.append((obj_id, target_db, fp))
+    return buf.getvalue(), emitted, baseline
+
+
+def write_xml(f, st, samples, tardict, release_date=None, bioproject_id=None,
+              encoding="us-ascii", workers=1, chunksize=64, known=None,
+              baseline=None):
+    """Stream the submission for ``samples`` into the open file ``f``,
+    one Action at a time. The output is byte for byte what
+    :py:func:`to_xml` followed by :py:func:`indent` and
+    ``ElementTree.write`` gives, without holding the whole tree in
+    memory.
+
+    :keyword workers: Integer; if more than one, serialize the Actions
+    of each record in a pool of this many processes and write them in
+    the original order. ``samples`` must then hold picklable records,
+    such as those from :py:func:`dcc_sra.project.records`.
+
+    :keyword known: Dictionary; SPUIDs already accepted by NCBI mapped
+    to the fingerprint of the accepted Action, or None. Actions for
+    these are only written if their fingerprint changed.
+
+    :keyword baseline: List; if given, ``(spuid, target_db,
+    fingerprint)`` is added to it for each Action left out because its
+    SPUID is known without a fingerprint, so the fingerprint can be
+    saved for the next run to compare against.
+
+    :returns: List of ``(spuid, target_db, fingerprint)`` tuples; one
+    for each Action written
+
+    """
+    write = f.write
+    write("<Submission>")
+    write("\n  ")
+    write_eld(write, _description(st, release_date), 1, encoding)
+    bioproject = list()
+    if not bioproject_id:
+        st_known = None if known is None else _known(known, [st])
+        bioproject.append( (st, None, None, [], None, st_known) )
+    jobs = chain(bioproject, _record_jobs(st, samples, tardict,
+                                          bioproject_id, known))
+    emitted = list()
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            frag = functools.partial(_fragment, encoding=encoding)
+            for fragment, fps, base in pool.imap(frag, jobs, chunksize):
+                write(fragment)
+                emitted.extend(fps)
+                if baseline is not None:
+                    baseline.extend(base)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in jobs:
+            fragment, fps, base = _fragment(job, encoding)
+            write(fragment)
+            emitted.extend(fps)
+            if baseline is not None:
+                baseline.extend(base)
+    write("\n</Submission>\n")
+    return emitted
@@ -0,0 +1,50 @@
+from collections import OrderedDict
+
+
+def _groups(recs_16s, recs_wgs):
+    groups = OrderedDict()
+    for i, recs in enumerate((recs_16s, recs_wgs)):
+        for rec in recs:
+            groups.setdefault(rec.sample.id, ([], []))[i].append(rec)
+    return groups.values()
+
+
+def _weight(group):
+    recs = group[0] + group[1]
+    n_actions = 1 + sum(len(rec.prepseqs) for rec in recs)
+    n_bytes = sum(seq.size for rec in recs for _, seq in rec.prepseqs)
+    return n_actions, n_bytes
+
+
+def plan(recs_16s, recs_wgs, max_actions=None, max_bytes=None):
+    """Split records into shards that each make one submission.
+
+    All records of a sample go in the same shard, so a BioSample
+    Action always goes with the SRA Actions that refer to it. A shard
+    is closed once adding the next sample would take it over
+    ``max_actions`` Actions or ``max_bytes`` bytes of sequence files; a
+    single sample over either limit gets a shard of its own.
+
+    :returns: List of tuples; the 16S and the WGS records of each
+    shard, in their original order
+
+    """
+    shards, cur, cur_actions, cur_bytes = list(), ([], []), 0, 0
+    for group in _groups(recs_16s, recs_wgs):
+        n_actions, n_bytes = _weight(group)
+        full = ((max_actions and cur_actions+n_actions > max_actions)
+                or (max_bytes and cur_bytes+n_bytes > max_bytes))
+        if full and (cur[0] or cur[1]):
+            shards.append(cur)
+            cur, cur_actions, cur_bytes = ([], []), 0, 0
+        cur[0].extend(group[0])
+        cur[1].extend(group[1])
+        cur_actions += n_actions
+        cur_bytes += n_bytes
+    if cur[0] or cur[1] or not shards:
+        shards.append(cur)
+    return shards
+
+
+def shard_name(i):
+    return "shard_%i"%(i)
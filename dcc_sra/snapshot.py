@@ -0,0 +1,174 @@
+import json
+import time
+import sqlite3
+from itertools import chain
+
+FNAME = "osdf_snapshot.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    id        TEXT PRIMARY KEY,
+    node_type TEXT,
+    ver       INTEGER,
+    doc       TEXT
+);
+CREATE TABLE IF NOT EXISTS links (
+    parent TEXT,
+    rel    TEXT,
+    pos    INTEGER,
+    child  TEXT,
+    PRIMARY KEY (parent, rel, pos)
+);
+CREATE TABLE IF NOT EXISTS studies (
+    id       TEXT PRIMARY KEY,
+    saved_at REAL
+);
+"""
+
+
+class DocNode(object):
+    """Stand-in for a cutlass object, built from an OSDF document.
+
+    Attributes are looked up in the document's ``meta`` section, the
+    same names cutlass uses, and children are resolved through
+    ``graph``, which must provide a ``children(node_id, rel)`` method.
+
+    """
+
+    def __init__(self, doc, graph):
+        self._doc = doc
+        self._graph = graph
+
+    @property
+    def id(self):
+        return self._doc['id']
+
+    def __getattr__(self, name):
+        meta = self.__dict__['_doc']['meta']
+        if name in meta:
+            return meta[name]
+        raise AttributeError(name)
+
+    def __repr__(self):
+        return "<DocNode %s %s>"%(self._doc['node_type'], self.id)
+
+    def _get_raw_doc(self):
+        return self._doc
+
+    def _children(self, rel):
+        return iter(self._graph.children(self.id, rel))
+
+    def subjects(self):
+        return self._children("subjects")
+
+    def visits(self):
+        return self._children("visits")
+
+    def samples(self):
+        return self._children("samples")
+
+    def sixteenSDnaPreps(self):
+        return self._children("preps_16s")
+
+    def wgsDnaPreps(self):
+        return self._children("preps_wgs")
+
+    def child_seq_sets(self):
+        return self._children("seqs")
+
+
+class Snapshot(object):
+    """SQLite copy of the OSDF documents for a study, its subjects,
+    visits, samples, preps and sequence sets, along with the links
+    between them.
+
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.conn = sqlite3.connect(fname)
+        self.conn.executescript(SCHEMA)
+        self._nodes = dict()
+
+
+    def node(self, node_id):
+        if node_id not in self._nodes:
+            row = self.conn.execute("SELECT doc FROM nodes WHERE id = ?",
+                                    (node_id,)).fetchone()
+            if row is None:
+                raise KeyError(node_id)
+            self._nodes[node_id] = DocNode(json.loads(row[0]), self)
+        return self._nodes[node_id]
+
+
+    def children(self, parent_id, rel):
+        rows = self.conn.execute(
+            "SELECT child FROM links WHERE parent = ? AND rel = ? "
+            "ORDER BY pos", (parent_id, rel))
+        return [ self.node(child_id) for (child_id,) in rows ]
+
+
+    def saved_at(self, study_id):
+        row = self.conn.execute("SELECT saved_at FROM studies WHERE id = ?",
+                                (study_id,)).fetchone()
+        return row[0] if row else None
+
+
+    def fresh(self, study_id, max_age):
+        """True if ``study_id`` was saved less than ``max_age`` seconds
+        ago."""
+        saved_at = self.saved_at(study_id)
+        if saved_at is None or not max_age:
+            return False
+        return time.time() - saved_at < max_age
+
+
+    def study(self, study_id):
+        if self.saved_at(study_id) is None:
+            raise KeyError("No snapshot of study %s in %s"%(study_id,
+                                                           self.fname))
+        return self.node(study_id)
+
+
+    def save(self, study, links):
+        """Store ``study`` and the ``(rel, parent, children)`` links
+        recorded by a :py:class:`dcc_sra.traverse.StudyTraversal`.
+
+        Only documents whose ``ver`` differs from the stored copy are
+        written.
+
+        :returns: Integer; the number of documents written.
+
+        """
+        known = dict(self.conn.execute("SELECT id, ver FROM nodes"))
+        written, seen = 0, set()
+        with self.conn:
+            nodes = chain([study], *(children for _, _, children in links))
+            for node in nodes:
+                doc = node._get_raw_doc()
+                if doc['id'] in seen:
+                    continue
+                seen.add(doc['id'])
+                if doc['id'] in known and known[doc['id']] == doc.get('ver'):
+                    continue
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?)",
+                    (doc['id'], doc['node_type'], doc.get('ver'),
+                     json.dumps(doc)))
+                self._nodes.pop(doc['id'], None)
+                written += 1
+            for rel, parent, children in links:
+                self.conn.execute(
+                    "DELETE FROM links WHERE parent = ? AND rel = ?",
+                    (parent.id, rel))
+                self.conn.executemany(
+                    "INSERT INTO links VALUES (?, ?, ?, ?)",
+                    [ (parent.id, rel, i, child.id)
+                      for i, child in enumerate(children) ])
+            self.conn.execute("INSERT OR REPLACE INTO studies VALUES (?, ?)",
+                              (study.id, time.time()))
+        return written
+
+
+    def close(self):
+        self.conn.close()
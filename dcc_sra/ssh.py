@@ -1,100 +1,184 @@
 import os
-import re
-import time
-import pipes
+import stat
+import errno
 import socket
-import string
-import operator
+import threading
+import posixpath
 from os.path import join, basename
 
 import paramiko
 
 
-last = operator.itemgetter(-1)
+class Session(object):
+    """An SSH transport and SFTP client, opened on first use and opened
+    again if the connection drops. Get one through :py:func:`session`
+    to share it with everything else talking to the same server.
+
+    :keyword keepalive: Integer; seconds between keepalive packets
+
+    """
+
+    def __init__(self, user, host, keyfile, port=22, keepalive=30):
+        self.user = user
+        self.host = host
+        self.keyfile = keyfile
+        self.port = port
+        self.keepalive = keepalive
+        self.key = None
+        self.transport = None
+        self.sftp = None
+        self.lock = threading.Lock()
+
+
+    def _connect(self):
+        if self.key is None:
+            self.key = paramiko.RSAKey.from_private_key_file(self.keyfile)
+        sock = socket.create_connection((self.host, self.port))
+        transport = paramiko.Transport(sock)
+        transport.start_client()
+        transport.auth_publickey(self.user, self.key)
+        transport.set_keepalive(self.keepalive)
+        self.sftp = paramiko.SFTPClient.from_transport(transport)
+        self.transport = transport
+
+
+    def _close(self):
+        if self.transport is not None:
+            self.transport.close()
+        self.transport = self.sftp = None
+
+
+    def client(self):
+        """:returns: The session's ``paramiko.SFTPClient``, connecting
+        first if needed"""
+        with self.lock:
+            if self.transport is None or not self.transport.is_active():
+                self._close()
+                self._connect()
+            return self.sftp
+
+
+    def call(self, func):
+        """Call ``func`` with the SFTP client, connecting again and
+        retrying once if the connection was lost"""
+        sftp = self.client()
+        try:
+            return func(sftp)
+        except (socket.error, EOFError, paramiko.SSHException):
+            with self.lock:
+                # another thread may have reconnected already
+                if self.sftp is sftp:
+                    self._close()
+            return func(self.client())
+
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+
+_sessions = dict()
+_sessions_lock = threading.Lock()
+
+def session(user, host, keyfile, port=22):
+    """:returns: The process-wide :py:class:`Session` for ``user`` on
+    ``host`` with ``keyfile``"""
+    key = (user, host, keyfile, port)
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = Session(user, host, keyfile, port)
+        return _sessions[key]
+
 
 class SSHConnection(object):
-    def __init__(self, user, host, keyfile, remote_path):
-        self.remote_path = remote_path
-        self.key = paramiko.RSAKey.from_private_key_file(keyfile)
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((host, 22))
-        self.transport = paramiko.Transport(self.sock)
-        self.transport.start_client()
-        self.transport.auth_publickey(user, self.key)
-        self.chan = self.transport.open_session()
-        self.chan.get_pty()
-        self.chan.invoke_shell()
-        self._recvall()
-        self._path_check()
-        self.file_cache = self._build_file_cache()
-
-    def _path_check(self):
-        self.remote_path = self.remote_path.rstrip('/')
-        head, tail = os.path.split(self.remote_path)
-        ret = self.execute("ls -l "+head)
-        fields = map(string.split, ret.strip().split('\r\n')[2:-1])
-        names = dict(  zip(map(last, fields), fields) )
-        if tail not in names:
-            self.execute("mkdir --mode=0775 "+self.remote_path)
-            return
-        if tail in names and not names[tail][0].startswith("d"):
-            self.execute("rm "+self.remote_path)
-            self.execute("mkdir --mode=0775 "+self.remote_path)
+    """Look at and manage files in ``remote_path`` over SFTP, using the
+    shared :py:class:`Session` for the server. Nothing is sent until
+    the first call that needs the server.
+
+    ``remote_path`` is created if it doesn't exist, and
+    ``file_cache`` maps the full path of each entry in it to its size.
+
+    """
+
+    def __init__(self, user, host, keyfile, remote_path, port=22):
+        self.remote_path = remote_path.rstrip('/')
+        self.session = session(user, host, keyfile, port)
+        self.checked = False
+        self._file_cache = None
+
+    @property
+    def file_cache(self):
+        if self._file_cache is None:
+            self._file_cache = self._build_file_cache()
+        return self._file_cache
+
+    def _call(self, func):
+        if not self.checked:
+            self.session.call(self._path_check)
+            self.checked = True
+        return self.session.call(func)
+
+    def _stat(self, sftp, path):
+        try:
+            return sftp.stat(path)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def _makedirs(self, sftp, path):
+        if not path or path == "/" or self._stat(sftp, path) is not None:
             return
+        self._makedirs(sftp, posixpath.dirname(path))
+        sftp.mkdir(path, mode=0775)
+
+    def _path_check(self, sftp):
+        attrs = self._stat(sftp, self.remote_path)
+        if attrs is not None and not stat.S_ISDIR(attrs.st_mode):
+            sftp.remove(self.remote_path)
+            attrs = None
+        if attrs is None:
+            self._makedirs(sftp, self.remote_path)
+
+
+    def listing(self):
+        """:returns: Dictionary; name to size of each entry in
+        ``remote_path``"""
+        attrs = self._call(lambda sftp: sftp.listdir_attr(self.remote_path))
+        return dict( (a.filename, a.st_size) for a in attrs )
 
 
     def _build_file_cache(self):
-        cache = dict()
-        output = self.execute("ls -l "+self.remote_path).strip()
-        for line in output.split('\r\n')[2:-1]:
-            fields = line.split(None, 8)
-            name = re.sub(r'(.*)\s+->.*', r'\1', fields[-1])
-            name = os.path.join(self.remote_path, name)
-            try:
-                size = int(fields[4])
-            except ValueError:
-                continue
-            cache[name] = size
-        return cache
-            
-
-    def _wait(self, tries=5):
-        for i in range(tries):
-            time.sleep(0.125)
-            if self.chan.recv_ready():
-                return True
-        return False
-
-        
-    def _recvall(self):
-        ret = str()
-        while True:
-            if self.chan.recv_ready():
-                ret += self.chan.recv(1024)
-            else:
-                if not self._wait():
-                    break
-        return ret
+        return dict( (os.path.join(self.remote_path, name), size)
+                     for name, size in self.listing().iteritems() )
 
 
     def execute(self, cmd, verbose=False):
-        if not cmd.endswith("\n"):
-            cmd += "\n"
+        """Run ``cmd`` on the server in a channel of its own
+
+        :returns: String; the command's stdout and stderr
+
+        """
         if verbose:
             print "sending `%s'"%(cmd)
-        self.chan.send(cmd)
-        return self._recvall()
+        def _open(sftp):
+            return sftp.get_channel().get_transport().open_session()
+        chan = self._call(_open)
+        try:
+            chan.set_combine_stderr(True)
+            chan.exec_command(cmd)
+            ret = str()
+            for chunk in iter(lambda: chan.recv(32768), ""):
+                ret += chunk
+            return ret
+        finally:
+            chan.close()
 
 
     def fsize(self, fname):
-        quoted = pipes.quote(join(self.remote_path, fname))
-        output = self.execute("ls -l "+quoted).split("\n")[1].strip()
-        try:
-            return int(output.split(None, 8)[4])
-        except ValueError:
-            return None
-        except IndexError:
-            raise OSError(output)
+        path = join(self.remote_path, fname)
+        attrs = self._call(lambda sftp: self._stat(sftp, path))
+        return None if attrs is None else attrs.st_size
 
 
     def uptodate(self, task, values):
@@ -106,5 +190,10 @@ class SSHConnection(object):
                 return False
             return self.file_cache[remote_fname] == os.stat(fname).st_size
 
+    def get(self, fname, local_path):
+        """Download ``fname`` from ``remote_path`` to ``local_path``"""
+        path = join(self.remote_path, fname)
+        self._call(lambda sftp: sftp.get(path, local_path))
+
     def files(self):
-        return self.execute("ls "+self.remote_path).strip().split('\r\n')[1:-1]
+        return self._call(lambda sftp: sftp.listdir(self.remote_path))
@@ -0,0 +1,135 @@
+import os
+import sys
+import time
+import threading
+
+
+class StagingArea(object):
+    """Byte accounting for the local disk used by transfers.
+
+    Downloads ask for room with :py:meth:`reserve`, which blocks while
+    the bytes in use plus the request would go over ``budget``. They
+    ask for the tarball and the :py:meth:`estimate` of what it will
+    extract to, so tarballs waiting to be extracted can't crowd out the
+    room to extract them. Extractions book a fresh estimate with
+    :py:meth:`reserve_extract` before they write anything, and settle
+    the difference from the sizes they wrote once they're done, so the
+    archive is only read once. Files are handed back with
+    :py:meth:`remove` as soon as they're no longer needed. A request
+    is always let through when nothing else is staged, so a single
+    tarball larger than the budget can't wait forever.
+
+    :keyword budget: Integer; bytes of disk to allow. 0 or None means
+    no limit; usage and waits are still tracked.
+
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.usage = 0
+        self.peak = 0
+        self.draining = 0
+        self.extract_waiting = 0
+        self.tarball_bytes = self.extracted_bytes = 0
+        self.waits = list()
+        self.cond = threading.Condition()
+
+
+    def _add(self, nbytes):
+        self.usage += nbytes
+        self.peak = max(self.peak, self.usage)
+
+
+    def reserve(self, nbytes):
+        start = time.time()
+        with self.cond:
+            # extractions waiting for room go first
+            while (self.budget and self.usage
+                   and (self.extract_waiting
+                        or self.usage + nbytes > self.budget)):
+                self.cond.wait(1)
+            self._add(nbytes)
+        self.waits.append(time.time() - start)
+
+
+    def add(self, nbytes):
+        with self.cond:
+            self._add(nbytes)
+
+
+    def estimate(self, tarball_size):
+        """:returns: Integer; the bytes a tarball is expected to extract
+        to, going by the tarballs extracted so far"""
+        with self.cond:
+            if not self.tarball_bytes:
+                return tarball_size
+            return int(tarball_size * float(self.extracted_bytes)
+                       / self.tarball_bytes)
+
+
+    def learn(self, tarball_size, extracted):
+        with self.cond:
+            self.tarball_bytes += tarball_size
+            self.extracted_bytes += extracted
+
+
+    def reserve_extract(self, held, nbytes, wait=True):
+        """Make room for ``nbytes`` more than a job already holds, about
+        to be extracted from its tarball. ``nbytes`` is negative if the
+        job booked more than it needs, and the rest is handed back.
+
+        Waits while that would go over the budget and other jobs hold
+        extracted files, which their uploads are sure to hand back.
+        Jobs still waiting to extract hand nothing back, so they're
+        never waited for, or extractions could wait on each other
+        forever. From here on all of the job's bytes count as draining.
+
+        :keyword wait: Boolean; if False, count bytes already on disk
+        without waiting
+
+        """
+        start = time.time()
+        with self.cond:
+            self.extract_waiting += 1
+            try:
+                while (wait and self.budget and self.draining
+                       and self.usage + nbytes > self.budget):
+                    self.cond.wait(1)
+            finally:
+                self.extract_waiting -= 1
+            self._add(nbytes)
+            self.draining += held + nbytes
+            self.cond.notify_all()
+        if wait:
+            self.waits.append(time.time() - start)
+
+
+    def release(self, nbytes, draining=False):
+        with self.cond:
+            self.usage = max(0, self.usage - nbytes)
+            if draining:
+                self.draining = max(0, self.draining - nbytes)
+            self.cond.notify_all()
+
+
+    def remove(self, path, nbytes=None, draining=True):
+        if nbytes is None:
+            nbytes = os.stat(path).st_size
+        os.remove(path)
+        self.release(nbytes, draining)
+
+
+    def stats(self):
+        return { "budget": self.budget,
+                 "usage": self.usage,
+                 "peak": self.peak,
+                 "reservations": len(self.waits),
+                 "total_wait": sum(self.waits),
+                 "max_wait": max(self.waits) if self.waits else 0 }
+
+
+    def report(self, out=sys.stderr):
+        print >> out, ("Staging: %(usage)i bytes in use, %(peak)i peak, "
+                       "budget %(budget)s; waited %(total_wait).1fs "
+                       "(max %(max_wait).1fs) over %(reservations)i "
+                       "reservations")%self.stats()
@@ -0,0 +1,591 @@
+import os
+import sys
+import Queue
+import hashlib
+import tarfile
+import threading
+from os.path import join
+from os.path import dirname
+from os.path import basename
+from os.path import exists
+from urlparse import urlparse
+from collections import namedtuple
+
+from anadama.util import addtag
+
+from . import aspera
+from .journal import Journal
+from .policy import Policy
+
+
+def parse_fasp_url(u):
+    parsed = urlparse(u)
+    return parsed.netloc, parsed.path
+
+
+Member = namedtuple("Member", "path size md5 sha256")
+
+def _makedirs(d, created):
+    if not d or os.path.isdir(d):
+        return
+    _makedirs(dirname(d), created)
+    os.mkdir(d)
+    created.append(d)
+
+
+class _Hashing(object):
+    """A file open for reading that feeds what's read to ``checksum``"""
+
+    def __init__(self, f, checksum):
+        self.f = f
+        self.checksum = checksum
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.checksum.update(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def untar(fname, namespace, dest=os.curdir, bufsize=1024*1024,
+          checksum=None):
+    """Extract the regular files in the tarball ``fname`` under
+    ``dest``, each straight to its name tagged with ``namespace``.
+    Sizes and checksums are computed while the data is written.
+
+    :keyword checksum: A :py:mod:`hashlib` object; if given, it's
+    updated with every byte of the tarball in the same pass
+
+    :returns: Tuple; a list of every file and directory created, in
+    creation order, and a list of :py:class:`Member`s
+
+    """
+    to_rm, members = list(), list()
+    f = open(fname, 'rb')
+    if checksum is not None:
+        f = _Hashing(f, checksum)
+    tf = tarfile.open(fileobj=f, mode="r|*")
+    try:
+        for info in tf:
+            name = os.path.normpath(info.name)
+            if os.path.isabs(name) or name.split(os.sep)[0] == os.pardir:
+                print >> sys.stderr, "Skipping unsafe tar member "+info.name
+                continue
+            if not info.isfile():
+                continue
+            path = join(dest, addtag(name, namespace))
+            _makedirs(dirname(path), to_rm)
+            src = tf.extractfile(info)
+            md5, sha256, size = hashlib.md5(), hashlib.sha256(), 0
+            with open(path, 'wb') as out:
+                to_rm.append(path)
+                for chunk in iter(lambda: src.read(bufsize), ""):
+                    out.write(chunk)
+                    md5.update(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+            members.append(Member(path, size, md5.hexdigest(),
+                                  sha256.hexdigest()))
+        if checksum is not None:
+            # the end of archive blocks and padding aren't read for
+            # the members, but they count toward the checksum
+            for _ in iter(lambda: f.read(bufsize), ""):
+                pass
+    finally:
+        tf.close()
+        f.close()
+    return to_rm, members
+
+
+def _staged_paths(dest, members):
+    """Rebuild the list :py:func:`untar` returns as its first element,
+    for members extracted by an earlier run"""
+    paths, seen = list(), set()
+    for m in members:
+        rel = os.path.relpath(dirname(m.path), dest)
+        d = dest
+        for part in ([] if rel == os.curdir else rel.split(os.sep)):
+            d = join(d, part)
+            if d not in seen:
+                seen.add(d)
+                paths.append(d)
+        paths.append(m.path)
+    return [dest]+paths
+
+
+class Job(object):
+    """One tarball to move from the DCC to NCBI"""
+
+    def __init__(self, url, local_dir, local_cached, size, namespace,
+                 spuid=None, md5=None):
+        self.url = url
+        self.spuid = spuid
+        self.md5 = md5
+        self.srv, self.remote_path = parse_fasp_url(url)
+        self.local_dir = local_dir
+        self.local_cached = local_cached
+        self.size = size
+        self.namespace = namespace
+        self.local_file = join(local_dir, basename(self.remote_path))
+        self.complete_fname = self.local_file+"."+namespace+".complete"
+        self.stage_dir = self.local_file+"."+namespace+".extract"
+        self.to_rm = list()
+        self.members = list()
+        self.pending = 0
+        self.error = None
+        self.downloaded = False
+        self.fetched = False
+        self.staged = 0
+        self.draining = False
+        self.booked = 0
+        self.journal = None
+        self.transfers = None
+
+
+class Transfers(object):
+    """The steps of a :py:class:`Job`: download the tarball from the
+    DCC, extract it, upload each member to NCBI, and write the
+    ``.complete`` manifest.
+
+    :keyword staging: :py:class:`dcc_sra.staging.StagingArea`; if
+    given, downloads and extractions wait for room in its budget, each
+    member is deleted as soon as its upload succeeds, and tarballs
+    downloaded here are deleted once their ``.complete`` manifest is
+    written.
+
+    :keyword batch: Boolean; if True, upload all the members of a
+    tarball in one ascp session instead of one session per member.
+
+    :keyword verify: Callable; given a file name, returns its size in
+    ``ncbi_path`` or None. Used to find which members of a failed batch
+    upload arrived anyway.
+
+    :keyword journal_dir: String; if given, keep a
+    :py:class:`dcc_sra.journal.Journal` for each job in this directory.
+    An interrupted job then resumes its download, reuses the members
+    it already extracted, and skips the members it already uploaded.
+    Extracted files of failed jobs are left in place for the next run.
+
+    :keyword index: :py:class:`dcc_sra.remote.RemoteIndex`; if given,
+    each successful upload is added to it, and it's saved as each job
+    finishes.
+
+    :keyword accessions: :py:class:`dcc_sra.accessions.AccessionIndex`;
+    if given, the names and sizes of the files uploaded for each job
+    with a ``spuid`` are saved to it.
+
+    :keyword manifest: :py:class:`dcc_sra.manifest.ManifestStore`; if
+    given, each ``.complete`` manifest is saved to it as well.
+
+    :keyword cache: :py:class:`dcc_sra.cache.TarballCache`; if given,
+    tarballs are taken from it instead of downloaded when it has them,
+    and added to it when they're downloaded, once extracting them has
+    shown they match the DCC's md5.
+
+    :keyword policy: :py:class:`dcc_sra.policy.Policy`; how to retry
+    failed downloads and uploads. A job fails once a download or the
+    upload of any member runs out of retries. A tarball that turns out
+    not to match the DCC's md5 while it's extracted is deleted and
+    downloaded again, as many times, before anything is uploaded.
+
+    """
+
+    def __init__(self, dcc_user, dcc_pw, ncbi_srv, ncbi_path, ncbi_user,
+                 ncbi_keyfile, staging=None, batch=False, verify=None,
+                 journal_dir=None, policy=None, index=None,
+                 accessions=None, manifest=None, cache=None):
+        self.dcc_user = dcc_user
+        self.dcc_pw = dcc_pw
+        self.ncbi_srv = ncbi_srv
+        self.ncbi_path = ncbi_path
+        self.ncbi_user = ncbi_user
+        self.ncbi_keyfile = ncbi_keyfile
+        self.staging = staging
+        self.batch = batch
+        self.verify = verify
+        self.journal_dir = journal_dir
+        self.policy = policy or Policy()
+        self.index = index
+        self.accessions = accessions
+        self.manifest = manifest
+        self.cache = cache
+        self.lock = threading.Lock()
+
+
+    def _stage(self, job, nbytes):
+        with self.lock:
+            job.staged += nbytes
+
+
+    def clear(self, job):
+        """Delete the tarball of a job an earlier run finished, if it
+        was downloaded into the staging area"""
+        if (self.staging is not None and exists(job.complete_fname)
+            and exists(job.local_file)
+            and basename(job.local_file) not in job.local_cached):
+            os.remove(job.local_file)
+
+
+    def _open_journal(self, job):
+        if self.journal_dir and job.journal is None:
+            job.journal = Journal(join(
+                self.journal_dir,
+                basename(job.local_file)+"."+job.namespace+".journal"))
+        return job.journal
+
+
+    def download(self, job):
+        journal = self._open_journal(job)
+        cached = basename(job.local_file) in job.local_cached
+        confirmed = cached or (journal is not None
+                               and journal.download_size == job.size)
+        skip = (confirmed and exists(job.local_file)
+                and os.stat(job.local_file).st_size == job.size)
+        if self.staging is not None:
+            job.booked = self.staging.estimate(job.size)
+            if skip:
+                self.staging.add(job.size+job.booked)
+            else:
+                self.staging.reserve(job.size+job.booked)
+            self._stage(job, job.size+job.booked)
+        job.downloaded = not (cached and skip)
+        if skip == False:
+            if self.cache is None or not self.cache.fetch(
+                    job.url, job.size, job.md5, job.local_file):
+                self.policy.call(job.srv, "Download of "+job.url,
+                                 aspera.download_file, job.srv,
+                                 self.dcc_user, self.dcc_pw,
+                                 job.remote_path, job.local_dir)
+                job.fetched = True
+            if journal is not None:
+                journal.record_download(job.size)
+
+
+    def _extracted(self, job):
+        """Members a journal says were extracted, if the ones not yet
+        uploaded are still on disk"""
+        if job.journal is None or not job.journal.extracted:
+            return None
+        members = map(Member._make, job.journal.members)
+        for m in members:
+            if job.journal.is_uploaded(m):
+                continue
+            if not exists(m.path) or os.stat(m.path).st_size != m.size:
+                return None
+        return members
+
+
+    def extract(self, job):
+        members = self._extracted(job)
+        if members is not None:
+            job.members = members
+            job.to_rm = _staged_paths(job.stage_dir, members)
+            if self.staging is not None:
+                self._reserve_extract(job, sum(
+                    m.size for m in members if exists(m.path)), wait=False)
+            return
+        for attempt in range(self.policy.retries+1):
+            md5 = self._untar(job)
+            if md5 is None or not job.md5 or md5 == job.md5:
+                break
+            self._discard(job)
+            msg = "%s doesn't match the DCC's md5"%(job.url)
+            if attempt == self.policy.retries:
+                raise Exception("%s after %i downloads"%(msg, attempt+1))
+            print >> sys.stderr, msg+"; downloading it again"
+            self.download(job)
+        if job.journal is not None:
+            job.journal.record_extract(job.members)
+        if md5 is not None and self.cache is not None:
+            self.cache.store(job.url, job.size, md5, job.local_file)
+
+
+    def _untar(self, job):
+        """Extract a job's tarball, and check the md5 of one downloaded
+        here along the way
+
+        :returns: String; the md5 of the tarball, or None if it wasn't
+        checked
+
+        """
+        if self.staging is not None:
+            estimate = self.staging.estimate(job.size)
+            self._reserve_extract(job, estimate)
+        checksum = None
+        if job.fetched and (job.md5 or self.cache is not None):
+            checksum = hashlib.md5()
+        job.to_rm, job.members = untar(job.local_file, job.namespace,
+                                       dest=job.stage_dir, checksum=checksum)
+        if self.staging is not None:
+            # settle the estimate with what was actually written
+            extracted = sum(m.size for m in job.members)
+            self.staging.learn(job.size, extracted)
+            self.staging.reserve_extract(0, extracted-estimate, wait=False)
+            self._stage(job, extracted-estimate)
+        return checksum.hexdigest() if checksum is not None else None
+
+
+    def _discard(self, job):
+        """Delete a bad download and what was extracted from it, so it
+        can be downloaded again"""
+        for f in reversed(job.to_rm+[job.local_file]):
+            if exists(f):
+                os.rmdir(f) if os.path.isdir(f) else os.remove(f)
+        job.to_rm, job.members = list(), list()
+        if self.staging is not None:
+            with self.lock:
+                staged, job.staged = job.staged, 0
+            self.staging.release(staged, job.draining)
+            job.draining = False
+
+
+    def _reserve_extract(self, job, nbytes, wait=True):
+        nbytes, job.booked = nbytes-job.booked, 0
+        self.staging.reserve_extract(job.staged, nbytes, wait)
+        job.draining = True
+        self._stage(job, nbytes)
+
+
+    def _uploaded(self, job, member):
+        if self.index is not None:
+            self.index.record(basename(member.path), member.size)
+        if job.journal is not None and not job.journal.is_uploaded(member):
+            job.journal.record_upload(member)
+        if self.staging is not None and exists(member.path):
+            self.staging.remove(member.path, member.size)
+            self._stage(job, -member.size)
+
+
+    def _todo(self, job, members):
+        if job.journal is None:
+            return list(members)
+        return [ m for m in members if not job.journal.is_uploaded(m) ]
+
+
+    def _send(self, job, members):
+        """Upload ``members`` until all of them made it, retrying only
+        the ones that didn't"""
+        todo = self._todo(job, members)
+        for m in members:
+            if m not in todo: # confirmed by an earlier run
+                self._uploaded(job, m)
+        def _attempt():
+            results = aspera.upload_files(self.ncbi_srv, self.ncbi_user,
+                                          None, [m.path for m in todo],
+                                          self.ncbi_path,
+                                          keyfile=self.ncbi_keyfile,
+                                          verify=self.verify)
+            for m, result in zip(list(todo), results):
+                if result.ok:
+                    self._uploaded(job, m)
+                    todo.remove(m)
+            return not todo
+        if todo:
+            what = "Upload of "+(todo[0].path if len(todo) == 1 else
+                                 "%i files from %s"%(len(todo), job.url))
+            self.policy.call(self.ncbi_srv, what, _attempt)
+        return True
+
+
+    def upload(self, job, member):
+        return self._send(job, [member])
+
+
+    def batches(self, job):
+        """Split the members of ``job`` into the groups to upload
+        together"""
+        if self.batch:
+            return [job.members] if job.members else []
+        return [ [m] for m in job.members ]
+
+
+    def upload_batch(self, job, members):
+        if not self.batch:
+            return all([ self.upload(job, m) for m in members ])
+        return self._send(job, members)
+
+
+    def record(self, job, rows):
+        """Write the ``.complete`` manifest of a job whose members all
+        made it to NCBI, and save it to the manifest store and the
+        accession index
+
+        :param rows: List of tuples; name, size, md5 and sha256 of each
+        member
+
+        """
+        if self.manifest is not None:
+            self.manifest.put(job.complete_fname, rows)
+        with open(job.complete_fname, 'w') as f:
+            for row in rows:
+                print >> f, "\t".join(map(str, row))
+        if self.accessions is not None and job.spuid:
+            self.accessions.record_files(
+                job.spuid, [ (row[0], row[1]) for row in rows ])
+
+
+    def finish(self, job):
+        if job.error is None:
+            self.record(job, [ (basename(m.path),)+m[1:]
+                               for m in job.members ])
+            if job.journal is not None:
+                job.journal.remove()
+            if self.staging is not None and job.downloaded:
+                os.remove(job.local_file)
+        # keep what a failed job extracted, for its journal to pick up
+        to_rm = job.to_rm
+        if job.error is not None and job.journal is not None:
+            to_rm = []
+        for f in reversed(to_rm):
+            if not exists(f):
+                continue
+            try:
+                os.rmdir(f) if os.path.isdir(f) else os.remove(f)
+            except:
+                print >> sys.stderr, "Unable to remove "+f
+        if self.staging is not None:
+            with self.lock:
+                staged, job.staged = job.staged, 0
+            self.staging.release(staged, job.draining)
+        if self.index is not None:
+            self.index.save()
+
+
+    def run(self, job):
+        try:
+            self.download(job)
+            self.extract(job)
+            for members in self.batches(job):
+                self.upload_batch(job, members)
+        except Exception as e:
+            job.error = e
+            raise
+        finally:
+            self.finish(job)
+
+
+class StagedScheduler(object):
+    """Run :py:class:`Job`s through separate pools of download,
+    extraction and upload threads connected by bounded queues, so the
+    next tarball can download while the members of the last one
+    upload.
+
+    :keyword queue_size: Integer; how many downloaded tarballs may wait
+    for extraction, and how many uploads per upload thread may wait
+    to start, before the stage in front of them blocks
+
+    A job with its own ``transfers`` set is run with those, so one
+    scheduler can serve jobs bound for different places.
+
+    """
+
+    def __init__(self, transfers, download_workers=2, extract_workers=1,
+                 upload_workers=4, queue_size=4):
+        self.transfers = transfers
+        self.download_workers = max(1, download_workers)
+        self.extract_workers = max(1, extract_workers)
+        self.upload_workers = max(1, upload_workers)
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.failed = list()
+
+
+    def _fail(self, job, e):
+        with self.lock:
+            if job.error is None:
+                job.error = e
+                self.failed.append(job)
+        print >> sys.stderr, "Transfer of %s failed: %s"%(job.url, e)
+
+
+    def _t(self, job):
+        return job.transfers or self.transfers
+
+
+    def _finish(self, job):
+        # an exception here must not take the worker thread down with
+        # it, or the stages in front of it would block forever
+        try:
+            self._t(job).finish(job)
+        except Exception as e:
+            self._fail(job, e)
+
+
+    def _downloader(self, inq, outq):
+        for job in iter(inq.get, None):
+            try:
+                self._t(job).download(job)
+            except Exception as e:
+                self._fail(job, e)
+                self._finish(job)
+                continue
+            outq.put(job)
+
+
+    def _extractor(self, inq, outq):
+        for job in iter(inq.get, None):
+            try:
+                self._t(job).extract(job)
+            except Exception as e:
+                self._fail(job, e)
+                self._finish(job)
+                continue
+            batches = self._t(job).batches(job)
+            job.pending = len(batches)
+            if not batches:
+                self._finish(job)
+            for members in batches:
+                outq.put((job, members))
+
+
+    def _uploader(self, inq):
+        for job, members in iter(inq.get, None):
+            try:
+                self._t(job).upload_batch(job, members)
+            except Exception as e:
+                self._fail(job, e)
+            with self.lock:
+                job.pending -= 1
+                done = job.pending == 0
+            if done:
+                self._finish(job)
+
+
+    def _start(self, n, target, *args):
+        threads = [ threading.Thread(target=target, args=args)
+                    for _ in range(n) ]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        return threads
+
+
+    def run(self, jobs):
+        download_q = Queue.Queue()
+        extract_q = Queue.Queue(self.queue_size)
+        upload_q = Queue.Queue(self.queue_size*self.upload_workers)
+        stages = [
+            (self._start(self.download_workers, self._downloader,
+                         download_q, extract_q), download_q),
+            (self._start(self.extract_workers, self._extractor,
+                         extract_q, upload_q), extract_q),
+            (self._start(self.upload_workers, self._uploader,
+                         upload_q), upload_q),
+        ]
+        for job in jobs:
+            download_q.put(job)
+        for threads, inq in stages:
+            for _ in threads:
+                inq.put(None)
+            for t in threads:
+                t.join()
+        if self.transfers.staging is not None:
+            self.transfers.staging.report()
+        if self.transfers.cache is not None:
+            self.transfers.cache.report()
+        if self.failed:
+            raise Exception("%i of %i transfers failed: %s"%(
+                len(self.failed), len(jobs),
+                ", ".join(job.url for job in self.failed)))
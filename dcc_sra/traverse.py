@@ -0,0 +1,136 @@
+import sys
+import time
+import threading
+from itertools import chain
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from . import SubmitRecord
+from . import PrepSeq
+
+LEVELS = ("subjects", "visits", "samples", "preps", "seqs")
+
+
+def seq_sets(prep):
+    meth = getattr(prep, "child_seq_sets", None)
+    if not meth:
+        meth = getattr(prep, "raw_seq_sets", None)
+    return list(meth())
+
+
+def _subjects(study):
+    return list(study.subjects())
+
+def _visits(subject):
+    return list(subject.visits())
+
+def _samples(visit):
+    return list(visit.samples())
+
+def _preps(sample):
+    return list(sample.sixteenSDnaPreps()), list(sample.wgsDnaPreps())
+
+
+def _flat(nested):
+    return list(chain.from_iterable(nested))
+
+
+class StudyTraversal(object):
+    """Walk an OSDF study graph level by level, loading the children of
+    every node on a level concurrently.
+
+    :keyword workers: Integer; size of the thread pool shared by all
+    levels.
+
+    :keyword fanout: Dictionary; maps a level name from ``LEVELS`` to
+    the maximum number of requests in flight for that level. Levels
+    not mentioned may use every worker.
+
+    """
+
+    def __init__(self, workers=8, fanout=None):
+        self.workers = max(1, int(workers))
+        self.fanout = dict(fanout or {})
+        self.timings = OrderedDict()
+        self.counts = OrderedDict()
+        self.links = list()
+        self._pool = None
+
+
+    def _bounded(self, level, func):
+        limit = self.fanout.get(level)
+        if not limit or limit >= self.workers:
+            return func
+        sem = threading.BoundedSemaphore(limit)
+        def _f(item):
+            with sem:
+                return func(item)
+        return _f
+
+
+    def _level(self, level, func, parents):
+        start = time.time()
+        if self.workers == 1 or len(parents) < 2:
+            ret = map(func, parents)
+        else:
+            ret = self._pool.map(self._bounded(level, func), parents,
+                                 chunksize=1)
+        self.timings[level] = time.time() - start
+        return ret
+
+
+    def run(self, study):
+        """Load every sample, prep, and sequence set of ``study``.
+
+        :returns: Tuple of lists; the 16S ``SubmitRecord``s and the
+        WGS ``SubmitRecord``s, one of each per sample in the order a
+        serial walk would produce them.
+
+        """
+        self._pool = ThreadPool(self.workers) if self.workers > 1 else None
+        try:
+            subjects = _flat(self._level("subjects", _subjects, [study]))
+            visits_by = self._level("visits", _visits, subjects)
+            visits = _flat(visits_by)
+            samples_by = self._level("samples", _samples, visits)
+            samples = _flat(samples_by)
+            preps = self._level("preps", _preps, samples)
+            all_preps = [p for six, wgs in preps for p in chain(six, wgs)]
+            seqs = iter(self._level("seqs", seq_sets, all_preps))
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+        for level, nodes in zip(LEVELS, (subjects, visits, samples,
+                                         all_preps)):
+            self.counts[level] = len(nodes)
+
+        self.links = [("subjects", study, subjects)]
+        self.links.extend(("visits", s, v) for s, v in zip(subjects, visits_by))
+        self.links.extend(("samples", v, s) for v, s in zip(visits, samples_by))
+
+        def _prepseqs(preps):
+            ret = list()
+            for prep in preps:
+                prep_seqs = next(seqs)
+                self.links.append(("seqs", prep, prep_seqs))
+                ret.extend( PrepSeq(prep, seq) for seq in prep_seqs )
+            return ret
+
+        records_16s, records_wgs = list(), list()
+        for sample, (preps_16s, preps_wgs) in zip(samples, preps):
+            self.links.append(("preps_16s", sample, preps_16s))
+            self.links.append(("preps_wgs", sample, preps_wgs))
+            records_16s.append(SubmitRecord(sample, _prepseqs(preps_16s)))
+            records_wgs.append(SubmitRecord(sample, _prepseqs(preps_wgs)))
+        self.counts["seqs"] = sum(len(r.prepseqs)
+                                  for r in chain(records_16s, records_wgs))
+        return records_16s, records_wgs
+
+
+    def report(self, out=sys.stderr):
+        for level, secs in self.timings.iteritems():
+            print >> out, "OSDF traversal: %s took %.2fs (%i nodes)"%(
+                level, secs, self.counts.get(level, 0))
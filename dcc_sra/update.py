@@ -1,60 +1,242 @@
 import sys
 import xml.etree.ElementTree as ET
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 
 def handle_error(r):
-    obj_id = r.iter("Object").next().get("spuid")
-    msg_text = "Problem with: " + obj_id + "\n"
+    obj = next(r.iter("Object"), None)
+    obj_id = obj.get("spuid") if obj is not None else None
+    msg_text = "Problem with: " + (obj_id or "submission") + "\n"
     for m in r.iter():
         if m.text and m.text.strip():
             msg_text += m.text.strip() + "\n"
     return msg_text
 
 
+def _tag(osdf, spuid, target_db, acc_num):
+    """Add the ``target_db:acc_num`` tag to an OSDF node
+
+    :returns: Tuple; whether the node changed, and the node document
+
+    """
+    doc = osdf.get_node(spuid)
+    to_append = "%s:%s"%(target_db, acc_num)
+    if to_append in doc['meta']['tags']:
+        return False, doc
+    doc['meta']['tags'].append(to_append)
+    _, errs = osdf.validate_node(doc)
+    if errs:
+        raise Exception("Unable to save changes to object `%s': %s"%(
+            doc['id'], errs))
+    osdf.edit_node(doc)
+    return True, doc
+
+
 def handle_ok(session, r):
     msg_text = ""
     osdf = session.get_osdf()
     for obj in r.iter("Object"):
-        msg = ""
         try:
-            doc = osdf.get_node(obj.attrib['spuid'])
-            target_db = obj.attrib['target_db']
-            acc_num = obj.attrib['accession']
+            changed, doc = _tag(osdf, obj.attrib['spuid'],
+                                obj.attrib['target_db'],
+                                obj.attrib['accession'])
+        except KeyError as e:
+            msg_text += "Unable to save object %s: %s\n"%(obj.attrib, e)
+            continue
         except Exception as e:
-            msg += ("Unable to save object %s: %s"%(obj.attrib, e))
-            msg_text += msg + "\n"
+            msg_text += str(e)+"\n"
             continue
-        to_append = "%s:%s"%(target_db, acc_num)
-        if to_append not in doc['meta']['tags']:
-            doc['meta']['tags'].append(to_append)
-        _, errs = osdf.validate_node(doc)
-        if errs:
-            msg += "Unable to save changes to object `%s': %s"%(doc['id'], errs)
-        else:
-            osdf.edit_node(doc)
-            msg = "%s id `%s' now has tags: %s"%(doc['node_type'],
-                                                 doc['id'], doc['meta']['tags'])
-        msg_text += msg+"\n"
+        msg_text += "%s id `%s' now has tags: %s\n"%(
+            doc['node_type'], doc['id'], doc['meta']['tags'])
     return msg_text
 
 
-def update_osdf_from_report(session, report_fname):
-    resps = ET.parse(report_fname).getroot().iter("Response")
-    oks, errors = list(), list()
-    for resp in resps:
-        if 'status' not in resp.attrib:
+def tag_nodes(session, objects, workers=8, tagged=None):
+    """Tag OSDF nodes with the accessions NCBI gave them, a few at a
+    time. Nodes that already have the tag are left alone, so this is
+    safe to run again after a partial failure.
+
+    :param objects: Iterable of tuples; ``(spuid, target_db,
+    accession)``
+
+    :keyword tagged: Dictionary; node ID to a collection of tags the
+    node is known to have, like ``BioSample:SAMN01``. Nodes already
+    tagged with their accession aren't fetched at all, and nodes
+    tagged here are added to it.
+
+    :returns: Dictionary; lists of ``(spuid, target_db, accession)``
+    under ``tagged`` for nodes changed, ``unchanged`` for nodes that
+    already had the tag, and ``skipped`` for nodes known to have it
+    without asking OSDF. ``failed`` lists ``(spuid, target_db,
+    accession, message)``.
+
+    """
+    if tagged is None:
+        tagged = dict()
+    summary = dict(tagged=[], unchanged=[], skipped=[], failed=[])
+    todo = list()
+    for obj in sorted(set(objects)):
+        spuid, target_db, acc_num = obj
+        if "%s:%s"%(target_db, acc_num) in tagged.get(spuid, ()):
+            summary['skipped'].append(obj)
+        else:
+            todo.append(obj)
+
+    osdf = session.get_osdf()
+    def _t(obj):
+        try:
+            changed, _ = _tag(osdf, *obj)
+        except Exception as e:
+            return obj, None, str(e)
+        return obj, changed, None
+
+    pool = ThreadPool(max(1, min(workers, len(todo) or 1)))
+    try:
+        for obj, changed, err in pool.imap_unordered(_t, todo):
+            if err is not None:
+                summary['failed'].append(obj+(err,))
+            else:
+                summary['tagged' if changed else 'unchanged'].append(obj)
+                tagged.setdefault(obj[0], set()).add("%s:%s"%obj[1:])
+    finally:
+        pool.close()
+        pool.join()
+    for v in summary.itervalues():
+        v.sort()
+    return summary
+
+
+def _is_ok(status):
+    return bool(status) and ('ok' in status or 'continue' in status)
+
+
+def responses(report_fname):
+    """Generate the ``Response`` elements of a report one at a time,
+    without keeping the whole report in memory. Each element is
+    cleared once the next one is asked for, so use it before then."""
+    root = None
+    for event, el in ET.iterparse(report_fname, events=("start", "end")):
+        if root is None:
+            root = el
+        if event != "end":
             continue
-        s = resp.attrib['status']
-        if 'ok' in s or 'continue' in s:
-            oks.append(handle_ok(session, resp))
+        if el.tag == "Response":
+            yield el
+            el.clear()
+        elif el.tag == "Action":
+            root.clear()
+
+
+def accepted(report_fname):
+    """Generate ``(spuid, target_db, accession)`` for every object NCBI
+    accepted in a report"""
+    for resp in responses(report_fname):
+        if not _is_ok(resp.attrib.get('status', '')):
+            continue
+        for obj in resp.iter("Object"):
+            if 'accession' in obj.attrib and 'spuid' in obj.attrib:
+                yield (obj.attrib['spuid'], obj.attrib.get('target_db'),
+                       obj.attrib['accession'])
+
+
+ObjectStatus = namedtuple("ObjectStatus", "spuid target_db accession status "
+                          "report message")
+
+def merge_reports(report_fnames, errors=None):
+    """Merge reports into the latest status of each object. An object
+    keeps the accession it got in an earlier report if a later report
+    doesn't repeat it.
+
+    :param report_fnames: List of strings; reports, oldest first
+
+    :keyword errors: List; if given, the messages of the latest
+    report's error Responses that don't name an object, like a failed
+    submission, are added to it
+
+    :returns: List of :py:class:`ObjectStatus`, sorted by SPUID
+
+    """
+    merged = dict()
+    unattached = list()
+    for fname in report_fnames:
+        unattached = list()
+        for resp in responses(fname):
+            if 'status' not in resp.attrib:
+                continue
+            status = resp.attrib['status']
+            objs = [ obj for obj in resp.iter("Object")
+                     if 'spuid' in obj.attrib ]
+            message = None if _is_ok(status) else handle_error(resp)
+            if not objs:
+                if message is not None:
+                    unattached.append(message)
+                continue
+            for obj in objs:
+                key = (obj.attrib['spuid'], obj.attrib.get('target_db'))
+                prev = merged.get(key)
+                acc = obj.attrib.get('accession') or (prev and prev.accession)
+                merged[key] = ObjectStatus(key[0], key[1], acc, status,
+                                           fname, message)
+    if errors is not None:
+        errors.extend(unattached)
+    return [ merged[k] for k in sorted(merged) ]
+
+
+def update_osdf_from_reports(session, report_fnames, workers=8, tagged=None,
+                             accessions=None):
+    """Tag OSDF nodes with the accessions in all of the reports on a
+    submission, and print what NCBI objected to in the latest report
+    on each object.
+
+    :param report_fnames: List of strings; reports, oldest first
+
+    :keyword accessions: :py:class:`dcc_sra.accessions.AccessionIndex`;
+    if given, the statuses are saved to it, and nodes it knows to be
+    tagged already are skipped.
+
+    :returns: Dictionary; the summary from :py:func:`tag_nodes`, with
+    messages about the objects NCBI didn't accept under ``errors``
+
+    """
+    objects, errors = list(), list()
+    merged = merge_reports(report_fnames, errors)
+    if accessions is not None:
+        accessions.record_statuses(merged)
+        if tagged is None:
+            tagged = dict()
+        for spuid, tags in accessions.tags().iteritems():
+            tagged.setdefault(spuid, set()).update(tags)
+    for o in merged:
+        if not _is_ok(o.status):
+            errors.append(o.message)
+        elif o.target_db and o.accession:
+            objects.append((o.spuid, o.target_db, o.accession))
         else:
-            errors.append(handle_error(resp))
+            errors.append("Unable to save object %s: no %s"%(
+                o.spuid, "target_db" if o.accession else "accession"))
 
-    for ok in oks:
-        print >> sys.stderr, "OK --  "+ ok
-        print >> sys.stderr, "-------"
+    summary = tag_nodes(session, objects, workers, tagged)
+    summary['errors'] = errors
+    if accessions is not None:
+        accessions.mark_tagged(summary['tagged']+summary['unchanged']
+                               +summary['skipped'])
+    for key in ("tagged", "unchanged", "skipped"):
+        for spuid, target_db, acc_num in summary[key]:
+            print >> sys.stderr, "OK --  %s %s:%s (%s)"%(spuid, target_db,
+                                                        acc_num, key)
+    for spuid, target_db, acc_num, msg in summary['failed']:
+        print >> sys.stderr, "FAILED --  %s %s:%s: %s"%(spuid, target_db,
+                                                       acc_num, msg)
+    print >> sys.stderr, "-------"
 
     if errors:
         for error in errors:
             print >> sys.stderr, "ERROR --  "+error
             print >> sys.stderr, "----------"
-        return False
+    return summary
+
+
+def update_osdf_from_report(session, report_fname, workers=8, tagged=None,
+                            accessions=None):
+    return update_osdf_from_reports(session, [report_fname], workers, tagged,
+                                    accessions)
@@ -0,0 +1,105 @@
+import os
+import re
+import sys
+import time
+import xml.etree.ElementTree as ET
+from os.path import join
+from os.path import exists
+
+from .util import reportnum
+
+REPORT_RE = re.compile(r'report\.[\d.]*xml$')
+
+# SubmissionStatus values after which NCBI sends no more reports
+FINAL = ("processed-ok", "processed-error", "failed", "deleted")
+
+
+def report_status(fname):
+    """:returns: String; the status of the whole submission, read from
+    the root element of a report"""
+    for _, el in ET.iterparse(fname, events=("start",)):
+        return el.get("status", "")
+
+
+class ReportWatcher(object):
+    """Watch a remote directory for NCBI's report.N.xml files, and
+    hand each new one over as soon as it's downloaded.
+
+    The directory is listed every ``interval`` seconds at first, and
+    half as often after each listing that turns up nothing, up to once
+    every ``max_interval`` seconds. A new report resets the interval.
+
+    :param conn: :py:class:`dcc_sra.ssh.SSHConnection`
+
+    :keyword deadline: Number; seconds to watch for before giving up
+
+    :keyword until_final: Boolean; if False, stop once new reports
+    were found. If True, stop once a report has one of the
+    :py:data:`FINAL` statuses, which may be one downloaded before.
+
+    """
+
+    def __init__(self, conn, reports_dir, interval=0.5, max_interval=60,
+                 deadline=20*60, until_final=False):
+        self.conn = conn
+        self.reports_dir = reports_dir
+        self.interval = interval
+        self.max_interval = max_interval
+        self.deadline = deadline
+        self.until_final = until_final
+        self.polls = 0
+
+
+    def _new(self):
+        self.polls += 1
+        names = [ n for n in self.conn.files() if REPORT_RE.search(n)
+                  and not exists(join(self.reports_dir, n)) ]
+        return sorted(names, key=reportnum)
+
+
+    def _latest_status(self):
+        """:returns: String; the status of the latest report already
+        downloaded, or None if there are none"""
+        if not os.path.isdir(self.reports_dir):
+            return None
+        names = sorted([ n for n in os.listdir(self.reports_dir)
+                         if REPORT_RE.search(n) ], key=reportnum)
+        if not names:
+            return None
+        return report_status(join(self.reports_dir, names[-1]))
+
+
+    def watch(self, handle):
+        """Call ``handle`` with the local path of every new report, in
+        the order NCBI numbered them.
+
+        :returns: String; the status of the last report handled, or
+        None if the deadline passed without one. With ``until_final``,
+        a report downloaded before counts as handled, and a final one
+        ends the watch before the first wait.
+
+        """
+        stop_at = time.time() + self.deadline
+        delay, status = self.interval, None
+        while True:
+            new = self._new()
+            for name in new:
+                local = join(self.reports_dir, name)
+                # a partial download must not pass for the report
+                self.conn.get(name, local+".part")
+                os.rename(local+".part", local)
+                status = report_status(local)
+                print >> sys.stderr, "Report %s: %s"%(name, status)
+                handle(local)
+            if self.until_final:
+                # the latest report, whether it's new or not
+                status = self._latest_status()
+                if status in FINAL:
+                    return status
+            if new and not self.until_final:
+                return status
+            delay = self.interval if new else min(delay*2, self.max_interval)
+            left = stop_at - time.time()
+            if left <= 0:
+                return status
+            time.sleep(min(delay, left))
@@ -1,41 +1,46 @@
 import os
 import re
 import sys
-import time
-import subprocess
 from os.path import join
 from os.path import dirname
 from os.path import basename
 from os.path import exists
-from urlparse import urlparse
 from itertools import chain
 from collections import defaultdict
-import xml.etree.ElementTree as ET
 
 from cutlass.aspera import aspera as asp
-from anadama.util import addtag
 
 from . import ssh
-from .serialize import indent
-from .serialize import to_xml
+from .serialize import write_xml
+from .transfer import Job
+from .transfer import Transfers
+from .transfer import StagedScheduler
+from .staging import StagingArea
+from .policy import Policy
+from .remote import RemoteIndex
+from . import remote
+from .watch import ReportWatcher
+from .watch import FINAL
+from .watch import REPORT_RE
+from .update import update_osdf_from_reports
 from .util import reportnum
-from .update import update_osdf_from_report
+from .ledger import Ledger
+from .ledger import write_fingerprints
+from . import ledger
+from .accessions import AccessionIndex
+from .manifest import ManifestStore
+from .cache import TarballCache
+from .workqueue import WorkQueue
+from . import workqueue
+from .manifest import read_complete
+from . import manifest
+from . import accessions
 
 
-class NoEqual(object):
-    def __eq__(self, other):
-        return False
-
-    
 def fsize(fname):
     return os.stat(fname).st_size
 
 
-def parse_fasp_url(u):
-    parsed = urlparse(u)
-    return parsed.netloc, parsed.path
-
-
 identity = lambda x: x
 def groupby(keyfunc=identity, seq=[]):
     grouped = defaultdict(list)
@@ -57,109 +62,341 @@ def _completeparse(fname):
     with open(fname) as f:
         ret = []
         for line in f:
-            ret.append( line.split('\t') )
+            ret.append( line.rstrip('\n').split('\t') )
     return ret
 
 
-def untar(fname):
-    proc = subprocess.Popen(["tar", "-xvf", fname,], 
-                            stdout=subprocess.PIPE)
-    out = proc.communicate()[0]
-    names = filter(bool, map(str.strip, out.split('\n')))
-    return names, filter(os.path.isfile, names)
-
-
 class DownUpUpToDate(object):
-    def __init__(self, seq, ssh_session):
+    """A tarball is up to date if every member in its ``.complete``
+    manifest is on the NCBI server with the right size, or if NCBI
+    already accepted the sequence set, when ``accessions`` is given.
+    With a ``manifest`` store, the members are looked up there instead
+    of read from the ``.complete`` file."""
+
+    def __init__(self, seq, index, accessions=None, manifest=None):
         self.seq = seq
-        self.ssh_session = ssh_session
+        self.index = index
+        self.accessions = accessions
+        self.manifest = manifest
 
     def __call__(self, task, values):
-        cf = task.targets[0]
+        return self.check(task.targets[0])
+
+    def _members(self, cf):
+        if self.manifest is not None:
+            return self.manifest.members(cf)
+        return read_complete(cf)
+
+    def check(self, cf):
         t = re.sub(r'\....\.complete$', '', cf)
-        if not exists(t) or not exists(cf):
+        if not exists(cf):
+            return False
+        if self.accessions is not None \
+           and self.accessions.accession(self.seq.id, "SRA"):
+            return True
+        # the tarball may have been cleaned out of the staging area
+        if exists(t) and not os.stat(t).st_size == self.seq.size:
             return False
-        if not os.stat(t).st_size == self.seq.size:
+        members = self._members(cf)
+        if members is None:
             return False
-        with open(cf) as f:
-            for name, size in [ s.split("\t") for s in map(str.strip, f) ]:
-                key = os.path.join(self.ssh_session.remote_path, name)
-                remote_size = self.ssh_session.file_cache.get(key, NoEqual())
-                if not remote_size == int(size):
-                    return False
+        for fields in members:
+            name, size = fields[:2]
+            if not self.index.get(name) == int(size):
+                return False
         return True
+
+
+class AllUpToDate(object):
+    def __init__(self, checks):
+        self.checks = checks
+
+    def __call__(self, task, values):
+        return not self.outdated(stop_early=True)
+
+    def outdated(self, stop_early=False):
+        """Check every tarball in one pass
+
+        :returns: List of strings; the ``.complete`` files of the
+        tarballs that are out of date
+
+        """
+        ret = list()
+        for cf, check in self.checks:
+            if not check.check(cf):
+                ret.append(cf)
+                if stop_early:
+                    break
+        return ret
     
 
 def download_upload(recs_16s, cached_16s_files, recs_wgs, 
                     cached_wgs_files, dcc_user, dcc_pw, ncbi_srv, 
-                    ncbi_path, ncbi_user, ncbi_keyfile, products_dir):
+                    ncbi_path, ncbi_user, ncbi_keyfile, products_dir,
+                    pipelined=False, download_workers=2, extract_workers=1,
+                    upload_workers=4, queue_size=4, staging_budget=None,
+                    batch_uploads=False, retries=3, backoff=2, max_backoff=300,
+                    breaker_threshold=5, breaker_cooldown=60,
+                    remote_index_ttl=3600, accessions_fname=None,
+                    manifest_db=False, manifest_fname=None, cache_dir=None,
+                    cache_max_bytes=None, queue_fname=None, queue_lease=600,
+                    queue_attempts=3, queue_poll=5, queue_timeout=3600,
+                    queue=None, shared=None):
+    """Download raw sequence tarballs from the DCC, extract them, and
+    upload their contents to NCBI.
+
+    :keyword pipelined: Boolean; if True, make a single task that runs
+    every out of date transfer through a
+    :py:class:`dcc_sra.transfer.StagedScheduler` with the given number
+    of download, extract and upload workers. Otherwise, make one task
+    per tarball.
+
+    :keyword staging_budget: Integer; if set, keep the local files of
+    all transfers within this many bytes (0 for no limit), delete
+    extracted files as soon as they're uploaded, and delete downloaded
+    tarballs once their ``.complete`` manifest is written. See
+    :py:class:`dcc_sra.staging.StagingArea`.
+
+    Each transfer keeps a journal in ``products_dir`` while it runs, so
+    a transfer interrupted by a crash resumes from its last finished
+    step. See :py:class:`dcc_sra.journal.Journal`.
+
+    :keyword batch_uploads: Boolean; if True, upload the contents of
+    each tarball in a single ascp session. See
+    :py:func:`dcc_sra.aspera.upload_files`.
+
+    :keyword retries: Integer; how many times to retry a failed
+    download or upload, waiting up to ``backoff`` seconds (doubling
+    each time, up to ``max_backoff``) in between. After
+    ``breaker_threshold`` failures in a row, all transfers to or from
+    that host pause for ``breaker_cooldown`` seconds. See
+    :py:class:`dcc_sra.policy.Policy`.
+
+    :keyword remote_index_ttl: Number; seconds before the saved listing
+    of ``ncbi_path`` is listed again from the server. Uploads are added
+    to it as they succeed. See :py:class:`dcc_sra.remote.RemoteIndex`.
+
+    :keyword queue_fname: String; if given, don't transfer anything
+    here. Instead, make a single task that publishes every out of date
+    transfer to the :py:class:`dcc_sra.workqueue.WorkQueue` in this
+    file, for workers elsewhere to lease for ``queue_lease`` seconds at
+    a time and try up to ``queue_attempts`` times, and writes the
+    ``.complete`` manifests as they finish. The task fails if no
+    worker shows any sign of life for ``queue_timeout`` seconds. See
+    :py:class:`dcc_sra.workqueue.Worker`.
+
+    :keyword queue: :py:class:`dcc_sra.workqueue.WorkQueue`; use this
+    queue instead of opening ``queue_fname``, e.g. one on ``:memory:``
+    shared with workers in the same process.
+
+    :keyword shared: Dictionary; with ``pipelined`` or a queue,
+    collect the transfers here for :py:func:`transfer_all` instead of
+    making a task for them, and share the staging area, retry policy
+    and tarball cache with other calls given the same dictionary.
+
+    """
 
+    distributed = bool(queue_fname) or queue is not None
     ssh_session = ssh.SSHConnection(ncbi_user, ncbi_srv, ncbi_keyfile, ncbi_path)
+    index = RemoteIndex(ssh_session, join(products_dir, remote.FNAME),
+                        remote_index_ttl)
+    acc_index = None
+    if accessions_fname:
+        acc_index = AccessionIndex(accessions_fname)
+    store = None
+    if manifest_db:
+        store = ManifestStore(manifest_fname
+                              or join(products_dir, manifest.FNAME))
+
+    def _shared(key, make):
+        if shared is None:
+            return make()
+        if key not in shared:
+            shared[key] = make()
+        return shared[key]
+    cache, staging = None, None
+    if cache_dir:
+        cache = _shared("cache",
+                        lambda: TarballCache(cache_dir, cache_max_bytes))
+    if staging_budget is not None:
+        staging = _shared("staging", lambda: StagingArea(staging_budget))
+    policy = _shared("policy", lambda: Policy(retries, backoff, max_backoff,
+                                              breaker_threshold,
+                                              breaker_cooldown))
+    transfers = Transfers(dcc_user, dcc_pw, ncbi_srv, ncbi_path, ncbi_user,
+                          ncbi_keyfile, staging=staging, batch=batch_uploads,
+                          verify=ssh_session.fsize, journal_dir=products_dir,
+                          index=index, accessions=acc_index, manifest=store,
+                          cache=cache, policy=policy)
 
     cached_dir_16s = dirname(cached_16s_files[0]) if cached_16s_files else products_dir
     cached_dir_wgs = dirname(cached_wgs_files[0]) if cached_wgs_files else products_dir
     six_files = set(map(basename, cached_16s_files))
     wgs_files = set(map(basename, cached_wgs_files))
     
-    def _du(url, local_dir, local_cached, remote_size, namespace):
+    def _du(job):
         def _actually_du():
-            srv, remote_path = parse_fasp_url(url)
-            bn = basename(remote_path)
-            local_file = join(local_dir, bn)
-            skip = (bn in local_cached 
-                    and os.stat(local_file).st_size == remote_size)
-            if skip == False:
-                ret = asp.download_file(srv, dcc_user, dcc_pw, 
-                                        remote_path, local_dir)
-                if not ret:
-                    raise Exception("Download failed: "+url)
-            to_rm, files_to_upload = untar(local_file)
-            for i, f in enumerate(files_to_upload):
-                new_f = addtag(f, namespace)
-                os.rename(f, new_f)
-                files_to_upload[i] = new_f
-            names_sizes = [(basename(f), os.stat(f).st_size) 
-                           for f in files_to_upload]
-            for f in files_to_upload:
-                ret = asp.upload_file(ncbi_srv, ncbi_user, None, f,
-                                      ncbi_path, keyfile=ncbi_keyfile)
-            with open(local_file+"."+namespace+".complete", 'w') as f:
-                for name_size in names_sizes:
-                    print >> f, "\t".join(map(str, name_size))
-            for f in reversed(to_rm):
-                try:
-                    os.rmdir(f) if os.path.isdir(f) else os.remove(f)
-                except:
-                    print >> sys.stderr, "Unable to remove "+f
+            transfers.run(job)
         return _actually_du
 
     complete_16s, complete_wgs, tasks = [],[], []
+    jobs_checks = []
                 
     args = ([six_files, cached_dir_16s, recs_16s, complete_16s, "16s"],
             [wgs_files, cached_dir_wgs, recs_wgs, complete_wgs, "wgs"])
     for local_files, local_dir, recs, result_container, namespace in args:
         for seq in _sequences(recs):
             remote_fname = basename(seq.urls[0])
-            target = join(local_dir, remote_fname)
             
             if not seq.urls:
                 raise Exception("Sequence ID %s has no urls"%(seq.id))
+            job = Job(seq.urls[0], local_dir, local_files, seq.size,
+                      namespace, spuid=seq.id, md5=seq.md5)
+            check = DownUpUpToDate(seq, index, acc_index, store)
+            job.transfers = transfers
+            jobs_checks.append((job, check))
+            result_container.append(job.complete_fname)
+            if pipelined or distributed:
+                continue
             tasks.append(
                 { "name": "serialize:download_upload: "+remote_fname+"."+namespace,
-                  "actions": [_du(seq.urls[0], local_dir, 
-                                  local_files, seq.size, namespace)],
+                  "actions": [_du(job)],
                   "file_dep": [],
-                  "uptodate": [DownUpUpToDate(seq, ssh_session)],
-                  "targets": [target+"."+namespace+".complete"] }
+                  "uptodate": [check],
+                  "targets": [job.complete_fname] }
                 )
-            result_container.append(target+"."+namespace+".complete")
+
+    if store is not None:
+        imported = store.import_complete(complete_16s+complete_wgs)
+        if imported:
+            print >> sys.stderr, "Imported %i .complete files into %s"%(
+                imported, store.fname)
+
+    if (pipelined or distributed) and shared is not None:
+        shared.setdefault("jobs", []).extend(jobs_checks)
+    elif distributed and jobs_checks:
+        tasks.append(_queue_task(
+            "serialize:download_upload:queue: "+ncbi_path,
+            queue or WorkQueue(queue_fname, queue_lease, queue_attempts),
+            jobs_checks, queue_poll, queue_timeout))
+    elif pipelined and jobs_checks:
+        scheduler = StagedScheduler(transfers, download_workers,
+                                    extract_workers, upload_workers,
+                                    queue_size)
+        tasks.append(_pipeline_task(
+            "serialize:download_upload:pipeline: "+ncbi_path,
+            scheduler, jobs_checks))
+    elif staging is not None and jobs_checks:
+        tasks.append(_clear_task(
+            "serialize:download_upload:clear: "+ncbi_path, jobs_checks))
     return complete_16s, complete_wgs, tasks
+
+
+def _clear_current(jobs_checks, outdated):
+    """Delete the staged tarballs left over from transfers that are up
+    to date"""
+    for job, check in jobs_checks:
+        if job.complete_fname not in outdated:
+            job.transfers.clear(job)
+
+
+def _clear_task(name, jobs_checks):
+    all_checks = AllUpToDate([ (j.complete_fname, c)
+                               for j, c in jobs_checks ])
+    def _clear():
+        _clear_current(jobs_checks, set(all_checks.outdated()))
+    return { "name": name,
+             "actions": [_clear],
+             "file_dep": [ j.complete_fname for j, _ in jobs_checks ],
+             "uptodate": [False],
+             "targets": [] }
+
+
+def _pipeline_task(name, scheduler, jobs_checks):
+    all_checks = AllUpToDate([ (j.complete_fname, c)
+                               for j, c in jobs_checks ])
+    def _pipeline():
+        outdated = set(all_checks.outdated())
+        _clear_current(jobs_checks, outdated)
+        todo = [ job for job, check in jobs_checks
+                 if job.complete_fname in outdated ]
+        print >> sys.stderr, "%i of %i transfers out of date"%(
+            len(todo), len(jobs_checks))
+        scheduler.run(todo)
+    return { "name": name,
+             "actions": [_pipeline],
+             "file_dep": [],
+             "uptodate": [all_checks],
+             "targets": [ j.complete_fname for j, _ in jobs_checks ] }
+
+
+def _queue_task(name, queue, jobs_checks, poll=5, timeout=None):
+    all_checks = AllUpToDate([ (j.complete_fname, c)
+                               for j, c in jobs_checks ])
+    def _distribute():
+        outdated = set(all_checks.outdated())
+        _clear_current(jobs_checks, outdated)
+        todo = dict( (job.complete_fname, job) for job, check in jobs_checks
+                     if job.complete_fname in outdated )
+        print >> sys.stderr, "%i of %i transfers out of date; queued in %s"%(
+            len(todo), len(jobs_checks), queue.fname)
+        queue.publish( (key, workqueue.payload(job))
+                       for key, job in todo.iteritems() )
+        failed = list()
+        for item in queue.wait(todo.keys(), poll, timeout=timeout):
+            job = todo[item.key]
+            if item.state != "done":
+                print >> sys.stderr, "Transfer of %s failed: %s"%(
+                    job.url, item.message)
+                failed.append(job)
+                continue
+            t = job.transfers
+            for row in item.result:
+                t.index.record(row[0], row[1])
+            t.record(job, item.result)
+            t.index.save()
+        if failed:
+            raise Exception("%i of %i transfers failed: %s"%(
+                len(failed), len(todo),
+                ", ".join(job.url for job in failed)))
+    return { "name": name,
+             "actions": [_distribute],
+             "file_dep": [],
+             "uptodate": [all_checks],
+             "targets": [ j.complete_fname for j, _ in jobs_checks ] }
+
+
+def transfer_all(shared, download_workers=2, extract_workers=1,
+                 upload_workers=4, queue_size=4, queue_fname=None,
+                 queue_lease=600, queue_attempts=3, queue_poll=5,
+                 queue_timeout=3600, queue=None):
+    """Run the transfers that :py:func:`download_upload` calls added to
+    ``shared`` through one :py:class:`dcc_sra.transfer.StagedScheduler`,
+    so they share its workers whichever submission they belong to. With
+    ``queue_fname`` or ``queue``, publish them all to one
+    :py:class:`dcc_sra.workqueue.WorkQueue` instead.
+
+    """
+    jobs_checks = shared.get("jobs", [])
+    if not jobs_checks:
+        return
+    if queue_fname or queue is not None:
+        yield _queue_task("serialize:download_upload:queue:all",
+                          queue or WorkQueue(queue_fname, queue_lease,
+                                             queue_attempts),
+                          jobs_checks, queue_poll, queue_timeout)
+        return
+    scheduler = StagedScheduler(jobs_checks[0][0].transfers, download_workers,
+                                extract_workers, upload_workers, queue_size)
+    yield _pipeline_task("serialize:download_upload:pipeline:all",
+                         scheduler, jobs_checks)
         
 
 def serialize(session, study, records_16s, files_16s, records_wgs, files_wgs,
               unsequenced_records, submission_fname, ready_fname, products_dir, 
               dcc_user, dcc_pw, study_id=None, release_date=None, 
-              bioproject_id=None):
+              bioproject_id=None, workers=1, incremental=False,
+              manifest_fname=None):
     """
     Download raw sequence files and serialize metadata into xml for a
     cutlass.Study
@@ -169,38 +406,101 @@ def serialize(session, study, records_16s, files_16s, records_wgs, files_wgs,
     :param dcc_pw: String; the password used for the cutlass.iHMPSession
 
     :param study_id: String; OSDF-given ID for the study you want to serialize
+
+    :param workers: Integer; number of processes to build the
+    BioSample and SRA Actions with
+
+    :param incremental: Boolean; if True, leave out the Actions for
+    objects NCBI already accepted, unless they changed since. Accepted
+    objects are looked up in the ledger and the accession index kept in
+    ``products_dir``, and in the accession tags of the OSDF nodes.
+    Objects the ledger has no fingerprint for are left out the first
+    time, and their fingerprint is added to the ledger for later runs
+    to compare against.
+
+    :param manifest_fname: String; if given, read the members of each
+    tarball from this :py:class:`dcc_sra.manifest.ManifestStore`
+    rather than from its ``.complete`` file
     """
 
 
     def _write_xml():
         tardict = {}
+        store = ManifestStore(manifest_fname) if manifest_fname else None
         for complete_fname in chain(files_16s, files_wgs):
             seqtype = re.sub(r'.*\.(...)\.complete$', r'\1', complete_fname)
             key = (basename(re.sub(r'\....\.complete$', '', complete_fname)), seqtype)
-            tardict[key] = _completeparse(complete_fname)
+            members = store and store.members(complete_fname)
+            if members is None:
+                members = _completeparse(complete_fname)
+            tardict[key] = members
+        if store is not None:
+            store.close()
         samples = list(records_16s)+list(records_wgs)+list(unsequenced_records)
-        xml = to_xml(study, samples, tardict, release_date, bioproject_id)
-        indent(xml)
-        et = ET.ElementTree(xml)
-        et.write(submission_fname)
-
+        known, baseline, acc_index, l = None, None, None, None
+        if incremental:
+            known, baseline = dict(), list()
+            acc_fname = join(products_dir, accessions.FNAME)
+            if exists(acc_fname):
+                acc_index = AccessionIndex(acc_fname)
+                known.update(acc_index.known())
+            l = Ledger(join(products_dir, ledger.FNAME))
+            known.update(l.known())
+        with open(submission_fname+".tmp", 'wb') as f:
+            emitted = write_xml(f, study, samples, tardict, release_date,
+                                bioproject_id, workers=workers, known=known,
+                                baseline=baseline)
+        write_fingerprints(submission_fname+".fingerprints", emitted)
+        if baseline:
+            with ledger.locked(l.fname) as l:
+                for spuid, target_db, fp in baseline:
+                    acc = acc_index and acc_index.accession(spuid)
+                    l.baseline(spuid, target_db, fp, acc)
+            print >> sys.stderr, "Fingerprinted %i accepted objects"\
+                " new to the ledger"%(len(baseline))
+        if acc_index is not None:
+            acc_index.close()
+        if incremental and not emitted:
+            os.remove(submission_fname+".tmp")
+            for f in (submission_fname, ready_fname):
+                if exists(f):
+                    os.remove(f)
+            print >> sys.stderr, "Nothing new or changed to submit;"\
+                " not writing "+submission_fname
+            return
+        os.rename(submission_fname+".tmp", submission_fname)
+        if incremental:
+            # a new difference to submit; upload it even if the last
+            # one was uploaded
+            for f in (submission_fname, ready_fname):
+                if exists(f+".complete"):
+                    os.remove(f+".complete")
+        print >> sys.stderr, "Wrote %i Actions to %s"%(len(emitted),
+                                                        submission_fname)
+
+    def _ready():
+        if exists(submission_fname):
+            open(ready_fname, 'w').close()
+
+    xml_task = "serialize:xml: "+submission_fname
     yield {
-        "name": "serialize:xml: "+submission_fname,
+        "name": xml_task,
         "actions": [_write_xml],
         "file_dep": list(files_16s)+list(files_wgs),
-        "targets": [submission_fname]
+        "targets": [submission_fname, submission_fname+".fingerprints"]
     }
 
     yield {
         "name": "serialize:ready_file: "+ready_fname,
-        "actions": [lambda *a, **kw: open(ready_fname, 'w').close()],
+        "actions": [_ready],
         "file_dep": [],
+        "task_dep": [xml_task],
         "targets": [ready_fname]
     }
 
 
 def kickoff(sub_fname, ready_fname, complete_fnames, keyfile,
-            remote_path, remote_srv, user, products_dir):
+            remote_path, remote_srv, user, products_dir, shard=None):
     """Upload raw sequence files and xml.
 
     :param keyfile: String; absolute filepath to private SSH keyfile for
@@ -214,10 +514,20 @@ def kickoff(sub_fname, ready_fname, complete_fnames, keyfile,
 
     :param user: String; username used to access NCBI's submission server
 
+    :param shard: String; name of the shard these files belong to, if
+    the study is split into several submissions
+
     """
+    prefix = shard+"/" if shard else ""
 
     def _upload(local_fname, complete_fname, blithely=False):
         def _u():
+            if not exists(local_fname):
+                # an incremental run with nothing to submit
+                print >> sys.stderr, "No %s to upload; skipping it"%(
+                    local_fname)
+                open(complete_fname, 'w').close()
+                return True
             ret = asp.upload_file(remote_srv, user, None, local_fname,
                                   remote_path, keyfile=keyfile)
             if blithely or ret:
@@ -226,14 +536,14 @@ def kickoff(sub_fname, ready_fname, complete_fnames, keyfile,
         return _u
 
     yield {
-        "name": "upload: "+basename(sub_fname),
+        "name": "upload: "+prefix+basename(sub_fname),
         "actions": [_upload(sub_fname, sub_fname+".complete")],
         "file_dep": complete_fnames,
         "targets": [sub_fname+".complete"]
     }
 
     yield {
-        "name": "upload: "+basename(ready_fname),
+        "name": "upload: "+prefix+basename(ready_fname),
         "actions": [_upload(ready_fname, ready_fname+".complete", True)],
         "file_dep": complete_fnames+[sub_fname+".complete"],
         "targets": [ready_fname+".complete"]
@@ -241,31 +551,67 @@ def kickoff(sub_fname, ready_fname, complete_fnames, keyfile,
 
 
 def report(session, ready_complete_fname, user, remote_srv,
-           remote_path, keyfile):
+           remote_path, keyfile, fingerprints_fname=None, ledger_fname=None,
+           shard=None, interval=0.5, max_interval=60, deadline=20*60,
+           until_final=False, osdf_workers=8, tagged=None,
+           accessions_fname=None):
+    """Download NCBI's reports on a submission as they appear, and
+    update OSDF (and the ledger, if given) from each one in turn.
+
+    :keyword interval: Number; seconds between the first looks for new
+    reports. See :py:class:`dcc_sra.watch.ReportWatcher` for how it
+    backs off to ``max_interval``.
+
+    :keyword deadline: Number; seconds to wait for reports
+
+    :keyword until_final: Boolean; keep watching after the first
+    reports arrive, until NCBI reports a final status.
+
+    :keyword tagged: Dictionary; tags the OSDF nodes are known to
+    have. See :py:func:`dcc_sra.update.tag_nodes`.
+
+    :keyword accessions_fname: String; path to the
+    :py:class:`dcc_sra.accessions.AccessionIndex` to save statuses to
+
+    """
     reports_dir = dirname(ready_complete_fname)
+    def _handle(report_fname):
+        # merge every report so far, in case an earlier one was never
+        # applied; nodes already tagged are skipped without a lookup
+        report_fnames = sorted([ join(reports_dir, n)
+                                 for n in os.listdir(reports_dir)
+                                 if REPORT_RE.search(n) ],
+                               key=lambda n: reportnum(basename(n)))
+        acc_index = None
+        if accessions_fname:
+            acc_index = AccessionIndex(accessions_fname)
+        update_osdf_from_reports(session, report_fnames, osdf_workers,
+                                 tagged, acc_index)
+        if acc_index is not None:
+            acc_index.close()
+        if fingerprints_fname and ledger_fname:
+            with ledger.locked(ledger_fname) as l:
+                l.update_from_reports(report_fnames, fingerprints_fname)
+
     def _download():
+        if not exists(re.sub(r'\.complete$', '', ready_complete_fname)):
+            print >> sys.stderr, "Nothing was submitted; not waiting for"\
+                " reports"
+            return
         c = ssh.SSHConnection(user, remote_srv, keyfile, remote_path)
-        for _ in range(60*20*2): # 20 minutes in half-seconds
-            report_fnames = [basename(n) for n in c.files()
-                             if re.search(r'report\.[\d.]*xml', n)
-                             and not exists(join(reports_dir, basename(n)))]
-            if report_fnames:
-                break
-            else:
-                time.sleep(.5)
-        for n in report_fnames:
-            if exists(join(reports_dir, n)):
-                continue
-            asp.download_file(remote_srv, user, None, join(remote_path, n),
-                              reports_dir, keyfile=keyfile)
-        if not report_fnames:
+        watcher = ReportWatcher(c, reports_dir, interval, max_interval,
+                                deadline, until_final)
+        status = watcher.watch(_handle)
+        if status is None:
             print >> sys.stderr, "Timed out waiting for report xml files."
             return False
-        most_recent_report = max(report_fnames, key=reportnum)
-        update_osdf_from_report(session, join(reports_dir, most_recent_report))
+        if until_final and status not in FINAL:
+            print >> sys.stderr, "Timed out waiting for a final report;"\
+                " last status was "+status
+            return False
 
     yield {
-        "name": "report:get_reports",
+        "name": "report:get_reports"+(": "+shard if shard else ""),
         "actions": [_download],
         "file_dep": [ready_complete_fname],
         "uptodate": [False],
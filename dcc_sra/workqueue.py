@@ -0,0 +1,396 @@
+import os
+import sys
+import time
+import json
+import socket
+import sqlite3
+import threading
+from os.path import join
+from os.path import dirname
+from os.path import basename
+from os.path import exists
+from collections import namedtuple
+from contextlib import contextmanager
+
+from . import ssh
+from .transfer import Job
+from .transfer import Transfers
+
+FNAME = "work_queue.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    key      TEXT PRIMARY KEY,
+    payload  TEXT,
+    state    TEXT,
+    owner    TEXT,
+    expires  REAL,
+    attempts INTEGER DEFAULT 0,
+    result   TEXT,
+    message  TEXT
+);
+"""
+
+# states a job stays in until a worker is done with it
+OPEN = ("pending", "leased")
+
+Item = namedtuple("Item", "key state result message")
+
+
+class WorkQueue(object):
+    """Transfer jobs shared between a coordinator and any number of
+    worker processes, in a SQLite database on storage they can all
+    reach.
+
+    The coordinator :py:meth:`publish`es jobs. A worker
+    :py:meth:`claim`s one at a time, which leases it for ``lease``
+    seconds, and keeps the lease with :py:meth:`renew` while it works.
+    A job whose lease runs out goes to the next worker to ask, so a
+    worker that dies only costs the time left on its lease. A job is
+    failed for good once it failed or lost its lease ``max_attempts``
+    times.
+
+    A queue on ``:memory:`` lives only in this object, so to use one in
+    place of the shared file, hand the same :py:class:`WorkQueue` to
+    the coordinator and the workers.
+
+    """
+
+    def __init__(self, fname, lease=600, max_attempts=3):
+        self.fname = fname
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(fname, timeout=60, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+
+    @contextmanager
+    def _transaction(self):
+        # take the write lock up front, so two workers can't both
+        # read a job as free and then both lease it
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+
+    def publish(self, items):
+        """Queue jobs, replacing any earlier run of the same job that
+        isn't leased
+
+        :param items: Iterable of tuples; ``(key, payload)``, payload
+        being a JSON-serializable dictionary
+
+        """
+        with self._transaction():
+            for key, payload in items:
+                data = json.dumps(payload, sort_keys=True)
+                self.db.execute(
+                    "INSERT OR IGNORE INTO jobs (key, payload, state)"
+                    " VALUES (?, ?, 'pending')", (key, data))
+                self.db.execute(
+                    "UPDATE jobs SET payload = ?, state = 'pending',"
+                    " owner = NULL, expires = NULL, attempts = 0,"
+                    " result = NULL, message = NULL"
+                    " WHERE key = ? AND state != 'leased'", (data, key))
+
+
+    def claim(self, owner):
+        """Lease the next free job to ``owner``
+
+        :returns: Tuple; ``(key, payload)``, or None if no job is free
+
+        """
+        now = time.time()
+        with self._transaction():
+            while True:
+                row = self.db.execute(
+                    "SELECT key, payload, attempts FROM jobs"
+                    " WHERE state = 'pending'"
+                    " OR (state = 'leased' AND expires < ?)"
+                    " ORDER BY rowid LIMIT 1", (now,)).fetchone()
+                if row is None:
+                    return None
+                key, payload, attempts = row
+                if attempts < self.max_attempts:
+                    break
+                self.db.execute(
+                    "UPDATE jobs SET state = 'failed', message = ?"
+                    " WHERE key = ?",
+                    ("Lease expired after %i attempts"%(attempts), key))
+            self.db.execute(
+                "UPDATE jobs SET state = 'leased', owner = ?, expires = ?,"
+                " attempts = attempts + 1 WHERE key = ?",
+                (owner, now+self.lease, key))
+        return key, json.loads(payload)
+
+
+    def renew(self, key, owner):
+        """:returns: Boolean; False if ``owner`` no longer holds the
+        lease on ``key``"""
+        with self._transaction():
+            cur = self.db.execute(
+                "UPDATE jobs SET expires = ? WHERE key = ? AND owner = ?"
+                " AND state = 'leased'", (time.time()+self.lease, key, owner))
+            return cur.rowcount == 1
+
+
+    def complete(self, key, result):
+        """Mark a leased job done. Whoever finished it first wins, even
+        if its lease ran out in the meantime."""
+        with self._transaction():
+            self.db.execute(
+                "UPDATE jobs SET state = 'done', result = ?, expires = NULL"
+                " WHERE key = ? AND state = 'leased'",
+                (json.dumps(result), key))
+
+
+    def fail(self, key, owner, message):
+        """Give a job back after a failed attempt. It's free again for
+        any worker unless it ran out of attempts."""
+        with self._transaction():
+            self.db.execute(
+                "UPDATE jobs SET state = CASE WHEN attempts < ?"
+                " THEN 'pending' ELSE 'failed' END, owner = NULL,"
+                " expires = NULL, message = ?"
+                " WHERE key = ? AND owner = ? AND state = 'leased'",
+                (self.max_attempts, message, key, owner))
+
+
+    def items(self, keys=None):
+        """:returns: Dictionary; key to :py:class:`Item` for every job,
+        or just the ones in ``keys``"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT key, state, result, message FROM jobs").fetchall()
+        keys = set(keys) if keys is not None else None
+        return dict(
+            (key, Item(key, state, json.loads(result) if result else None,
+                       message))
+            for key, state, result, message in rows
+            if keys is None or key in keys )
+
+
+    def open(self):
+        """:returns: Integer; the number of jobs pending or leased"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT count(*) FROM jobs WHERE state IN (?, ?)",
+                OPEN).fetchone()[0]
+
+
+    def _activity(self):
+        # leases move forward whenever a job is claimed or renewed
+        with self.lock:
+            return self.db.execute(
+                "SELECT max(expires) FROM jobs WHERE state = 'leased'"
+                ).fetchone()[0]
+
+
+    def wait(self, keys, interval=5, max_interval=60, timeout=None):
+        """Hand over each of the jobs in ``keys`` as it's done or
+        failed. Looks every ``interval`` seconds at first, and half as
+        often after each look that turns up nothing, up to once every
+        ``max_interval`` seconds.
+
+        :keyword timeout: Number; seconds to go without a job finishing,
+        being claimed or having its lease renewed, i.e. without any
+        sign of a live worker, before giving up. None waits for as long
+        as it takes.
+
+        :returns: Generator of :py:class:`Item`
+
+        """
+        left, delay = set(keys), interval
+        activity, last_seen = None, time.time()
+        while left:
+            finished = [ item for item in self.items(left).itervalues()
+                         if item.state not in OPEN ]
+            for item in finished:
+                left.discard(item.key)
+                yield item
+            if not left:
+                break
+            now, latest = time.time(), self._activity()
+            if finished or latest != activity:
+                activity, last_seen = latest, now
+            elif timeout is not None and now - last_seen > timeout:
+                raise Exception("No worker took up or renewed a job in %s"
+                                " for %g seconds; %i jobs left"%(
+                                    self.fname, now - last_seen, len(left)))
+            delay = interval if finished else min(delay*2, max_interval)
+            time.sleep(delay)
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def payload(job):
+    """What a worker needs to know to run ``job`` somewhere else. DCC
+    credentials are left out; each worker brings its own."""
+    t = job.transfers
+    cached = None
+    if basename(job.local_file) in job.local_cached:
+        cached = job.local_file
+    return { "url": job.url, "size": job.size, "md5": job.md5,
+             "namespace": job.namespace, "spuid": job.spuid,
+             "cached": cached, "ncbi_srv": t.ncbi_srv,
+             "ncbi_path": t.ncbi_path, "ncbi_user": t.ncbi_user,
+             "ncbi_keyfile": t.ncbi_keyfile, "batch": t.batch }
+
+
+class WorkerTransfers(Transfers):
+    """:py:class:`dcc_sra.transfer.Transfers` that keeps the
+    ``.complete`` manifest of a job for the coordinator to write,
+    instead of writing it"""
+
+    def record(self, job, rows):
+        job.rows = rows
+
+
+class Worker(object):
+    """Claim jobs from a :py:class:`WorkQueue` and run them here:
+    download each tarball from the DCC to ``work_dir``, extract it, and
+    upload its members to NCBI. A tarball the coordinator has cached is
+    used in place if this host can see it.
+
+    :keyword keyfile: String; NCBI key file to use instead of the
+    coordinator's, for hosts that keep it somewhere else
+
+    :keyword ssh_port: Integer; port to reach the NCBI server's SFTP
+    on from this host
+
+    :keyword staging: :py:class:`dcc_sra.staging.StagingArea`
+
+    :keyword cache: :py:class:`dcc_sra.cache.TarballCache`
+
+    :keyword policy: :py:class:`dcc_sra.policy.Policy`
+
+    """
+
+    def __init__(self, queue, dcc_user, dcc_pw, work_dir, keyfile=None,
+                 owner=None, staging=None, cache=None, policy=None,
+                 ssh_port=22):
+        self.queue = queue
+        self.dcc_user = dcc_user
+        self.dcc_pw = dcc_pw
+        self.work_dir = work_dir
+        self.keyfile = keyfile
+        self.ssh_port = ssh_port
+        self.owner = owner or "%s:%i"%(socket.gethostname(), os.getpid())
+        self.staging = staging
+        self.cache = cache
+        self.policy = policy
+        self.lock = threading.Lock()
+        self._all_transfers = dict()
+        self.done = self.failed = 0
+
+
+    def _transfers(self, p):
+        key = (p['ncbi_srv'], p['ncbi_path'], p['ncbi_user'],
+               self.keyfile or p['ncbi_keyfile'], p['batch'])
+        with self.lock:
+            if key not in self._all_transfers:
+                srv, path, user, keyfile, batch = key
+                conn = ssh.SSHConnection(user, srv, keyfile, path,
+                                         port=self.ssh_port)
+                self._all_transfers[key] = WorkerTransfers(
+                    self.dcc_user, self.dcc_pw, srv, path, user, keyfile,
+                    staging=self.staging, batch=batch, verify=conn.fsize,
+                    journal_dir=self.work_dir, policy=self.policy,
+                    cache=self.cache)
+            return self._all_transfers[key]
+
+
+    def _job(self, p):
+        cached = p['cached']
+        if cached and exists(cached) and os.stat(cached).st_size == p['size']:
+            local_dir, local_cached = dirname(cached), set([basename(cached)])
+        else:
+            local_dir, local_cached = self.work_dir, set()
+        job = Job(p['url'], local_dir, local_cached, p['size'],
+                  p['namespace'], spuid=p['spuid'], md5=p['md5'])
+        if local_dir != self.work_dir:
+            # extract here, not next to the coordinator's tarball
+            job.stage_dir = join(self.work_dir, basename(job.stage_dir))
+        job.rows = None
+        return job
+
+
+    def _heartbeat(self, key, owner, stop):
+        while not stop.wait(self.queue.lease/3.0):
+            if not self.queue.renew(key, owner):
+                print >> sys.stderr, "Lost the lease on "+key
+                return
+
+
+    def work_one(self, owner):
+        """Claim one job and run it
+
+        :returns: Boolean; False if there was no job to claim
+
+        """
+        claimed = self.queue.claim(owner)
+        if claimed is None:
+            return False
+        key, p = claimed
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat,
+                                     args=(key, owner, stop))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            job = self._job(p)
+            self._transfers(p).run(job)
+        except Exception as e:
+            print >> sys.stderr, "Transfer of %s failed: %s"%(p['url'], e)
+            self.queue.fail(key, owner, str(e))
+            with self.lock:
+                self.failed += 1
+        else:
+            self.queue.complete(key, job.rows)
+            with self.lock:
+                self.done += 1
+        finally:
+            stop.set()
+            heartbeat.join()
+        return True
+
+
+    def _loop(self, owner, poll, wait):
+        while True:
+            if self.work_one(owner):
+                continue
+            if not wait and not self.queue.open():
+                return
+            time.sleep(poll)
+
+
+    def run(self, threads=1, poll=5, wait=False):
+        """Work through the queue with ``threads`` jobs at a time
+
+        :keyword wait: Boolean; if True, keep waiting for jobs to be
+        published. Otherwise, stop once no job is pending or leased.
+
+        """
+        workers = [ threading.Thread(target=self._loop,
+                                     args=("%s/%i"%(self.owner, i),
+                                           poll, wait))
+                    for i in range(max(1, threads)) ]
+        for t in workers:
+            t.daemon = True
+            t.start()
+        for t in workers:
+            # join with a timeout so ^C still gets through
+            while t.is_alive():
+                t.join(1)
+        print >> sys.stderr, "Worker %s: %i transfers done, %i failed"%(
+            self.owner, self.done, self.failed)
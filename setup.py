@@ -19,7 +19,9 @@ setup(
     ],
     entry_points= {
         'anadama.pipeline': [
-            ".dcc_sra = dcc_sra.pipeline:DCCSRAPipeline"
+            ".dcc_sra = dcc_sra.pipeline:DCCSRAPipeline",
+            ".dcc_sra_batch = dcc_sra.pipeline:DCCSRABatchPipeline",
+            ".dcc_sra_worker = dcc_sra.pipeline:DCCSRAWorkerPipeline"
         ]
     }
 )
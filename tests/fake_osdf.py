@@ -0,0 +1,175 @@
+"""A stand-in OSDF server for tests: enough of OSDF's REST API for the
+``get_node``, ``edit_node``, ``validate_node`` and ``oql_query`` calls
+of ``osdf.OSDF``, over an in-memory set of documents."""
+
+import re
+import json
+import threading
+import SocketServer
+import BaseHTTPServer
+from collections import defaultdict
+
+import osdf
+
+NODE_TYPE_RE = re.compile(r'"([^"]+)"\[node_type\]')
+LINKAGE_RE = re.compile(r'"([^"]+)"\[linkage\.(\w+)\]')
+
+
+def _doc(node_id, node_type, meta=None, **linkage):
+    m = {"tags": []}
+    m.update(meta or {})
+    return { "id": node_id, "node_type": node_type, "ver": 1,
+             "meta": m, "linkage": dict((k, [v]) for k, v in
+                                        linkage.iteritems()) }
+
+
+def study_docs(subjects=3, visits=2, samples=4, study_id="study"):
+    """:returns: Dictionary; ID to document for a study with
+    ``subjects`` subjects of ``visits`` visits of ``samples`` samples
+    each. Every sample has a 16S and a WGS prep, and every 16S prep a
+    sequence set. WGS preps cycle through none, a raw sequence set, a
+    private one, and a raw set along with a microbial transcriptomics
+    one."""
+    docs = { study_id: _doc(study_id, "study", {"name": "Test study"}) }
+    def add(doc):
+        docs[doc['id']] = doc
+    for a in range(subjects):
+        su = "su%d"%(a)
+        add(_doc(su, "subject", participates_in=study_id))
+        for b in range(visits):
+            v = "%s_v%d"%(su, b)
+            add(_doc(v, "visit", by=su))
+            for c in range(samples):
+                sa = "%s_sa%d"%(v, c)
+                add(_doc(sa, "sample", collected_during=v))
+                add(_doc(sa+"_p16", "16s_dna_prep", prepared_from=sa))
+                add(_doc(sa+"_pwgs", "wgs_dna_prep", prepared_from=sa))
+                add(_doc(sa+"_s16", "16s_raw_seq_set",
+                         {"urls": ["fasp://dcc/"+sa+"_s16.tar"],
+                          "size": 1000, "seq_model": "MiSeq"},
+                         sequenced_from=sa+"_p16"))
+                wgs = ([], ["wgs_raw_seq_set"], ["wgs_raw_seq_set_private"],
+                       ["wgs_raw_seq_set",
+                        "microb_transcriptomics_raw_seq_set"])[c % 4]
+                for i, node_type in enumerate(wgs):
+                    seq_id = sa+"_swgs"+("_%d"%(i) if i else "")
+                    add(_doc(seq_id, node_type,
+                             {"urls": ["fasp://dcc/"+seq_id+".tar"],
+                              "size": 2000, "seq_model": "HiSeq"},
+                             sequenced_from=sa+"_pwgs"))
+    return docs
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeOSDF(object):
+    """Serve ``docs`` on a free local port.
+
+    :keyword page_size: Integer; results per page of an OQL query
+
+    :keyword fail_edits: Set of strings; node IDs whose edits fail
+
+    Every request is logged to ``requests`` as ``(method, path)``.
+
+    """
+
+    def __init__(self, docs, page_size=100, fail_edits=()):
+        self.docs = docs
+        self.page_size = page_size
+        self.fail_edits = set(fail_edits)
+        self.requests = list()
+        self.lock = threading.Lock()
+        self._linked = defaultdict(list)
+        for doc in docs.itervalues():
+            for field, parents in doc['linkage'].iteritems():
+                for parent in parents:
+                    self._linked[(doc['node_type'], field, parent)].append(
+                        doc)
+
+
+    def start(self):
+        fake = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+            def _body(self):
+                n = int(self.headers.getheader('content-length') or 0)
+                return self.rfile.read(n)
+            def _reply(self, status, body=""):
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def do_GET(self):
+                self._reply(*fake.handle("GET", self.path))
+            def do_PUT(self):
+                self._reply(*fake.handle("PUT", self.path, self._body()))
+            def do_POST(self):
+                self._reply(*fake.handle("POST", self.path, self._body()))
+
+        self.httpd = _Server(("127.0.0.1", 0), Handler)
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+    def client(self):
+        return osdf.OSDF("127.0.0.1", "test", "test", self.port)
+
+
+    def count(self, method=None):
+        with self.lock:
+            return len([ r for r in self.requests
+                         if method is None or r[0] == method ])
+
+
+    def handle(self, method, path, body=None):
+        with self.lock:
+            self.requests.append((method, path))
+        parts = path.strip("/").split("/")
+        if method == "POST" and parts[:2] == ["nodes", "oql"]:
+            page = int(parts[4]) if len(parts) > 4 else 1
+            return 200, json.dumps(self.query(body, page))
+        if method == "POST" and parts == ["nodes", "validate"]:
+            return 200, ""
+        if parts[0] != "nodes" or len(parts) != 2:
+            return 404, "Not found"
+        node_id = parts[1]
+        if node_id not in self.docs:
+            return 404, "No such node: "+node_id
+        if method == "GET":
+            with self.lock:
+                return 200, json.dumps(self.docs[node_id])
+        if method == "PUT":
+            if node_id in self.fail_edits:
+                return 500, "Edit of %s failed"%(node_id)
+            doc = json.loads(body)
+            with self.lock:
+                doc['ver'] = self.docs[node_id]['ver'] + 1
+                self.docs[node_id] = doc
+            return 200, ""
+        return 405, "Method not allowed"
+
+
+    def query(self, oql, page):
+        node_type = NODE_TYPE_RE.search(oql).group(1)
+        found = dict()
+        for parent, field in LINKAGE_RE.findall(oql):
+            for doc in self._linked.get((node_type, field, parent), []):
+                found[doc['id']] = doc
+        results = [ found[k] for k in sorted(found) ]
+        start = (page-1)*self.page_size
+        page_results = results[start:start+self.page_size]
+        return { "page": page,
+                 "results": page_results,
+                 "result_count": len(page_results),
+                 "search_result_total": len(results) }
@@ -0,0 +1,144 @@
+"""A local SFTP server for tests, serving a directory over paramiko.
+Any user with any key may log in; paths are taken relative to
+``root``."""
+
+import os
+import socket
+import threading
+
+import paramiko
+from paramiko import SFTPServer
+from paramiko import SFTPServerInterface
+from paramiko import SFTPAttributes
+from paramiko import SFTPHandle
+from paramiko import SFTP_OK
+
+
+class _Auth(paramiko.ServerInterface):
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class _Handle(SFTPHandle):
+
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+def _errno(func):
+    def _f(*args):
+        try:
+            return func(*args)
+        except (OSError, IOError) as e:
+            return SFTPServer.convert_errno(e.errno)
+    return _f
+
+
+def _interface(root):
+    class Interface(SFTPServerInterface):
+
+        def _path(self, path):
+            return root + self.canonicalize(path)
+
+        @_errno
+        def list_folder(self, path):
+            ret = list()
+            for name in os.listdir(self._path(path)):
+                attrs = SFTPAttributes.from_stat(
+                    os.lstat(os.path.join(self._path(path), name)))
+                attrs.filename = name
+                ret.append(attrs)
+            return ret
+
+        @_errno
+        def stat(self, path):
+            return SFTPAttributes.from_stat(os.stat(self._path(path)))
+
+        lstat = stat
+
+        @_errno
+        def open(self, path, flags, attr):
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                mode = "wb" if flags & os.O_TRUNC else "r+b"
+                if not os.path.exists(self._path(path)):
+                    mode = "wb"
+            else:
+                mode = "rb"
+            f = open(self._path(path), mode)
+            handle = _Handle(flags)
+            handle.readfile = handle.writefile = f
+            return handle
+
+        @_errno
+        def mkdir(self, path, attr):
+            os.mkdir(self._path(path))
+            return SFTP_OK
+
+        @_errno
+        def remove(self, path):
+            os.remove(self._path(path))
+            return SFTP_OK
+
+    return Interface
+
+
+class SFTPFixture(object):
+    """Serve ``root`` on a free local port.
+
+    ``keyfile`` is a fresh private key to log in with, written to
+    ``key_dir``. ``connections`` counts the SSH connections accepted.
+
+    """
+
+    def __init__(self, root, key_dir):
+        self.root = root.rstrip("/")
+        self.host_key = paramiko.RSAKey.generate(1024)
+        self.keyfile = os.path.join(key_dir, "id_rsa")
+        paramiko.RSAKey.generate(1024).write_private_key_file(self.keyfile)
+        self.connections = 0
+        self.transports = list()
+
+
+    def start(self):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self._accept)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+
+    def _accept(self):
+        interface = _interface(self.root)
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            t = paramiko.Transport(conn)
+            t.add_server_key(self.host_key)
+            t.set_subsystem_handler("sftp", SFTPServer, interface)
+            t.start_server(server=_Auth())
+            self.transports.append(t)
+
+
+    def drop(self):
+        """Close every connection, as if the network went away"""
+        for t in self.transports:
+            t.close()
+
+
+    def stop(self):
+        self.drop()
+        self.sock.close()
@@ -0,0 +1,107 @@
+import os
+import sys
+import time
+import unittest
+from collections import defaultdict
+
+from dcc_sra import bulk
+from dcc_sra.traverse import StudyTraversal
+
+from fake_osdf import FakeOSDF
+from fake_osdf import study_docs
+
+
+def _expected(docs, study_id="study"):
+    """The IDs of the records a walk of ``docs`` should give, joined
+    straight from their linkage. Every node linked to a prep counts as
+    one of its sequence sets, whatever its type."""
+    children = defaultdict(list)
+    for doc in docs.itervalues():
+        for parents in doc['linkage'].itervalues():
+            for parent in parents:
+                children[parent].append(doc)
+    def _kids(node_id, node_type=None):
+        return sorted( d['id'] for d in children[node_id]
+                       if node_type is None or d['node_type'] == node_type )
+    ret = list(), list()
+    for subject in _kids(study_id):
+        for visit in _kids(subject):
+            for sample in _kids(visit):
+                for records, prep_type in zip(ret, ("16s_dna_prep",
+                                                    "wgs_dna_prep")):
+                    records.append((sample, [
+                        (prep, seq) for prep in _kids(sample, prep_type)
+                        for seq in _kids(prep) ]))
+    return ret
+
+
+def _ids(records):
+    return [ (r.sample.id, [ (p.prep.id, p.seq.id) for p in r.prepseqs ])
+             for r in records ]
+
+
+class TestBulkLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeOSDF(study_docs(4, 3, 5), page_size=7).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_same_records_as_linkage(self):
+        expected = _expected(self.server.docs)
+        osdf = self.server.client()
+        study = bulk.BulkLoader(osdf, batch_size=10, workers=4).load("study")
+        got = StudyTraversal(workers=4).run(study)
+        self.assertEqual(_ids(got[0]), expected[0])
+        self.assertEqual(_ids(got[1]), expected[1])
+        self.assertEqual(len(got[0]), 4*3*5)
+        self.assertTrue(all(len(r.prepseqs) == 1 for r in got[0]))
+        # three of the 5 samples per visit have WGS sets, one of them two
+        self.assertEqual(sum(len(r.prepseqs) for r in got[1]), 4*3*4)
+
+    def test_request_count(self):
+        loader = bulk.BulkLoader(self.server.client(), batch_size=10,
+                                 workers=4)
+        loader.load("study")
+        self.assertEqual(loader.requests, self.server.count())
+        # 60 samples in batches of 10 with 7 results a page is the
+        # biggest level: 6 batches of at most 20 results, 3 pages each
+        self.assertTrue(loader.requests < 7*(6*3), loader.requests)
+
+    def test_missing_study(self):
+        loader = bulk.BulkLoader(self.server.client())
+        self.assertRaises(Exception, loader.load, "no_such_study")
+
+    def test_no_total(self):
+        class NoTotal(object):
+            def oql_query(self, namespace, query, page=1):
+                return {"results": [{"id": "a"}], "result_count": 1}
+        loader = bulk.BulkLoader(NoTotal())
+        self.assertRaises(Exception, loader._query, '"visit"[node_type]')
+
+
+@unittest.skipUnless(os.environ.get("DCC_SRA_BENCH"),
+                     "set DCC_SRA_BENCH=1 to load a 10k sample study")
+class TestBulkLoaderLarge(unittest.TestCase):
+
+    def test_large_study(self):
+        # 50 subjects * 20 visits * 10 samples
+        docs = study_docs(50, 20, 10)
+        server = FakeOSDF(docs, page_size=1000).start()
+        try:
+            loader = bulk.BulkLoader(server.client(), batch_size=100,
+                                     workers=8)
+            start = time.time()
+            recs_16s, recs_wgs = StudyTraversal(8).run(loader.load("study"))
+            secs = time.time() - start
+        finally:
+            server.stop()
+        self.assertEqual(len(recs_16s), 10000)
+        self.assertEqual(loader.requests, server.count())
+        print >> sys.stderr, ("\n%i nodes, %i samples: %i requests, %.2fs"%(
+            len(docs), len(recs_16s), loader.requests, secs))
+
+
+if __name__ == '__main__':
+    unittest.main()
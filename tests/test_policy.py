@@ -0,0 +1,143 @@
+import time
+import threading
+import unittest
+
+from dcc_sra.policy import CircuitBreaker
+from dcc_sra.policy import Policy
+
+
+class Flaky(object):
+    """Fails the first ``failures`` calls, then returns True"""
+
+    def __init__(self, failures, exc=False):
+        self.failures = failures
+        self.exc = exc
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            if self.exc:
+                raise IOError("injected failure")
+            return False
+        return True
+
+
+class TestPolicy(unittest.TestCase):
+
+    def test_retries_until_success(self):
+        p = Policy(retries=3, backoff=0, breaker_threshold=0)
+        for exc in (False, True):
+            f = Flaky(3, exc)
+            self.assertTrue(p.call("srv", "Flaky", f))
+            self.assertEqual(f.calls, 4)
+
+    def test_gives_up(self):
+        p = Policy(retries=2, backoff=0, breaker_threshold=0)
+        f = Flaky(5)
+        self.assertRaises(Exception, p.call, "srv", "Flaky", f)
+        self.assertEqual(f.calls, 3)
+
+    def test_delay_bounds(self):
+        p = Policy(backoff=2, max_backoff=10)
+        for attempt in range(8):
+            d = p.delay(attempt)
+            self.assertTrue(0 <= d <= min(10, 2*2**attempt), (attempt, d))
+
+    def test_breaker_per_endpoint(self):
+        p = Policy()
+        self.assertTrue(p.breaker("a") is p.breaker("a"))
+        self.assertFalse(p.breaker("a") is p.breaker("b"))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_opens_after_threshold(self):
+        b = CircuitBreaker("srv", threshold=3, cooldown=60)
+        b.failure()
+        b.failure()
+        self.assertTrue(b.opened_at is None)
+        b.failure()
+        self.assertTrue(b.opened_at is not None)
+        b.success()
+        self.assertTrue(b.opened_at is None)
+        self.assertEqual(b.failures, 0)
+
+    def test_waits_out_cooldown(self):
+        b = CircuitBreaker("srv", threshold=1, cooldown=0.3)
+        b.failure()
+        start = time.time()
+        b.wait()
+        self.assertTrue(time.time() - start >= 0.25)
+        self.assertTrue(b.probing)
+
+    def test_one_probe_at_a_time(self):
+        b = CircuitBreaker("srv", threshold=1, cooldown=0.1)
+        b.failure()
+        b.wait()  # this caller probes
+        passed = list()
+        def _w():
+            b.wait()
+            passed.append(time.time())
+        others = [ threading.Thread(target=_w) for _ in range(3) ]
+        for t in others:
+            t.start()
+        time.sleep(0.4)
+        # well past the cooldown, but the probe hasn't reported back
+        self.assertEqual(passed, [])
+        b.success()
+        for t in others:
+            t.join(5)
+        self.assertEqual(len(passed), 3)
+        self.assertFalse(b.probing)
+
+    def test_failed_probe_reopens(self):
+        b = CircuitBreaker("srv", threshold=1, cooldown=0.2)
+        b.failure()
+        self.assertTrue(b.wait())
+        opened = b.opened_at
+        b.failure(probe=True)
+        self.assertFalse(b.probing)
+        self.assertTrue(b.opened_at > opened)
+        start = time.time()
+        b.wait()
+        self.assertTrue(time.time() - start >= 0.15)
+
+    def test_stale_failure_during_probe(self):
+        b = CircuitBreaker("srv", threshold=1, cooldown=0.1)
+        b.failure()
+        opened = b.opened_at
+        self.assertTrue(b.wait())  # this caller probes
+        # a call that started before the breaker opened fails now
+        stale = threading.Thread(target=b.failure)
+        stale.start()
+        stale.join(5)
+        self.assertTrue(b.probing)
+        self.assertEqual(b.opened_at, opened)
+        probes = list()
+        others = [ threading.Thread(target=lambda: probes.append(b.wait()))
+                   for _ in range(3) ]
+        for t in others:
+            t.start()
+        time.sleep(0.3)
+        # no second probe, though the cooldown is long past
+        self.assertEqual(probes, [])
+        b.success()
+        for t in others:
+            t.join(5)
+        self.assertEqual(probes, [False]*3)
+
+    def test_policy_pauses_endpoint(self):
+        p = Policy(retries=5, backoff=0, breaker_threshold=2,
+                   breaker_cooldown=0.2)
+        f = Flaky(3)
+        start = time.time()
+        self.assertTrue(p.call("srv", "Flaky", f))
+        # opened after the 2nd failure and again after the failed probe
+        self.assertTrue(time.time() - start >= 0.35)
+        self.assertEqual(f.calls, 4)
+        self.assertTrue(p.breaker("srv").opened_at is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
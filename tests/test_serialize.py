@@ -0,0 +1,68 @@
+import unittest
+from cStringIO import StringIO
+import xml.etree.ElementTree as ET
+
+from dcc_sra import serialize
+from dcc_sra import SubmitRecord
+from dcc_sra import PrepSeq
+from dcc_sra.project import StudyMeta
+from dcc_sra.project import SampleMeta
+from dcc_sra.project import PrepMeta
+from dcc_sra.project import SeqMeta
+
+
+def study():
+    return StudyMeta("st0", "Study", "A study of <guts> &\n  other things",
+                     None)
+
+
+def records():
+    mixs = (("biome", "gut"), ("collection_date", "2015-01-01"),
+            ("lat_lon", "42.36 N 71.06 W"), ("samp_size", "  "))
+    p16 = PrepMeta("p16", "16s", "408170", "pcr", "16S  v4\namplicons")
+    pwgs = PrepMeta("pwgs", "wgs", "408170", "random", "Nextera")
+    recs, tardict = list(), dict()
+    for i in range(5):
+        sample = SampleMeta("sa%i"%(i), "Sample \"%i\""%(i), mixs, None)
+        s16 = SeqMeta("s16_%i"%(i), "16s", "Illumina MiSeq",
+                      ("fasp://h/16s_%i.tar"%(i),), 10, None, None)
+        swgs = SeqMeta("swgs_%i"%(i), "wgs", "Illumina HiSeq",
+                       ("fasp://h/wgs_%i.tar"%(i),), 0, None, None)
+        tardict[("16s_%i.tar"%(i), "16s")] = [("/x/16s_%i.fastq"%(i), 10)]
+        # no files and no size: no SRA Action
+        tardict[("wgs_%i.tar"%(i), "wgs")] = [] if i == 3 else \
+            [("/x/wgs_%i_R1.fastq"%(i), 5), ("/x/wgs_%i_R2.fastq"%(i), 5)]
+        recs.append(SubmitRecord(sample, [PrepSeq(p16, s16)]))
+        recs.append(SubmitRecord(sample, [PrepSeq(pwgs, swgs)]))
+    recs.append(SubmitRecord(SampleMeta("empty", "Empty", mixs, None), []))
+    return recs, tardict
+
+
+def old_xml(*args, **kwargs):
+    root = serialize.to_xml(*args, **kwargs)
+    serialize.indent(root)
+    f = StringIO()
+    ET.ElementTree(root).write(f)
+    return f.getvalue()
+
+
+class TestWriteXML(unittest.TestCase):
+
+    def check(self, **kwargs):
+        recs, tardict = records()
+        expected = old_xml(study(), recs, tardict, **kwargs)
+        for workers in (1, 3):
+            f = StringIO()
+            serialize.write_xml(f, study(), recs, tardict, workers=workers,
+                                chunksize=2, **kwargs)
+            self.assertEqual(f.getvalue(), expected)
+
+    def test_same_as_tree(self):
+        self.check()
+
+    def test_same_as_tree_release_bioproject(self):
+        self.check(release_date="March 3, 2017", bioproject_id="PRJNA1")
+
+
+if __name__ == '__main__':
+    unittest.main()
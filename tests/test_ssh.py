@@ -0,0 +1,165 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from os.path import join
+from os.path import isdir
+
+from dcc_sra import ssh
+from dcc_sra.remote import RemoteIndex
+
+from sftp_server import SFTPFixture
+
+
+class TestSSHConnection(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="dcc_sra_test.")
+        self.root = join(self.dir, "root")
+        os.mkdir(self.root)
+        self.server = SFTPFixture(self.root, self.dir).start()
+
+    def tearDown(self):
+        for key in list(ssh._sessions):
+            if key[3] == self.server.port:
+                ssh._sessions.pop(key).close()
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def connect(self, remote_path):
+        return ssh.SSHConnection("ncbi_user", "127.0.0.1",
+                                 self.server.keyfile, remote_path,
+                                 port=self.server.port)
+
+    def put(self, name, data):
+        with open(join(self.root, "submit", name), 'w') as f:
+            f.write(data)
+
+    def test_makes_nested_remote_path(self):
+        conn = self.connect("/submit/Production/study_shard_0/")
+        self.assertEqual(conn.listing(), {})
+        self.assertTrue(isdir(join(self.root, "submit", "Production",
+                                   "study_shard_0")))
+
+    def test_replaces_file_in_the_way(self):
+        with open(join(self.root, "submit"), 'w') as f:
+            f.write("not a directory")
+        conn = self.connect("/submit")
+        self.assertEqual(conn.files(), [])
+        self.assertTrue(isdir(join(self.root, "submit")))
+
+    def test_listing_and_files(self):
+        os.mkdir(join(self.root, "submit"))
+        self.put("a.fastq", "ACGT")
+        self.put("b.fastq", "ACGTACGT")
+        conn = self.connect("/submit")
+        self.assertEqual(conn.listing(), {"a.fastq": 4, "b.fastq": 8})
+        self.assertEqual(sorted(conn.files()), ["a.fastq", "b.fastq"])
+        self.assertEqual(conn.file_cache, {"/submit/a.fastq": 4,
+                                           "/submit/b.fastq": 8})
+
+    def test_fsize(self):
+        os.mkdir(join(self.root, "submit"))
+        self.put("a.fastq", "ACGT")
+        conn = self.connect("/submit")
+        self.assertEqual(conn.fsize("a.fastq"), 4)
+        self.assertTrue(conn.fsize("missing.fastq") is None)
+
+    def test_get(self):
+        os.mkdir(join(self.root, "submit"))
+        self.put("report.1.xml", "<SubmissionStatus />")
+        conn = self.connect("/submit")
+        local = join(self.dir, "report.1.xml")
+        conn.get("report.1.xml", local)
+        with open(local) as f:
+            self.assertEqual(f.read(), "<SubmissionStatus />")
+
+    def test_shared_session(self):
+        a, b = self.connect("/submit/a"), self.connect("/submit/b")
+        a.listing()
+        b.listing()
+        self.assertTrue(a.session is b.session)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_reconnects(self):
+        conn = self.connect("/submit")
+        conn.listing()
+        self.server.drop()
+        time.sleep(0.1)
+        self.assertEqual(conn.listing(), {})
+        self.assertEqual(self.server.connections, 2)
+
+
+class Listing(object):
+    """Stand-in for an :py:class:`dcc_sra.ssh.SSHConnection`"""
+
+    remote_path = "/submit"
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+
+    def listing(self):
+        return dict(self.sizes)
+
+
+class TestRemoteIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="dcc_sra_test.")
+        self.fname = join(self.dir, "remote_index.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_saves_merge(self):
+        conn = Listing({"a.fastq": 1})
+        RemoteIndex(conn, self.fname).refresh()
+        # like two tasks forked from the same index
+        first = RemoteIndex(conn, self.fname)
+        second = RemoteIndex(conn, self.fname)
+        first.record("b.fastq", 2)
+        second.record("c.fastq", 3)
+        first.save()
+        second.save()
+        index = RemoteIndex(conn, self.fname)
+        self.assertEqual(index.sizes, {"a.fastq": 1, "b.fastq": 2,
+                                       "c.fastq": 3})
+        self.assertFalse([ n for n in os.listdir(self.dir)
+                           if n.endswith(".tmp") ])
+
+    def test_refresh_forgets_deleted(self):
+        conn = Listing({"a.fastq": 5, "b.fastq": 5})
+        index = RemoteIndex(conn, self.fname)
+        self.assertEqual(index.get("a.fastq"), 5)
+        other = RemoteIndex(conn, self.fname)
+        other.record("c.fastq", 6)
+        other.save()
+        del conn.sizes["a.fastq"]
+        index.refresh()
+        self.assertEqual(index.get("a.fastq"), None)
+        self.assertEqual(RemoteIndex(conn, self.fname).get("a.fastq"), None)
+
+        # uploads recorded against an older listing still count
+        other.record("d.fastq", 7)
+        other.save()
+        index = RemoteIndex(conn, self.fname)
+        self.assertEqual(index.get("a.fastq"), None)
+        self.assertEqual(index.get("d.fastq"), 7)
+        self.assertEqual(other.get("a.fastq"), None)
+
+    def test_skips_bad_lines(self):
+        with open(self.fname, 'w') as f:
+            f.write("/submit\t%f\na.fastq\t1\nb.fas\nc.fastq\t3\n"%(
+                time.time()))
+        index = RemoteIndex(Listing({}), self.fname)
+        self.assertEqual(index.sizes, {"a.fastq": 1, "c.fastq": 3})
+
+        with open(self.fname, 'w') as f:
+            f.write("/sub")
+        index = RemoteIndex(Listing({"d.fastq": 4}), self.fname)
+        self.assertEqual(index.get("d.fastq"), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
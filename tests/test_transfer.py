@@ -0,0 +1,211 @@
+import os
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import unittest
+from os.path import join
+from os.path import dirname
+from os.path import exists
+from os.path import abspath
+
+from dcc_sra import aspera
+from dcc_sra.cache import TarballCache
+from dcc_sra.policy import Policy
+from dcc_sra.staging import StagingArea
+from dcc_sra.transfer import Job
+from dcc_sra.transfer import Transfers
+
+FAKEASCP = join(dirname(abspath(__file__)), "fakeascp")
+
+URL = "fasp://dcc.example.org/data/run1.tar"
+
+
+class FakeAscpTest(unittest.TestCase):
+    """Run ascp as ``tests/fakeascp``, in a scratch directory"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="dcc_sra_test.")
+        self.env = os.environ.get("FAKEASCP_DIR")
+        os.environ['FAKEASCP_DIR'] = self.dir
+        self.ascp, aspera.ASCP = aspera.ASCP, FAKEASCP
+        self.work = join(self.dir, "work")
+        self.remote = join(self.dir, "remote")
+        os.mkdir(self.work)
+        os.mkdir(self.remote)
+
+    def tearDown(self):
+        aspera.ASCP = self.ascp
+        if self.env is None:
+            del os.environ['FAKEASCP_DIR']
+        else:
+            os.environ['FAKEASCP_DIR'] = self.env
+        shutil.rmtree(self.dir)
+
+    def inject(self, name, n):
+        with open(join(self.dir, name), 'w') as f:
+            print >> f, n
+
+    def calls(self):
+        if not exists(join(self.dir, "log")):
+            return []
+        with open(join(self.dir, "log")) as f:
+            return f.read().splitlines()
+
+    def upload_lists(self):
+        """:returns: List of lists; the basenames each upload asked for"""
+        ret, cur = list(), list()
+        with open(join(self.dir, "uploaded")) as f:
+            for line in f:
+                line = line.strip()
+                if line == "--":
+                    ret.append(cur)
+                    cur = list()
+                else:
+                    cur.append(os.path.basename(line))
+        return ret
+
+    def remote_size(self, name):
+        path = join(self.remote, name)
+        return os.stat(path).st_size if exists(path) else None
+
+    def tarball(self, n=4):
+        """Put a tarball of ``n`` members on the fake DCC
+
+        :returns: Integer; its size
+
+        """
+        src = join(self.dir, "src")
+        os.mkdir(src)
+        for i in range(n):
+            with open(join(src, "r%i.fastq"%(i)), 'w') as f:
+                f.write("@read\nACGT\n+\nIIII\n"*(i+1))
+        path = join(self.dir, "dcc", "data", "run1.tar")
+        os.makedirs(dirname(path))
+        tf = tarfile.open(path, "w")
+        for i in range(n):
+            tf.add(join(src, "r%i.fastq"%(i)), "r%i.fastq"%(i))
+        tf.close()
+        return os.stat(path).st_size
+
+    def transfers(self, policy, batch=False, cache=None, staging=None):
+        return Transfers("dcc_user", "dcc_pw", "ncbi.example.org", "/submit",
+                         "ncbi_user", "/key", batch=batch,
+                         verify=self.remote_size, policy=policy, cache=cache,
+                         staging=staging)
+
+
+class TestFakeAscp(FakeAscpTest):
+
+    def test_download_retries(self):
+        size = self.tarball()
+        self.inject("fail", 2)
+        t = self.transfers(Policy(retries=3, backoff=0, breaker_threshold=0))
+        job = Job(URL, self.work, set(), size, "ns")
+        t.download(job)
+        self.assertEqual(os.stat(job.local_file).st_size, size)
+        self.assertEqual(len(self.calls()), 3)
+
+    def test_download_gives_up(self):
+        size = self.tarball()
+        self.inject("fail", 5)
+        t = self.transfers(Policy(retries=2, backoff=0, breaker_threshold=0))
+        job = Job(URL, self.work, set(), size, "ns")
+        self.assertRaises(Exception, t.download, job)
+        self.assertEqual(len(self.calls()), 3)
+
+    def test_breaker_opens_probes_and_closes(self):
+        size = self.tarball()
+        self.inject("fail", 3)
+        policy = Policy(retries=5, backoff=0, breaker_threshold=2,
+                        breaker_cooldown=0.2)
+        t = self.transfers(policy)
+        t.download(Job(URL, self.work, set(), size, "ns"))
+        # two failures open it, the first probe fails, the second works
+        self.assertEqual(len(self.calls()), 4)
+        breaker = policy.breaker("dcc.example.org")
+        self.assertTrue(breaker.opened_at is None)
+        self.assertEqual(breaker.failures, 0)
+
+    def test_partial_batch_retries_missing_files(self):
+        size = self.tarball(4)
+        t = self.transfers(Policy(retries=2, backoff=0, breaker_threshold=0),
+                           batch=True)
+        job = Job(URL, self.work, set(), size, "ns")
+        t.download(job)
+        t.extract(job)
+        self.inject("partial", 2)
+        for members in t.batches(job):
+            t.upload_batch(job, members)
+        names = sorted(os.path.basename(m.path) for m in job.members)
+        first, second = self.upload_lists()
+        self.assertEqual(sorted(first), names)
+        self.assertEqual(sorted(second), names[2:])
+        for m in job.members:
+            self.assertEqual(self.remote_size(os.path.basename(m.path)),
+                             m.size)
+
+    def test_run(self):
+        size = self.tarball(3)
+        t = self.transfers(Policy(retries=1, backoff=0), batch=True)
+        job = Job(URL, self.work, set(), size, "ns")
+        t.run(job)
+        with open(job.complete_fname) as f:
+            rows = [ line.split("\t") for line in f ]
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(sorted(os.listdir(self.remote)),
+                         sorted(r[0] for r in rows))
+        self.assertFalse(exists(job.stage_dir))
+
+    def test_staging_settles_estimate(self):
+        size = self.tarball(3)
+        staging = StagingArea(10*size)
+        t = self.transfers(Policy(retries=0, backoff=0), batch=True,
+                           staging=staging)
+        job = Job(URL, self.work, set(), size, "ns")
+        t.download(job)
+        t.extract(job)
+        extracted = sum(m.size for m in job.members)
+        self.assertNotEqual(extracted, size)
+        self.assertEqual(staging.usage, size+extracted)
+        self.assertEqual(staging.estimate(size), extracted)
+        for members in t.batches(job):
+            t.upload_batch(job, members)
+        t.finish(job)
+        self.assertEqual(staging.usage, 0)
+        self.assertEqual(staging.draining, 0)
+        self.assertFalse(exists(job.local_file))
+
+    def test_checks_md5(self):
+        size = self.tarball(3)
+        with open(join(self.dir, "dcc", "data", "run1.tar"), 'rb') as f:
+            md5 = hashlib.md5(f.read()).hexdigest()
+        cache = TarballCache(join(self.dir, "cache"))
+        staging = StagingArea(10*size)
+        t = self.transfers(Policy(retries=1, backoff=0), cache=cache,
+                           staging=staging)
+
+        # a download that doesn't match the DCC's md5 is downloaded
+        # again, then fails the job before anything is uploaded
+        job = Job(URL, self.work, set(), size, "ns", md5="0"*32)
+        self.assertRaises(Exception, t.run, job)
+        self.assertEqual(len(self.calls()), 2)
+        self.assertEqual(os.listdir(self.remote), [])
+        self.assertFalse(exists(job.local_file))
+        self.assertFalse(exists(job.stage_dir))
+        self.assertEqual(staging.usage, 0)
+        self.assertFalse(cache.fetch(URL, size, None,
+                                     join(self.dir, "fetched.tar")))
+
+        job = Job(URL, self.work, set(), size, "ns", md5=md5)
+        t.download(job)
+        t.extract(job)
+        os.remove(job.local_file)
+        job = Job(URL, self.work, set(), size, "ns", md5=md5)
+        t.download(job)
+        self.assertEqual(len(self.calls()), 3)
+        self.assertEqual(os.stat(job.local_file).st_size, size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from os.path import join
+
+from dcc_sra import update
+from dcc_sra import ledger
+from dcc_sra.accessions import AccessionIndex
+
+from fake_osdf import FakeOSDF
+from fake_osdf import study_docs
+
+REPORT = """<?xml version="1.0"?>
+<SubmissionStatus submission_id="SUB1" status="processed-ok">
+  <Action action_id="SUB1-a" target_db="BioSample" status="processed-ok">
+    <Response status="processed-ok">
+      <Object target_db="BioSample" spuid="su0_v0_sa0" accession="SAMN01"
+              status="updated" />
+    </Response>
+  </Action>
+  <Action action_id="SUB1-b" target_db="SRA" status="processed-ok">
+    <Response status="processed-ok">
+      <Object target_db="SRA" spuid="su0_v0_sa0_s16" accession="SRR01"
+              status="updated" />
+    </Response>
+  </Action>
+  <Action action_id="SUB1-c" target_db="SRA" status="processed-error">
+    <Response status="error">
+      <Message severity="error">File is corrupt</Message>
+      <Object target_db="SRA" spuid="su0_v0_sa1_s16" />
+    </Response>
+  </Action>
+  <Action action_id="SUB1-d" target_db="SRA" status="processed-error">
+    <Response status="error">
+      <Message severity="error">Submission failed</Message>
+    </Response>
+  </Action>
+</SubmissionStatus>
+"""
+
+
+class Session(object):
+    """Stand-in for ``cutlass.iHMPSession``"""
+
+    def __init__(self, osdf):
+        self.osdf = osdf
+
+    def get_osdf(self):
+        return self.osdf
+
+
+class TestTagNodes(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeOSDF(study_docs(1, 1, 2),
+                               fail_edits=["su0_v0_sa1"]).start()
+        self.session = Session(self.server.client())
+        self.dir = tempfile.mkdtemp(prefix="dcc_sra_test.")
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def tags(self, node_id):
+        return self.server.docs[node_id]['meta']['tags']
+
+    def test_buckets(self):
+        self.server.docs["su0_v0_sa0_s16"]['meta']['tags'] = ["SRA:SRR01"]
+        objects = [ ("su0_v0_sa0", "BioSample", "SAMN01"),
+                    ("su0_v0_sa0_s16", "SRA", "SRR01"),
+                    ("su0_v0_sa0_p16", "SRA", "SRR02"),
+                    ("su0_v0_sa1", "BioSample", "SAMN02"),
+                    ("no_such_node", "SRA", "SRR03") ]
+        tagged = {"su0_v0_sa0_p16": set(["SRA:SRR02"])}
+        summary = update.tag_nodes(self.session, objects, workers=3,
+                                   tagged=tagged)
+        self.assertEqual(summary['tagged'], [objects[0]])
+        self.assertEqual(summary['unchanged'], [objects[1]])
+        self.assertEqual(summary['skipped'], [objects[2]])
+        self.assertEqual([ f[:3] for f in summary['failed'] ],
+                         [objects[4], objects[3]])
+        self.assertEqual(self.tags("su0_v0_sa0"), ["BioSample:SAMN01"])
+        self.assertEqual(self.tags("su0_v0_sa1"), [])
+        self.assertEqual(tagged["su0_v0_sa0"], set(["BioSample:SAMN01"]))
+
+    def test_rerun(self):
+        objects = [ ("su0_v0_sa0", "BioSample", "SAMN01"),
+                    ("su0_v0_sa0_s16", "SRA", "SRR01") ]
+        first = update.tag_nodes(self.session, objects)
+        self.assertEqual(first['tagged'], sorted(objects))
+        puts = self.server.count("PUT")
+        self.assertEqual(puts, 2)
+
+        second = update.tag_nodes(self.session, objects)
+        self.assertEqual(second['unchanged'], sorted(objects))
+        self.assertEqual(self.server.count("PUT"), puts)
+        self.assertEqual(self.tags("su0_v0_sa0"), ["BioSample:SAMN01"])
+
+        # with what the first run tagged, OSDF isn't asked at all
+        tagged = dict()
+        update.tag_nodes(self.session, objects, tagged=tagged)
+        requests = self.server.count()
+        third = update.tag_nodes(self.session, objects, tagged=tagged)
+        self.assertEqual(third['skipped'], sorted(objects))
+        self.assertEqual(self.server.count(), requests)
+
+    def test_update_from_reports(self):
+        report = join(self.dir, "report.1.xml")
+        with open(report, 'w') as f:
+            f.write(REPORT)
+        acc = AccessionIndex(join(self.dir, "accessions.db"))
+        summary = update.update_osdf_from_reports(
+            self.session, [report], accessions=acc)
+        self.assertEqual(summary['tagged'], [
+            ("su0_v0_sa0", "BioSample", "SAMN01"),
+            ("su0_v0_sa0_s16", "SRA", "SRR01") ])
+        self.assertEqual(len(summary['errors']), 2)
+        self.assertTrue("Submission failed" in summary['errors'][0])
+        self.assertTrue("su0_v0_sa1_s16" in summary['errors'][1])
+        self.assertTrue("File is corrupt" in summary['errors'][1])
+        self.assertEqual(self.tags("su0_v0_sa0_s16"), ["SRA:SRR01"])
+
+        # the index remembers the tags, so a rerun leaves OSDF alone
+        requests = self.server.count()
+        again = update.update_osdf_from_reports(
+            self.session, [report], accessions=acc)
+        self.assertEqual(len(again['skipped']), 2)
+        self.assertEqual(self.server.count(), requests)
+        acc.close()
+
+    def test_merge_keeps_latest_submission_errors(self):
+        old = join(self.dir, "report.1.xml")
+        new = join(self.dir, "report.2.xml")
+        with open(old, 'w') as f:
+            f.write(REPORT)
+        with open(new, 'w') as f:
+            f.write(REPORT.replace("Submission failed", "Try again"))
+        errors = list()
+        merged = update.merge_reports([old, new], errors)
+        self.assertEqual(len(merged), 3)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue("Try again" in errors[0])
+
+    def test_handle_error_without_object(self):
+        report = join(self.dir, "report.1.xml")
+        with open(report, 'w') as f:
+            f.write(REPORT)
+        responses = [ update.handle_error(r)
+                      for r in update.responses(report)
+                      if r.get("status") == "error" ]
+        self.assertTrue(responses[-1].startswith("Problem with: submission"))
+        self.assertTrue("Submission failed" in responses[-1])
+
+
+def _record_many(fname, prefix, n):
+    for i in range(n):
+        with ledger.locked(fname) as l:
+            l.record("%s%i"%(prefix, i), "SRA", "SRR%i"%(i), "fp")
+
+
+class TestLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="dcc_sra_test.")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_locked_from_several_processes(self):
+        fname = join(self.dir, ledger.FNAME)
+        procs = [ multiprocessing.Process(target=_record_many,
+                                          args=(fname, "shard%i_"%(i), 20))
+                  for i in range(4) ]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        self.assertEqual(len(ledger.Ledger(fname).entries), 80)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+from dcc_sra.watch import ReportWatcher
+
+REPORT = '<?xml version="1.0"?>\n<SubmissionStatus status="%s" />\n'
+
+
+class Remote(object):
+    """Stand-in for an :py:class:`dcc_sra.ssh.SSHConnection` holding
+    reports"""
+
+    def __init__(self, reports):
+        self.reports = reports
+        self.listings = 0
+
+    def files(self):
+        self.listings += 1
+        return sorted(self.reports)
+
+    def get(self, name, local):
+        with open(local, 'w') as f:
+            f.write(REPORT%(self.reports[name]))
+
+
+class TestReportWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="dcc_sra_test.")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_final_report_already_here(self):
+        with open(join(self.dir, "report.2.xml"), 'w') as f:
+            f.write(REPORT%("processed-ok"))
+        remote = Remote({"report.1.xml": "submitted",
+                         "report.2.xml": "processed-ok"})
+        handled = list()
+        watcher = ReportWatcher(remote, self.dir, interval=5, deadline=30,
+                                until_final=True)
+        self.assertEqual(watcher.watch(handled.append), "processed-ok")
+        # the older report is fetched, but nothing waits on more
+        self.assertEqual(handled, [join(self.dir, "report.1.xml")])
+        self.assertEqual(remote.listings, 1)
+
+    def test_waits_past_local_report(self):
+        with open(join(self.dir, "report.1.xml"), 'w') as f:
+            f.write(REPORT%("processing"))
+        remote = Remote({"report.1.xml": "processing"})
+        watcher = ReportWatcher(remote, self.dir, interval=0.01,
+                                max_interval=0.01, deadline=0.1,
+                                until_final=True)
+        self.assertEqual(watcher.watch(lambda fname: None), "processing")
+        self.assertTrue(remote.listings > 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import time
+import unittest
+from os.path import join
+
+from dcc_sra import ssh
+from dcc_sra.policy import Policy
+from dcc_sra.transfer import Job
+from dcc_sra.transfer import Transfers
+from dcc_sra import workqueue
+from dcc_sra.workqueue import WorkQueue
+from dcc_sra.workqueue import Worker
+
+from sftp_server import SFTPFixture
+from test_transfer import FakeAscpTest
+from test_transfer import URL
+
+
+class TestWorkQueue(unittest.TestCase):
+
+    def queue(self, **kwargs):
+        return WorkQueue(":memory:", **kwargs)
+
+    def test_claim_order(self):
+        q = self.queue()
+        q.publish([ (k, {"n": i}) for i, k in enumerate("cab") ])
+        claimed = [ q.claim("w") for _ in range(4) ]
+        self.assertEqual(claimed[:3], [("c", {"n": 0}), ("a", {"n": 1}),
+                                       ("b", {"n": 2})])
+        self.assertEqual(claimed[3], None)
+        self.assertEqual(q.open(), 3)
+
+    def test_lease_expires(self):
+        q = self.queue(lease=0.05)
+        q.publish([("a", {})])
+        self.assertEqual(q.claim("w1")[0], "a")
+        self.assertEqual(q.claim("w2"), None)
+        time.sleep(0.1)
+        self.assertEqual(q.claim("w2")[0], "a")
+        self.assertFalse(q.renew("a", "w1"))
+        self.assertTrue(q.renew("a", "w2"))
+        q.complete("a", [["r1.fastq", 4]])
+        item = q.items()["a"]
+        self.assertEqual(item.state, "done")
+        self.assertEqual(item.result, [["r1.fastq", 4]])
+
+    def test_fail_retries_then_fails(self):
+        q = self.queue(max_attempts=2)
+        q.publish([("a", {})])
+        q.claim("w")
+        q.fail("a", "w", "first")
+        self.assertEqual(q.items()["a"].state, "pending")
+        self.assertEqual(q.claim("w")[0], "a")
+        q.fail("a", "w", "second")
+        item = q.items()["a"]
+        self.assertEqual((item.state, item.message), ("failed", "second"))
+        self.assertEqual(q.claim("w"), None)
+        self.assertEqual(q.open(), 0)
+
+    def test_publish_keeps_leased(self):
+        q = self.queue()
+        q.publish([("a", {"v": 1}), ("b", {"v": 1})])
+        q.claim("w")
+        q.publish([("a", {"v": 2}), ("b", {"v": 2})])
+        self.assertEqual(q.items()["a"].state, "leased")
+        self.assertTrue(q.renew("a", "w"))
+        self.assertEqual(q.claim("w2"), ("b", {"v": 2}))
+        self.assertEqual(q.claim("w2"), None)
+
+    def test_wait_times_out(self):
+        q = self.queue()
+        q.publish([("a", {})])
+        items = q.wait(["a"], interval=0.01, max_interval=0.01, timeout=0.05)
+        self.assertRaises(Exception, list, items)
+
+
+class TestWorker(FakeAscpTest):
+
+    def setUp(self):
+        super(TestWorker, self).setUp()
+        self.server = SFTPFixture(self.dir, self.dir).start()
+
+    def tearDown(self):
+        for key in list(ssh._sessions):
+            if key[3] == self.server.port:
+                ssh._sessions.pop(key).close()
+        self.server.stop()
+        super(TestWorker, self).tearDown()
+
+    def test_work_one(self):
+        size = self.tarball(3)
+        coordinator = Transfers("dcc_user", "dcc_pw", "127.0.0.1", "/remote",
+                                "ncbi_user", self.server.keyfile, batch=True)
+        job = Job(URL, self.work, set(), size, "ns")
+        job.transfers = coordinator
+        q = WorkQueue(":memory:")
+        q.publish([(job.complete_fname, workqueue.payload(job))])
+
+        worker_dir = join(self.dir, "worker")
+        os.mkdir(worker_dir)
+        worker = Worker(q, "dcc_user", "dcc_pw", worker_dir,
+                        policy=Policy(retries=1, backoff=0),
+                        ssh_port=self.server.port)
+        # the first upload stops after one file; the retry sends the rest
+        self.inject("partial", 1)
+        self.assertTrue(worker.work_one("w"))
+        self.assertFalse(worker.work_one("w"))
+
+        item = q.items()[job.complete_fname]
+        self.assertEqual(item.state, "done")
+        names = sorted(row[0] for row in item.result)
+        self.assertEqual(names, sorted(os.listdir(self.remote)))
+        for row in item.result:
+            self.assertEqual(self.remote_size(row[0]), row[1])
+        self.assertEqual(len(self.upload_lists()[1]), 2)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual((worker.done, worker.failed), (1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()